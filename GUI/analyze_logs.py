@@ -0,0 +1,286 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import datetime
+import itertools
+import concurrent.futures
+import numpy
+inter_path=os.path.dirname(os.path.realpath(__file__))
+sys.path.append(inter_path)
+from logger import Logger
+import topology
+import log_writer
+from conversion import codes_to_voltage, voltage_to_vplot, N_VREFS, MATRIX_A_SENSORS, R1, R2, V_A, CAUTION_VOLTAGE, SATURATION_VOLTAGE
+from recording import RecordingReader
+from rolling_stats import batch_moments, empty_moments, merge_moments, summarize_moments
+
+# Analyzes the CSV logs of many sessions, one file per worker process
+#   Files are read CHUNK_ROWS rows at a time, so memory does not depend on their size
+#   Every file gives a summary that is merged with the others into a single report
+CHUNK_ROWS=16384
+# Deviation events kept in the report of each file, the others are only counted
+MAX_EVENTS=1000
+LOG_PATTERN="log_*.csv"
+MANIFEST_PATTERN="log_*" + log_writer.MANIFEST_SUFFIX
+
+# CSV time column, written by log_writer in one of its time formats
+#   Datetimes are read as UTC, only differences between them are used
+def parse_times (time_strings):
+    if "_" in time_strings[0]:
+        return numpy.array([time_string.replace("_", "T") for time_string in time_strings], dtype="datetime64[ms]").astype(numpy.float64)/1E3
+    return numpy.array(time_strings, dtype=numpy.float64)
+
+# A log is a single CSV file or, when integ.py rotates it, the manifest of its segments
+def is_manifest (file_path):
+    return file_path.endswith(log_writer.MANIFEST_SUFFIX)
+
+# Yields the lines of the rows of a log, headers skipped, compressed segments are decompressed as they are read
+def log_lines (file_path):
+    if is_manifest(file_path):
+        yield from log_writer.SessionLogReader(file_path).lines()
+        return
+    with open(file_path) as csv_file:
+        csv_file.readline()
+        yield from csv_file
+
+def log_size (file_path):
+    if is_manifest(file_path):
+        reader = log_writer.SessionLogReader(file_path)
+        return sum(os.path.getsize(os.path.join(reader.directory, segment["file"])) for segment in reader.segments)
+    return os.path.getsize(file_path)
+
+# Every log of the folder, segments are read through their manifest
+def find_logs (logs_dir):
+    manifests = glob.glob(os.path.join(logs_dir, MANIFEST_PATTERN))
+    segments = {os.path.join(logs_dir, segment["file"]) for manifest in manifests for segment in log_writer.SessionLogReader(manifest).segments}
+    return manifests + [file_path for file_path in glob.glob(os.path.join(logs_dir, LOG_PATTERN)) if file_path not in segments]
+
+# Yields (time strings, (n_rows, n_columns) values) for every chunk of a log
+def read_chunks (file_path, chunk_rows):
+    lines_iterator = log_lines(file_path)
+    while True:
+        lines = list(itertools.islice(lines_iterator, chunk_rows))
+        if not lines:
+            return
+        time_strings = [line.split(",", 1)[0] for line in lines]
+        values = numpy.loadtxt(lines, delimiter=",", usecols=range(1, lines[0].count(",")+1), ndmin=2)
+        yield time_strings, values
+
+# Rows of frames that were missing, older logs filled them with code 0 for every sensor
+#   Code 0 converts to the same resistance for every sensor of a matrix, with the references of the row:
+#   0 before IREF is known and the static model offset without --calculate-values
+#   IREF is not in the log, so the rows found are those where every sensor of each matrix has the same value
+def gap_rows (values):
+    sensors = values[:, N_VREFS:]
+    gaps = numpy.ones(len(values), dtype=bool)
+    for matrix in (sensors[:, :MATRIX_A_SENSORS], sensors[:, MATRIX_A_SENSORS:]):
+        gaps &= (matrix == matrix[:, :1]).all(axis=1)
+    return gaps
+
+# Runs of rows where a member deviates from its group, followed across chunks
+class DeviationEvents ():
+    def __init__ (self, chip, max_events):
+        self.chip = chip
+        self.max_events = max_events
+        self.n_events = 0
+        self.events = []
+        self.rows = numpy.zeros(len(chip.members), dtype=numpy.int64)
+        # Event still going on at the end of the last chunk, per member: [start, rows, max deviation]
+        self.open = [None]*len(chip.members)
+        self.last_time = None
+
+    def add (self, time_strings, deviation, deviating):
+        self.rows += deviating.sum(axis=0)
+        for member in numpy.nonzero(deviating.any(axis=0) | numpy.array([event is not None for event in self.open]))[0]:
+            flags = deviating[:, member]
+            edges = numpy.diff(numpy.concatenate(([self.open[member] is not None], flags, [False])).astype(numpy.int8))
+            starts = numpy.nonzero(edges == 1)[0]
+            ends = numpy.nonzero(edges == -1)[0]
+            if self.open[member] is not None:
+                starts = numpy.concatenate(([-1], starts))
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                run = numpy.abs(deviation[max(start, 0):end, member])
+                event = self.open[member] if start < 0 else [time_strings[start], 0, 0.0]
+                event[1] += end - max(start, 0)
+                event[2] = max(event[2], float(run.max())) if len(run) else event[2]
+                if end == len(flags):
+                    # Goes on in the next chunk
+                    self.open[member] = event
+                else:
+                    self.open[member] = None
+                    # An event that went on in the last chunk may end right at the start of this one
+                    self._close(member, event, time_strings[end-1] if end > 0 else self.last_time)
+        self.last_time = time_strings[-1]
+
+    def _close (self, member, event, end):
+        self.n_events += 1
+        if len(self.events) < self.max_events:
+            self.events.append({"sensor": self.chip.label(self.chip.members[member]), "start": event[0], "end": end, "rows": event[1], "max_deviation": event[2]})
+
+    def close (self, last_time):
+        for member, event in enumerate(self.open):
+            if event is not None:
+                self._close(member, event, last_time)
+        self.open = [None]*len(self.open)
+
+# Samples above the caution and saturation voltages, from the raw codes of the recording of the session
+def count_saturation (recording_path, aref_voltage, adc_resoltuion, chunk_rows):
+    recording = RecordingReader(recording_path)
+    caution = numpy.zeros(recording.n_sensors - N_VREFS, dtype=numpy.int64)
+    saturation = numpy.zeros_like(caution)
+    for first in range(0, len(recording), chunk_rows):
+        codes = recording.records[first:first+chunk_rows]["codes"][:, N_VREFS:]
+        vplots = voltage_to_vplot(codes_to_voltage(codes, aref_voltage, adc_resoltuion), R1, R2, V_A)
+        caution += (vplots > CAUTION_VOLTAGE).sum(axis=0)
+        saturation += (vplots > SATURATION_VOLTAGE).sum(axis=0)
+    return {"frames": len(recording), "caution": caution, "saturation": saturation}
+
+# Summary of a single CSV log, run by the worker processes
+def analyze_file (file_path, topology_path, max_deviation, aref_voltage, adc_resoltuion, chunk_rows=CHUNK_ROWS, max_events=MAX_EVENTS):
+    chip = topology.load_topology(topology_path)
+    summary = {"file": file_path, "rows": 0, "skipped_rows": 0, "start": None, "end": None}
+    sensor_moments = None
+    group_moments = empty_moments(len(chip.starts))
+    events = DeviationEvents(chip, max_events)
+    minimum = maximum = None
+    last_time = None
+    for time_strings, values in read_chunks(file_path, chunk_rows):
+        summary["rows"] += len(values)
+        # Older logs have frames filled with zeros where frames were missing, they are not measurements
+        measured = ~gap_rows(values)
+        summary["skipped_rows"] += int(numpy.count_nonzero(~measured))
+        if not measured.any():
+            continue
+        time_strings = [time_string for time_string, keep in zip(time_strings, measured.tolist()) if keep]
+        values = values[measured]
+        times = parse_times(time_strings)
+        if summary["start"] is None:
+            summary["start"] = time_strings[0]
+            sensor_moments = empty_moments(values.shape[1])
+            minimum = numpy.full(values.shape[1], numpy.inf)
+            maximum = numpy.full(values.shape[1], -numpy.inf)
+        summary["end"] = last_time = time_strings[-1]
+        sensor_moments = merge_moments(sensor_moments, batch_moments(times, values))
+        numpy.minimum(minimum, values.min(axis=0), out=minimum)
+        numpy.maximum(maximum, values.max(axis=0), out=maximum)
+        # Same groups and deviation rule as the live check of integ.py
+        group_means, deviation = chip.group_deviation(values[:, N_VREFS:])
+        group_moments = merge_moments(group_moments, batch_moments(times, group_means))
+        events.add(time_strings, deviation, numpy.abs(deviation) > max_deviation)
+    if last_time is not None:
+        events.close(last_time)
+    summary["sensor_moments"] = sensor_moments
+    summary["min"] = minimum
+    summary["max"] = maximum
+    summary["group_moments"] = group_moments
+    summary["deviating_rows"] = events.rows
+    summary["n_events"] = events.n_events
+    summary["events"] = events.events
+    # Saved next to the log when integ.py runs with --record
+    suffix = os.path.basename(file_path)[len("log_"):-len(log_writer.MANIFEST_SUFFIX if is_manifest(file_path) else ".csv")]
+    recording_path = os.path.join(os.path.dirname(file_path), "rec_" + suffix + ".rec")
+    summary["saturation"] = count_saturation(recording_path, aref_voltage, adc_resoltuion, chunk_rows) if os.path.exists(recording_path) else None
+    return summary
+
+def sensor_report (names, moments, minimum, maximum):
+    report = summarize_moments(moments)
+    if report["count"]:
+        report["min"] = minimum.tolist()
+        report["max"] = maximum.tolist()
+    report["names"] = names
+    return report
+
+def file_report (summary, sensor_names, group_names):
+    report = {key: summary[key] for key in ["file", "rows", "skipped_rows", "start", "end", "n_events", "events"]}
+    if summary["sensor_moments"] is not None:
+        report["sensors"] = sensor_report(sensor_names, summary["sensor_moments"], summary["min"], summary["max"])
+        report["groups"] = dict(summarize_moments(summary["group_moments"]), names=group_names)
+    report["deviating_rows"] = summary["deviating_rows"].tolist()
+    if summary["saturation"] is not None:
+        report["saturation"] = {key: value.tolist() if isinstance(value, numpy.ndarray) else value for key, value in summary["saturation"].items()}
+    return report
+
+# Merges the summaries of every file into the report
+def merge_summaries (summaries, chip):
+    sensor_names = ["VREF_A", "VREF_B"] + [chip.label(sensor) for sensor in range(chip.n_resistors)]
+    group_names = ["|".join(chip.label(sensor) for sensor in chip.members[start:start+size]) for start, size in zip(chip.starts.tolist(), chip.sizes.tolist())]
+    measured = [summary for summary in summaries if summary["sensor_moments"] is not None]
+    sensor_moments = empty_moments(len(sensor_names))
+    group_moments = empty_moments(len(group_names))
+    minimum = numpy.full(len(sensor_names), numpy.inf)
+    maximum = numpy.full(len(sensor_names), -numpy.inf)
+    for summary in measured:
+        sensor_moments = merge_moments(sensor_moments, summary["sensor_moments"])
+        group_moments = merge_moments(group_moments, summary["group_moments"])
+        numpy.minimum(minimum, summary["min"], out=minimum)
+        numpy.maximum(maximum, summary["max"], out=maximum)
+    recorded = [summary["saturation"] for summary in summaries if summary["saturation"] is not None]
+    report = {
+        "files": len(summaries),
+        "rows": sum(summary["rows"] for summary in summaries),
+        "skipped_rows": sum(summary["skipped_rows"] for summary in summaries),
+        "sensors": sensor_report(sensor_names, sensor_moments, minimum, maximum),
+        "groups": dict(summarize_moments(group_moments), names=group_names),
+        "deviating_rows": sum((summary["deviating_rows"] for summary in summaries), numpy.zeros(len(chip.members), dtype=numpy.int64)).tolist(),
+        "deviating_names": [chip.label(sensor) for sensor in chip.members.tolist()],
+        "n_events": sum(summary["n_events"] for summary in summaries),
+        # Only sessions recorded with --record have the raw codes needed to find saturated samples
+        "saturation": {
+            "files": len(recorded),
+            "frames": sum(saturation["frames"] for saturation in recorded),
+            "caution": sum((saturation["caution"] for saturation in recorded), numpy.zeros(chip.n_resistors, dtype=numpy.int64)).tolist(),
+            "saturation": sum((saturation["saturation"] for saturation in recorded), numpy.zeros(chip.n_resistors, dtype=numpy.int64)).tolist(),
+        },
+        "per_file": [file_report(summary, sensor_names, group_names) for summary in summaries],
+    }
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Analyzes the CSV logs of many sessions in parallel and writes a single JSON report.')
+    parser.add_argument('files', help='CSV logs or manifests of rotated logs to analyze (defaults to every log in the logs folder)', type=str, nargs='*')
+    parser.add_argument('--logs-dir', help='Folder searched for logs when no file is given', type=str, default=os.path.join(inter_path, "logs"))
+    parser.add_argument('--jobs', help='Worker processes, one file each at a time', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-rows', help='Rows read at once from a log, bounds the memory used by each worker', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--max-deviation', help='Max modular difference between a group of resistances (in kOhms)', type=int, default=10)
+    parser.add_argument('--aref', help='Voltage reference of the Arduino board', type=float, default=5)
+    parser.add_argument('--adc_resolution', help='Number of bits of resolution of the ADC', type=int, default=10)
+    parser.add_argument('--topology', help='JSON description of the groups of resistors of the chip', type=str, default=topology.DEFAULT_TOPOLOGY)
+    parser.add_argument('--max-events', help='Deviation events listed per file, the others are only counted', type=int, default=MAX_EVENTS)
+    parser.add_argument('--output', help='JSON file where the report is written', type=str, default=None)
+    parser.add_argument('--verbose', help='Outputs all messages', action='store_true')
+    args = parser.parse_args()
+
+    analyzer_logger = Logger("ANALYZER")
+    if args.verbose:
+        analyzer_logger.set_debug()
+    else:
+        analyzer_logger.set_info()
+    files = sorted(args.files or find_logs(args.logs_dir))
+    if not files:
+        analyzer_logger.error("No logs to analyze")
+        exit(1)
+    chip = topology.load_topology(args.topology)
+    adc_resoltuion = (2**args.adc_resolution)-1
+    # Biggest files first, so a large one does not start last and hold up the end
+    files.sort(key=log_size, reverse=True)
+    summaries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(analyze_file, file_path, args.topology, args.max_deviation, args.aref, adc_resoltuion, args.chunk_rows, args.max_events): file_path for file_path in files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                summaries.append(future.result())
+            # A malformed file is reported and left out of the report, the others are still analyzed
+            except Exception as e:
+                analyzer_logger.error("Could not analyze %s: %r", futures[future], e)
+                continue
+            analyzer_logger.debug("Analyzed %s", futures[future])
+    summaries.sort(key=lambda summary: summary["file"])
+    report = merge_summaries(summaries, chip)
+    output = args.output
+    if output is None:
+        output = os.path.join(args.logs_dir, "analysis_" + datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".json")
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=1)
+    analyzer_logger.info("%d files, %d rows, %d deviation events, report written to %s", report["files"], report["rows"], report["n_events"], output)
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import protocol
+from metrics import registry, STAGE_SERIAL, STAGE_ENQUEUE, STAGE_DECODE, STAGE_SEND
+
+# asyncio building blocks shared by osc.py and integ.py
+#   Stages are coroutines connected by bounded asyncio.Queue objects: a full queue makes the stage
+#   before it wait, instead of dropping or piling up frames, and cancelling the pipeline stops every
+#   stage at once, wherever it is waiting
+ASYNC_QUEUE_SIZE=1024
+RECV_BUFFER_SIZE=4096
+# In seconds, how often a serial port that can not be watched by the event loop is polled
+SERIAL_POLL_INTERVAL=0.05
+
+# Puts the frames read from an Oscilloscope opened with timeout=0 (non-blocking) in frames, tagged with board
+#   on_frames(batch) is called with the frames of each read and returns the frames to put
+async def read_serial(serial_reader, frames, on_frames=None, board=0):
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    watched = None
+    watched_port = None
+    seq = 0
+    try:
+        while True:
+            # Reconnecting opens a new file descriptor, it may get the number of the one it replaces
+            try:
+                fileno = serial_reader.ser.fileno()
+            except (AttributeError, OSError):
+                fileno = None
+            if fileno != watched or serial_reader.ser is not watched_port:
+                if watched is not None:
+                    loop.remove_reader(watched)
+                    watched = None
+                if fileno is not None:
+                    try:
+                        loop.add_reader(fileno, readable.set)
+                        watched = fileno
+                        watched_port = serial_reader.ser
+                    except NotImplementedError:
+                        pass
+            if watched is None:
+                await asyncio.sleep(SERIAL_POLL_INTERVAL)
+            else:
+                await readable.wait()
+                readable.clear()
+            receive_times, samples = serial_reader.get_serial_frames()
+            batch = []
+            for receive_time, frame_samples in zip(receive_times.tolist(), samples):
+                batch.append(protocol.Frame(seq, receive_time, frame_samples, board, {STAGE_SERIAL: receive_time}))
+                seq += 1
+            if on_frames is not None:
+                batch = on_frames(batch)
+            for frame in batch:
+                await frames.put(frame)
+                registry.stamp(frame.stamps, STAGE_ENQUEUE)
+    finally:
+        if watched is not None:
+            loop.remove_reader(watched)
+
+# Puts the frames received on a stream in frames, returns when the other side closes it
+async def read_stream(reader, decoder, frames, on_frames=None):
+    while True:
+        data = await reader.read(RECV_BUFFER_SIZE)
+        if not data:
+            return
+        batch = decoder.feed(data)
+        for frame in batch:
+            registry.stamp(frame.stamps, STAGE_DECODE)
+        if on_frames is not None:
+            batch = on_frames(batch)
+        for frame in batch:
+            await frames.put(frame)
+
+# Encodes every frame once and hands it to the subscribers of an AsyncFrameServer
+async def publish_frames(frames, server, wire_protocol):
+    while True:
+        frame = await frames.get()
+        server.publish(protocol.encode_frame(wire_protocol, frame.seq, frame.timestamp, frame.samples))
+        registry.stamp(frame.stamps, STAGE_SEND)
+
+# Takes every frame waiting (up to max_batch) and hands them to process(batch) on an executor thread
+#   process is CPU bound (conversion, logging), running it on the loop would stall the readers
+#   on_timeout() is called when no frame arrives in timeout seconds
+#   timeout may be a function returning it, called before each wait
+async def process_batches(frames, process, max_batch, timeout, on_timeout=None):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            batch = [await asyncio.wait_for(frames.get(), timeout() if callable(timeout) else timeout)]
+        except asyncio.TimeoutError:
+            if on_timeout:
+                on_timeout()
+            continue
+        while len(batch) < max_batch and not frames.empty():
+            batch.append(frames.get_nowait())
+        job = loop.run_in_executor(None, process, batch)
+        try:
+            await asyncio.shield(job)
+        except asyncio.CancelledError:
+            # The executor thread can not be interrupted, the batch is finished before stopping
+            await job
+            raise
+
+# Runs the stages until one of them returns or fails, then cancels the others
+async def run_stages(*stages):
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        if not task.cancelled():
+            task.result()
+
+# Runs coroutine_function(*args) in an event loop of its own thread
+#   so it can live next to the matplotlib main loop or a signal handling main thread
+class PipelineThread ():
+    def __init__ (self, coroutine_function, args=(), name="pipeline_thread"):
+        self.coroutine_function = coroutine_function
+        self.args = args
+        self.loop = None
+        self.task = None
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name)
+
+    def _run (self):
+        try:
+            asyncio.run(self._main())
+        finally:
+            self.started.set()
+
+    async def _main (self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.started.set()
+        try:
+            await self.coroutine_function(*self.args)
+        except asyncio.CancelledError:
+            pass
+
+    def start (self):
+        self.thread.start()
+        self.started.wait()
+
+    def is_alive (self):
+        return self.thread.is_alive()
+
+    def join (self, timeout=None):
+        self.thread.join(timeout)
+
+    # Cancels the pipeline and waits until every stage has finished
+    def stop (self):
+        try:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+        self.thread.join()
@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy
+inter_path=os.path.dirname(os.path.realpath(__file__))
+sys.path.append(inter_path)
+from logger import Logger
+import protocol
+import log_writer
+from serial_parser import SerialLineParser, FrameReassembler
+from conversion import ConversionEngine, R1, R2, V_A
+from frame_pool import FramePool, FRAME_POOL_BUFFERS
+from virtual_sensor import FirmwareEmulator, VirtualPort
+
+# Drives the same building blocks used by osc.py and integ.py at increasing frame rates
+#   source -> serial parse -> socket encode -> TCP -> decode -> conversion -> CSV logging
+# Every stage runs on its own thread with a bounded input queue, like the real scripts.
+# A frame that finds the next queue full is dropped and counted against that stage.
+
+STAGES=["serial_parse", "socket_encode", "decode", "conversion", "csv_logging"]
+N_SENSORS=34
+SOURCE_TICK=0.001
+DRAIN_TIMEOUT=5.0
+# Lines are generated once and replayed, so the emulator itself is not what limits the rate
+SOURCE_LINES=256
+# In seconds, short so the csv_logging latency is the cost of writing rather than the wait for the flush timer
+LOG_FLUSH_INTERVAL=0.01
+
+class StageStats ():
+    def __init__ (self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.latencies = []
+        # time.monotonic() of the first and last frame the stage finished
+        self.first = None
+        self.last = None
+
+    def add (self, latency, done):
+        self.processed += 1
+        self.latencies.append(latency)
+        if self.first is None:
+            self.first = done
+        self.last = done
+
+    # Throughput is measured while the stage was processing frames, the wait for the last ones to drain does not count
+    def summary (self):
+        latencies = numpy.array(self.latencies) * 1E3
+        span = self.last - self.first if self.processed > 1 else 0
+        return {
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "throughput_fps": (self.processed - 1)/span if span > 0 else 0.0,
+            "p50_ms": float(numpy.percentile(latencies, 50)) if latencies.size else None,
+            "p99_ms": float(numpy.percentile(latencies, 99)) if latencies.size else None,
+        }
+
+def put_or_drop(target_queue, item, stats):
+    try:
+        target_queue.put(item, block=False)
+        return True
+    except queue.Full:
+        stats.dropped += 1
+        return False
+
+def drain(source_queue, timeout):
+    items = [source_queue.get(block=True, timeout=timeout)]
+    try:
+        while True:
+            items.append(source_queue.get(block=False))
+    except queue.Empty:
+        pass
+    return items
+
+class PipelineBenchmark ():
+    def __init__ (self, rate, duration, source, wire_protocol, queue_size, log_dir, seed, frame_pool=True):
+        self.rate = rate
+        self.duration = duration
+        self.source = source
+        self.wire_protocol = wire_protocol
+        self.log_dir = log_dir
+        self.stop = threading.Event()
+        self.source_done = threading.Event()
+        self.stats = {name: StageStats(name) for name in STAGES}
+        self.source_sent = 0
+        self.queues = {name: queue.Queue(queue_size) for name in STAGES}
+        # Sequence number -> stage input times, used to follow frames across the socket
+        self.in_flight = {}
+        # The ascii protocol does not carry sequence numbers, decoders count frames as they arrive
+        self.wire_seqs = {}
+        emulator = FirmwareEmulator(seed=seed)
+        self.lines = [emulator.next_frame()[0] for _ in range(SOURCE_LINES)]
+        self.parser = SerialLineParser(N_SENSORS)
+        self.engine = ConversionEngine(5, 1023, R1, R2, V_A, True)
+        self.tables = self.engine.build_tables([0.5, 0.5], [1E-6, 1E-6])
+        # Binary frames are decoded into it and gathered out of it by the conversion, like in integ.py
+        self.pool = FramePool(FRAME_POOL_BUFFERS, N_SENSORS, protocol.SAMPLE_DTYPE) if frame_pool else None
+
+    def _due_frames (self, start):
+        return int((time.monotonic()-start)*self.rate) - self.source_sent
+
+    def run_synthetic_source (self):
+        start = time.monotonic()
+        end = start + self.duration
+        while time.monotonic() < end:
+            for _ in range(self._due_frames(start)):
+                line = self.lines[self.source_sent % SOURCE_LINES]
+                put_or_drop(self.queues["serial_parse"], (time.monotonic(), line), self.stats["serial_parse"])
+                self.source_sent += 1
+            time.sleep(SOURCE_TICK)
+        self.source_done.set()
+
+    def run_pty_source (self, port):
+        start = time.monotonic()
+        end = start + self.duration
+        while time.monotonic() < end:
+            for _ in range(self._due_frames(start)):
+                line = self.lines[self.source_sent % SOURCE_LINES]
+                port.write(line, time.monotonic()+SOURCE_TICK)
+                self.source_sent += 1
+            time.sleep(SOURCE_TICK)
+        self.source_done.set()
+
+    def run_pty_reader (self, port_name):
+        import serial
+        ser = serial.Serial(port=port_name, timeout=SOURCE_TICK*10)
+        reassembler = FrameReassembler()
+        read_buffer = bytearray(64*1024)
+        read_view = memoryview(read_buffer)
+        while not self.stop.is_set():
+            n_bytes = ser.readinto(read_view[:min(max(ser.in_waiting, 1), len(read_buffer))])
+            if not n_bytes:
+                continue
+            receive_time = time.monotonic()
+            complete = reassembler.feed(read_view[:n_bytes])
+            for line in complete.splitlines(keepends=True):
+                put_or_drop(self.queues["serial_parse"], (receive_time, line), self.stats["serial_parse"])
+        ser.close()
+
+    def run_parse (self):
+        seq = 0
+        while not self.stop.is_set():
+            try:
+                items = drain(self.queues["serial_parse"], SOURCE_TICK*10)
+            except queue.Empty:
+                continue
+            rejects = sum(self.parser.rejects.values())
+            frames = self.parser.parse(b"".join(line for _, line in items))
+            self.stats["serial_parse"].dropped += sum(self.parser.rejects.values()) - rejects
+            done = time.monotonic()
+            # Without rejects frames map one to one to their lines
+            in_times = [in_time for in_time, _ in items] if len(frames) == len(items) else [items[0][0]]*len(frames)
+            for in_time, samples in zip(in_times, frames):
+                self.stats["serial_parse"].add(done-in_time, done)
+                self.in_flight[seq] = {"socket_encode": done}
+                if not put_or_drop(self.queues["socket_encode"], (seq, samples), self.stats["socket_encode"]):
+                    del self.in_flight[seq]
+                seq += 1
+
+    def run_encode (self, data_socket):
+        wire_seq = 0
+        while not self.stop.is_set():
+            try:
+                seq, samples = self.queues["socket_encode"].get(block=True, timeout=SOURCE_TICK*10)
+            except queue.Empty:
+                continue
+            data = protocol.encode_frame(self.wire_protocol, wire_seq, time.time(), samples)
+            self.wire_seqs[wire_seq] = seq
+            wire_seq += 1
+            done = time.monotonic()
+            stamps = self.in_flight[seq]
+            self.stats["socket_encode"].add(done-stamps["socket_encode"], done)
+            # Decode latency covers the TCP hop, the stamp must exist before the receiver can see the frame
+            stamps["decode"] = done
+            data_socket.sendall(data)
+
+    def run_decode (self, data_socket):
+        decoder = protocol.make_decoder(self.wire_protocol, 0, self.pool)
+        data_socket.settimeout(SOURCE_TICK*10)
+        while not self.stop.is_set():
+            try:
+                data = data_socket.recv(4096)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            frames = decoder.feed(data)
+            done = time.monotonic()
+            for frame in frames:
+                frame = frame._replace(seq=self.wire_seqs.pop(frame.seq))
+                stamps = self.in_flight[frame.seq]
+                self.stats["decode"].add(done-stamps["decode"], done)
+                stamps["conversion"] = done
+                if not put_or_drop(self.queues["conversion"], frame, self.stats["conversion"]):
+                    del self.in_flight[frame.seq]
+                    if self.pool:
+                        self.pool.release(frame.slot)
+
+    def run_conversion (self):
+        while not self.stop.is_set():
+            try:
+                frames = drain(self.queues["conversion"], SOURCE_TICK*10)
+            except queue.Empty:
+                continue
+            codes = self.pool.gather(frames) if self.pool else numpy.stack([frame.samples for frame in frames])
+            _, resistances = self.engine.convert_with_tables(codes, *self.tables)
+            done = time.monotonic()
+            for frame in frames:
+                stamps = self.in_flight[frame.seq]
+                self.stats["conversion"].add(done-stamps["conversion"], done)
+                stamps["csv_logging"] = done
+            timestamps = numpy.array([frame.timestamp for frame in frames])
+            values = numpy.hstack((numpy.full((len(frames), 2), 0.5), resistances))
+            if not put_or_drop(self.queues["csv_logging"], ([frame.seq for frame in frames], timestamps, values), self.stats["csv_logging"]):
+                # The whole batch is lost, not only one frame
+                self.stats["csv_logging"].dropped += len(frames) - 1
+                for frame in frames:
+                    del self.in_flight[frame.seq]
+
+    def run_logging (self, writer):
+        while not self.stop.is_set():
+            try:
+                seqs, timestamps, values = self.queues["csv_logging"].get(block=True, timeout=SOURCE_TICK*10)
+            except queue.Empty:
+                continue
+            # Timed by logged(), once the writer thread has flushed the rows
+            writer.write(timestamps, values, seqs)
+
+    # on_flush of the LogWriter, the csv_logging stage ends when the rows are on disk
+    def logged (self, tags, flushed_time):
+        done = time.monotonic()
+        for seqs in tags:
+            for seq in seqs:
+                self.stats["csv_logging"].add(done-self.in_flight.pop(seq)["csv_logging"], done)
+
+    def pending (self):
+        return sum(stage_queue.qsize() for stage_queue in self.queues.values()) + len(self.in_flight)
+
+    def run (self):
+        server = socket.socket()
+        server.bind(("localhost", 0))
+        server.listen(1)
+        sender = socket.create_connection(server.getsockname())
+        receiver, _ = server.accept()
+        writer = log_writer.LogWriter(os.path.join(self.log_dir, f"bench_{self.rate}.csv"), ["time"]+[f"sensor{x}" for x in range(N_SENSORS)], flush_interval=LOG_FLUSH_INTERVAL, on_flush=self.logged)
+        threads = [
+            threading.Thread(target=self.run_parse, name="bench_parse"),
+            threading.Thread(target=self.run_encode, args=(sender,), name="bench_encode"),
+            threading.Thread(target=self.run_decode, args=(receiver,), name="bench_decode"),
+            threading.Thread(target=self.run_conversion, name="bench_conversion"),
+            threading.Thread(target=self.run_logging, args=(writer,), name="bench_logging"),
+        ]
+        port = None
+        if self.source == "pty":
+            port = VirtualPort()
+            threads.append(threading.Thread(target=self.run_pty_reader, args=(port.name,), name="bench_pty_reader"))
+            threads.append(threading.Thread(target=self.run_pty_source, args=(port,), name="bench_source"))
+        else:
+            threads.append(threading.Thread(target=self.run_synthetic_source, name="bench_source"))
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        for thread in threads:
+            thread.start()
+        self.source_done.wait()
+        # Lets frames already in the pipeline reach the end, whatever is still pending afterwards is lost
+        drain_end = time.monotonic() + DRAIN_TIMEOUT
+        while self.pending() and time.monotonic() < drain_end:
+            time.sleep(SOURCE_TICK*10)
+        duration = time.monotonic() - start
+        # CPU of every stage together, what the pipeline costs whatever the number of cores
+        cpu_time = time.process_time() - cpu_start
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        writer.close()
+        sender.close()
+        receiver.close()
+        server.close()
+        if port:
+            # Frames the reader did not take in time are lost on the port, like a UART overrun
+            self.stats["serial_parse"].dropped += port.overruns
+            port.close()
+        stages = {name: stats.summary() for name, stats in self.stats.items()}
+        return {
+            "target_fps": self.rate,
+            "source_frames": self.source_sent,
+            "delivered_frames": self.stats["csv_logging"].processed,
+            "lost_in_flight": len(self.in_flight),
+            "rows_written": writer.rows_written,
+            "duration_s": duration,
+            "cpu_us_per_frame": cpu_time/self.source_sent*1E6 if self.source_sent else None,
+            "frame_pool": self.pool is not None,
+            "stages": stages,
+        }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=inter_path, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the acquisition pipeline stages at increasing frame rates. Runs headless.')
+    parser.add_argument('--rates', help='Comma separated frame rates to test (frames per second)', type=str, default="1,10,100,1000,5000")
+    parser.add_argument('--duration', help='Seconds spent on each rate', type=float, default=5.0)
+    parser.add_argument('--source', help='Where frames come from', choices=['synthetic', 'pty'], default='synthetic')
+    parser.add_argument('--protocol', help='Wire format used through the socket', choices=protocol.PROTOCOLS, default=protocol.PROTOCOL_BINARY)
+    parser.add_argument('--queue-size', help='Size of the queue in front of every stage', type=int, default=1024)
+    parser.add_argument('--seed', help='Seed of the synthetic sensor values', type=int, default=0)
+    parser.add_argument('--no-frame-pool', help='Decodes every binary frame into an array of its own, to compare with the frame pool', action='store_true')
+    parser.add_argument('--output', help='JSON file where results are written', type=str, default=None)
+    parser.add_argument('--verbose', help='Outputs all messages', action='store_true')
+    args = parser.parse_args()
+
+    benchmark_logger = Logger("BENCHMARK")
+    if args.verbose:
+        benchmark_logger.set_debug()
+    else:
+        benchmark_logger.set_info()
+
+    commit = git_commit()
+    sttime = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    output = args.output
+    if output is None:
+        if not os.path.exists(os.path.join(inter_path, "benchmarks")):
+            os.makedirs(os.path.join(inter_path, "benchmarks"))
+        output = os.path.join(inter_path, "benchmarks", f"bench_{sttime}_{(commit or 'nogit')[:8]}.json")
+    results = {
+        "commit": commit,
+        "time": sttime,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as log_dir:
+        for rate in [float(rate) for rate in args.rates.split(",")]:
+            benchmark_logger.info("Running %g fps for %gs", rate, args.duration)
+            result = PipelineBenchmark(rate, args.duration, args.source, args.protocol, args.queue_size, log_dir, args.seed, not args.no_frame_pool).run()
+            results["results"].append(result)
+            for name, stage in result["stages"].items():
+                benchmark_logger.info("\t%-14s %9.1f fps  p50 %8.3f ms  p99 %8.3f ms  dropped %d", name, stage['throughput_fps'], stage['p50_ms'] or 0, stage['p99_ms'] or 0, stage['dropped'])
+            benchmark_logger.info("\tcpu %.1f us per frame", result['cpu_us_per_frame'] or 0)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    benchmark_logger.info("Results written to %s", output)
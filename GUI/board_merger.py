@@ -0,0 +1,63 @@
+import heapq
+import itertools
+
+# Per board counters kept by the merger
+class BoardStats ():
+    def __init__ (self):
+        self.frames = 0
+        # Released after a frame of another board with a later timestamp
+        self.late = 0
+        self.last_timestamp = None
+
+    def __repr__ (self):
+        return f"{self.frames} frames, {self.late} late"
+
+# Merges the frame streams of several boards into a single stream ordered by timestamp
+#   A frame is held until every board has sent a frame at least as recent, so no board
+#   can still send an older one, or until it has waited max_delay seconds, so a board
+#   that stops sending only delays the others by max_delay
+class FrameMerger ():
+    def __init__ (self, n_boards, max_delay):
+        self.n_boards = n_boards
+        self.max_delay = max_delay
+        # (timestamp, arrival order, frame)
+        self.pending = []
+        self.order = itertools.count()
+        self.latest = [None]*n_boards
+        self.last_released = None
+        self.stats = [BoardStats() for board in range(n_boards)]
+
+    def __len__ (self):
+        return len(self.pending)
+
+    # Adds frames of any board and returns the frames that can be released, oldest first
+    def push (self, frames, now):
+        for frame in frames:
+            self.stats[frame.board].frames += 1
+            self.stats[frame.board].last_timestamp = frame.timestamp
+            if self.latest[frame.board] is None or frame.timestamp > self.latest[frame.board]:
+                self.latest[frame.board] = frame.timestamp
+            heapq.heappush(self.pending, (frame.timestamp, next(self.order), frame))
+        return self.release(now)
+
+    # Returns the frames that can be released at time now, oldest first
+    def release (self, now):
+        released = []
+        while self.pending:
+            timestamp = self.pending[0][0]
+            if timestamp > now - self.max_delay and not all(latest is not None and latest >= timestamp for latest in self.latest):
+                break
+            released.append(self._pop())
+        return released
+
+    # Returns every frame still held, oldest first
+    def flush (self):
+        return [self._pop() for _ in range(len(self.pending))]
+
+    def _pop (self):
+        timestamp, _, frame = heapq.heappop(self.pending)
+        if self.last_released is not None and timestamp < self.last_released:
+            self.stats[frame.board].late += 1
+        else:
+            self.last_released = timestamp
+        return frame
@@ -0,0 +1,78 @@
+import threading
+import numpy
+from conversion import codes_to_voltage, voltage_to_vplot
+
+# Sensors of a frame (VREFs included) whose mean is the output voltage of the IREF resistor of matrix A and B
+IREF_SENSORS=[(2, 5), (18, 21)]
+# Weight of a new reading in the moving average of the references
+REFERENCE_SMOOTHING=0.1
+# The moving average starts from the median of this many first readings
+#   so a bad first frame (e.g. a sensor read in the VREF slot) does not bias it for the next 50
+REFERENCE_SEED_FRAMES=5
+# In ADC codes, the tables are rebuilt when a smoothed reference moves further than this
+#   from the one they were built with
+REBUILD_TOLERANCE=0.5
+
+# References of a board and the lookup tables built from them
+#   Never modified, a new one replaces it, so a thread holding one always sees a consistent set
+class Calibration ():
+    def __init__ (self, vref, iref, vplot_table, resistance_table, parameters, version):
+        self.vref = vref
+        self.iref = iref
+        self.vplot_table = vplot_table
+        self.resistance_table = resistance_table
+        self.parameters = parameters
+        self.version = version
+
+# Follows the references read in the frames of one board
+#   update() is called by the thread receiving the frames, any other thread reads calibration
+class Calibrator ():
+    def __init__ (self, engine, r_of_iref, smoothing=REFERENCE_SMOOTHING, tolerance=REBUILD_TOLERANCE, seed_frames=REFERENCE_SEED_FRAMES):
+        self.engine = engine
+        self.r_of_iref = r_of_iref
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.seed_frames = seed_frames
+        self.lock = threading.Lock()
+        # [VREF_A, VREF_B, IREF output A, IREF output B], in ADC codes
+        self.smoothed = None
+        # First readings, until there are seed_frames of them smoothed is their median
+        self.seed = []
+        self.built_with = None
+        self.rebuilds = 0
+        # Until the first frame VREF and IREF are 0, and so are the resistances calculated with them
+        self.calibration = self._build(numpy.zeros(2), numpy.zeros(2))
+
+    def _build (self, vref, iref):
+        vplot_table, resistance_table = self.engine.build_tables(vref, iref)
+        self.rebuilds += 1
+        return Calibration(vref, iref, vplot_table, resistance_table, self.engine.parameters(), self.rebuilds)
+
+    # Adds the references of frames (VREFs included) and returns the calibration to use from now on
+    #   samples: (n_sensors,) or (n_frames, n_sensors), a batch is smoothed as if its frames were added one by one
+    def update (self, samples):
+        samples = numpy.atleast_2d(samples)
+        readings = numpy.empty((len(samples), 4))
+        readings[:, :2] = samples[:, :2]
+        for reading, (a, b) in enumerate(IREF_SENSORS, 2):
+            numpy.add(samples[:, a], samples[:, b], out=readings[:, reading], dtype=numpy.float64)
+        # The mean is truncated to a code, as the IREF output always was
+        readings[:, 2:] //= 2
+        with self.lock:
+            if len(self.seed) < self.seed_frames:
+                seed = readings[:self.seed_frames - len(self.seed)]
+                self.seed.extend(seed)
+                readings = readings[len(seed):]
+                self.smoothed = numpy.median(self.seed, axis=0)
+            # Weight of each reading once the ones after it are added
+            weights = self.smoothing*(1 - self.smoothing)**numpy.arange(len(readings) - 1, -1, -1)
+            self.smoothed *= (1 - self.smoothing)**len(readings)
+            self.smoothed += weights @ readings
+            if self.built_with is not None and numpy.abs(self.smoothed - self.built_with).max() <= self.tolerance and self.calibration.parameters == self.engine.parameters():
+                return self.calibration
+            self.built_with = self.smoothed.copy()
+            engine = self.engine
+            vref = codes_to_voltage(self.smoothed[:2], engine.aref_voltage, engine.adc_resoltuion)
+            iref_output = voltage_to_vplot(codes_to_voltage(self.smoothed[2:], engine.aref_voltage, engine.adc_resoltuion), engine.r1, engine.r2, engine.v_a)
+            self.calibration = self._build(vref, (iref_output - vref)/self.r_of_iref)
+            return self.calibration
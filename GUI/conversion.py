@@ -0,0 +1,76 @@
+import numpy
+from serial_parser import ADC_MAX_CODE
+
+# Static model used when resistances are not calculated from VREF/IREF (in kOhms)
+STATIC_GAIN=1.81
+STATIC_OFFSET=-177
+# Resistors and voltage of the input stage between the sensors and the ADC
+R1=1
+R2=4.4
+V_A=1
+# In volts of vplot, samples above them are shown as near saturation and saturated
+CAUTION_VOLTAGE=1.5
+SATURATION_VOLTAGE=1.7
+# Number of VREF channels that come before the matrix sensors in every frame
+N_VREFS=2
+# First 16 matrix sensors belong to matrix A, the others to matrix B
+MATRIX_A_SENSORS=16
+# Every code the ADC can output, the size of the lookup tables
+N_CODES=ADC_MAX_CODE+1
+
+def codes_to_voltage(codes, aref_voltage, adc_resoltuion):
+    return (aref_voltage*numpy.asarray(codes, dtype=numpy.float64))/adc_resoltuion
+
+def voltage_to_vplot(vread, r1, r2, v_a):
+    return (vread + (r2/r1) * v_a) * (r1/(r1+r2))
+
+# Converts whole frames (or batches of frames) of ADC codes at once, through lookup tables
+#   frames: (n_frames, N_VREFS + n_sensors) or a single frame
+#   Returns vplot and resistance (kOhms) arrays shaped (n_frames, n_sensors)
+class ConversionEngine ():
+    def __init__ (self, aref_voltage, adc_resoltuion, r1, r2, v_a, calculate_values):
+        self.aref_voltage = aref_voltage
+        self.adc_resoltuion = adc_resoltuion
+        self.r1 = r1
+        self.r2 = r2
+        self.v_a = v_a
+        self.calculate_values = calculate_values
+        self.matrix_of_sensor = None
+        self.table_offsets = None
+
+    def _matrix_indexes (self, n_sensors):
+        if self.matrix_of_sensor is None or self.matrix_of_sensor.size != n_sensors:
+            self.matrix_of_sensor = (numpy.arange(n_sensors) >= MATRIX_A_SENSORS).astype(numpy.intp)
+        return self.matrix_of_sensor
+
+    # Anything that changes the lookup tables besides VREF/IREF
+    def parameters (self):
+        return (self.aref_voltage, self.adc_resoltuion, self.r1, self.r2, self.v_a, self.calculate_values)
+
+    # Lookup tables from ADC code to vplot (N_CODES,) and to resistance, one row per matrix (2, N_CODES)
+    #   vref, iref: (2,) ordered as [matrix A, matrix B]
+    def build_tables (self, vref, iref):
+        codes = numpy.arange(N_CODES)
+        vplot_table = voltage_to_vplot(codes_to_voltage(codes, self.aref_voltage, self.adc_resoltuion), self.r1, self.r2, self.v_a)
+        if self.calculate_values:
+            table_vref = numpy.asarray(vref, dtype=numpy.float64)[:, numpy.newaxis]
+            table_iref = numpy.broadcast_to(numpy.asarray(iref, dtype=numpy.float64)[:, numpy.newaxis], (2, N_CODES))
+            # Resistance is 0 while IREF is still unknown
+            resistance_table = numpy.zeros((2, N_CODES))
+            numpy.divide(vplot_table-table_vref, table_iref, out=resistance_table, where=table_iref != 0)
+            resistance_table /= 1E3
+        else:
+            resistance_table = numpy.tile(STATIC_GAIN*codes + STATIC_OFFSET, (2, 1)).astype(numpy.float64)
+        return vplot_table, resistance_table
+
+    # A single table lookup per sample, tables come from build_tables
+    #   Codes must not be above ADC_MAX_CODE, the parsers reject frames that have them
+    #   Any that get through are clipped, so they do not index past the end of their table
+    def convert_with_tables (self, frames, vplot_table, resistance_table):
+        codes = numpy.atleast_2d(frames)[:, N_VREFS:]
+        if codes.size and (codes.min() < 0 or codes.max() > ADC_MAX_CODE):
+            codes = numpy.clip(codes, 0, ADC_MAX_CODE)
+        # Offset of the row of the matrix of each sensor in the flattened resistance table
+        if self.table_offsets is None or self.table_offsets.size != codes.shape[1]:
+            self.table_offsets = self._matrix_indexes(codes.shape[1])*N_CODES
+        return numpy.take(vplot_table, codes), numpy.take(resistance_table.ravel(), codes + self.table_offsets)
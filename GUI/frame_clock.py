@@ -0,0 +1,102 @@
+import collections
+import numpy
+
+# Period of the firmware (Timer2 ISR of main.cpp), in seconds
+#   Only used until the period is measured from the frames that arrive
+NOMINAL_PERIOD=9.52
+# Percentage of the period a frame may arrive after it was due before it is late
+DEFAULT_TIME_TOLERANCE=10
+# The period is the median of the last PERIOD_WINDOW measurements, once there are PERIOD_MIN_SAMPLES of them
+PERIOD_WINDOW=32
+PERIOD_MIN_SAMPLES=4
+# Fraction of its lateness the clock moves towards a frame that arrived after its predicted time
+#   Frames arriving before it move the clock back to them right away
+LOCK_GAIN=0.05
+
+# Recovers the sample clock of a board from the times its frames arrive at the host
+#   Frames read at once arrive at the same time, each read is a group of consecutive frames
+#   The period is measured on each group (time since the previous group / frames in it), so missing frames
+#   and reads that take several frames at once are outliers the median ignores
+#   A group arriving more than half a period after the frames it holds were due is preceded by missing frames
+#   Sample times advance one period per frame and follow the earliest arrivals: a frame is never stamped
+#   after it arrived, and the delay of the host only slowly drags the clock
+class FrameClock ():
+    def __init__ (self, nominal_period=NOMINAL_PERIOD, time_tolerance=DEFAULT_TIME_TOLERANCE):
+        self.period = nominal_period
+        self.tolerance = time_tolerance/100
+        self.periods = collections.deque(maxlen=PERIOD_WINDOW)
+        # Index and sample time of the last frame
+        self.index = -1
+        self.sample_time = None
+        # Arrival time and size of the last group, arrival time of the one before it
+        self.last_arrival = None
+        self.group_frames = 0
+        self.previous_arrival = None
+        self.missed = 0
+
+    # Seconds after the previous frame when the next one is late
+    @property
+    def late_limit (self):
+        return self.period*(1 + self.tolerance)
+
+    # arrivals: (n_frames,) arrival times of consecutive frames
+    #   Returns the index of every frame since the first one, its sample time and the frames missing right before it
+    def stamp (self, arrivals):
+        arrivals = numpy.asarray(arrivals, dtype=numpy.float64)
+        indices = numpy.empty(len(arrivals), dtype=numpy.int64)
+        times = numpy.empty(len(arrivals))
+        missed = numpy.zeros(len(arrivals), dtype=numpy.int64)
+        starts = numpy.flatnonzero(numpy.diff(arrivals, prepend=numpy.nan) != 0)
+        for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(arrivals)]):
+            indices[start:end], times[start:end], missed[start] = self._stamp_group(float(arrivals[start]), end - start)
+        return indices, times, missed
+
+    def _stamp_group (self, arrival, n_frames):
+        if arrival == self.last_arrival:
+            # Rest of the last group, read separately
+            self.group_frames += n_frames
+            missing = 0
+        else:
+            if self.previous_arrival is not None:
+                self.periods.append((self.last_arrival - self.previous_arrival)/self.group_frames)
+                if len(self.periods) >= PERIOD_MIN_SAMPLES:
+                    self.period = float(numpy.median(self.periods))
+            missing = 0
+            if self.last_arrival is not None:
+                missing = max(int(round((arrival - self.last_arrival)/self.period)) - n_frames, 0)
+            self.previous_arrival = self.last_arrival
+            self.last_arrival = arrival
+            self.group_frames = n_frames
+        self.missed += missing
+        indices = self.index + missing + 1 + numpy.arange(n_frames)
+        if self.sample_time is None:
+            times = arrival - (n_frames - 1 - numpy.arange(n_frames))*self.period
+        else:
+            times = numpy.minimum(self.sample_time + (indices - self.index)*self.period, arrival)
+        self.index = int(indices[-1])
+        # The last frame of the group was sampled before it arrived
+        self.sample_time = float(times[-1]) + LOCK_GAIN*max(arrival - times[-1], 0)
+        return indices, times, missing
+
+    # Frames read at once, with their index as seq, their sample time as timestamp and the frames missing before each
+    #   The timestamp they come with is taken as their arrival time
+    def stamp_frames (self, frames):
+        if not frames:
+            return frames
+        indices, times, missed = self.stamp([frame.timestamp for frame in frames])
+        return [frame._replace(seq=index, timestamp=sample_time, missed=missing) for frame, index, sample_time, missing in zip(frames, indices.tolist(), times.tolist(), missed.tolist())]
+
+    # Frames that should have arrived by now
+    def overdue (self, now):
+        if self.last_arrival is None:
+            return 0
+        return max(int((now - self.last_arrival - self.tolerance*self.period)/self.period), 0)
+
+    # Seconds until the next frame is late, then until each following one is
+    def timeout (self, now):
+        if self.last_arrival is None:
+            return self.late_limit
+        late = now - self.last_arrival - self.late_limit
+        if late < 0:
+            return -late
+        return self.period - late % self.period
@@ -0,0 +1,77 @@
+import collections
+import threading
+import numpy
+from metrics import registry
+
+# Frames in flight between the readers and the data handler
+#   Enough for a full data queue plus what the merger holds, a batch being converted and the frames being read
+FRAME_POOL_BUFFERS=4096
+
+# Preallocated sample buffers of n_sensors values, one per frame in flight
+#   Used for the binary frames integ.py copies out of its receive buffer, which would otherwise get an
+#   array each. ASCII and line reads are not pooled, their parser makes an array per frame anyway
+#   A frame has a single owner at a time, the reader that fills its buffer hands it over with the frame
+#   and whoever ends up with it releases it: the data handler once it gathered the samples, or whoever
+#   drops the frame
+#   When every buffer is in use the frame gets a buffer of its own (slot None), counted as pool.exhausted
+class FramePool ():
+    def __init__ (self, n_buffers, n_sensors, dtype=numpy.uint16):
+        self.n_sensors = n_sensors
+        self.buffers = numpy.zeros((n_buffers, n_sensors), dtype=dtype)
+        # Row views are made once, taking one is not an allocation
+        self.views = list(self.buffers)
+        self.in_use = [False]*n_buffers
+        # Last released first, its buffer is still in the cache
+        self.free = collections.deque(range(n_buffers))
+        self.lock = threading.Lock()
+        # (n_frames, n_sensors) array samples are gathered into, see gather()
+        self.gathered = numpy.zeros((0, n_sensors), dtype=dtype)
+
+    # Buffers in use, so the pool shows in the metrics like a queue
+    def qsize (self):
+        return len(self.in_use) - len(self.free)
+
+    # Returns a free slot, None if there is none
+    def acquire (self):
+        with self.lock:
+            if not self.free:
+                slot = None
+            else:
+                slot = self.free.pop()
+                self.in_use[slot] = True
+        if slot is None:
+            registry.count("pool.exhausted")
+        return slot
+
+    # Gives the buffers back to the pool
+    #   Slots of frames that did not get a pooled buffer are None and ignored
+    def release (self, *slots):
+        with self.lock:
+            for slot in slots:
+                if slot is None:
+                    continue
+                if not self.in_use[slot]:
+                    raise ValueError(f"Buffer {slot} released twice")
+                self.in_use[slot] = False
+                self.free.append(slot)
+
+    # Copies samples into a pooled buffer, returns its slot and the buffer
+    #   The slot is None and the buffer a copy of its own if the pool is exhausted or samples do not fit
+    def copy_in (self, samples):
+        slot = self.acquire() if len(samples) == self.n_sensors else None
+        if slot is None:
+            return None, numpy.array(samples, dtype=self.buffers.dtype)
+        buffer = self.views[slot]
+        buffer[:] = samples
+        return slot, buffer
+
+    # Copies the samples of frames into a single (n_frames, n_sensors) array and releases their buffers
+    #   The array is reused by the next call, only one thread may gather and it must be done with it by then
+    def gather (self, frames):
+        if len(frames) > len(self.gathered):
+            self.gathered = numpy.zeros((len(frames), self.n_sensors), dtype=self.buffers.dtype)
+        gathered = self.gathered[:len(frames)]
+        for index, frame in enumerate(frames):
+            gathered[index] = frame.samples
+        self.release(*[frame.slot for frame in frames])
+        return gathered
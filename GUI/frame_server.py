@@ -0,0 +1,167 @@
+import asyncio
+import collections
+import socket
+import threading
+from logger import Logger
+from metrics import registry
+
+# Local servers that send every published frame to any number of subscribers
+#   Each subscriber has its own bounded buffer of encoded frames: when it can not keep up, its
+#   oldest frames are dropped, so a slow subscriber never delays acquisition or the other subscribers
+#   Frames are dropped whole, subscribers can spot the gaps in the sequence numbers of the binary protocol
+SUBSCRIBER_BUFFER_FRAMES=256
+# In seconds, how often the accept loop checks if the server was closed
+ACCEPT_TIMEOUT=0.5
+
+class SubscriberBuffer ():
+    def __init__ (self, name, capacity, connection=None):
+        self.name = name
+        self.frames = collections.deque(maxlen=capacity)
+        self.connection = connection
+        self.sent = 0
+        self.dropped = 0
+
+    def push (self, data):
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+            registry.count("dropped.subscriber")
+        self.frames.append(data)
+
+    def take (self):
+        pending = b"".join(self.frames)
+        n_frames = len(self.frames)
+        self.frames.clear()
+        return pending, n_frames
+
+# Thread based server, one sender thread per subscriber
+class FrameServer ():
+    def __init__ (self, port, buffer_frames=SUBSCRIBER_BUFFER_FRAMES, verbose=False, host='localhost'):
+        self.buffer_frames = buffer_frames
+        self.logger = Logger("FRAME-SERVER")
+        if verbose:
+            self.logger.set_debug()
+        else:
+            self.logger.set_warning()
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.server.settimeout(ACCEPT_TIMEOUT)
+        self.subscribers = []
+        self.condition = threading.Condition()
+        self.running = True
+        self.accept_thread = threading.Thread(target=self._accept, name="accept_thread", daemon=True)
+        self.accept_thread.start()
+
+    # Never blocks, frames are only queued for the sender threads
+    def publish (self, data):
+        with self.condition:
+            for subscriber in self.subscribers:
+                subscriber.push(data)
+            self.condition.notify_all()
+
+    def _accept (self):
+        while self.running:
+            try:
+                connection, addr = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            connection.settimeout(None)
+            subscriber = SubscriberBuffer(f"{addr[0]}:{addr[1]}", self.buffer_frames, connection)
+            with self.condition:
+                self.subscribers.append(subscriber)
+            self.logger.info("Subscriber %s connected", subscriber.name)
+            threading.Thread(target=self._send, name=f"sender_thread_{subscriber.name}", args=(subscriber,), daemon=True).start()
+
+    def _send (self, subscriber):
+        while True:
+            with self.condition:
+                while self.running and not subscriber.frames:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                pending, n_frames = subscriber.take()
+            try:
+                subscriber.connection.sendall(pending)
+                subscriber.sent += n_frames
+            except OSError:
+                break
+        with self.condition:
+            self.subscribers.remove(subscriber)
+        subscriber.connection.close()
+        self.logger.info("Subscriber %s left, %d frames sent, %d dropped", subscriber.name, subscriber.sent, subscriber.dropped)
+
+    def close (self):
+        with self.condition:
+            self.running = False
+            for subscriber in self.subscribers:
+                # Unblocks senders stuck on a subscriber that stopped reading
+                try:
+                    subscriber.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.condition.notify_all()
+        self.server.close()
+
+# asyncio version of FrameServer, one task per subscriber
+class AsyncFrameServer ():
+    def __init__ (self, port, buffer_frames=SUBSCRIBER_BUFFER_FRAMES, verbose=False, host='localhost'):
+        self.port = port
+        self.host = host
+        self.buffer_frames = buffer_frames
+        self.logger = Logger("FRAME-SERVER")
+        if verbose:
+            self.logger.set_debug()
+        else:
+            self.logger.set_warning()
+        self.server = None
+        self.subscribers = []
+        # Event that wakes up the task of each subscriber, and the task itself
+        self.wakeups = {}
+        self.tasks = set()
+
+    async def start (self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    def publish (self, data):
+        for subscriber in self.subscribers:
+            subscriber.push(data)
+            self.wakeups[subscriber].set()
+
+    async def _serve (self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        subscriber = SubscriberBuffer(f"{addr[0]}:{addr[1]}", self.buffer_frames)
+        wakeup = asyncio.Event()
+        task = asyncio.current_task()
+        self.wakeups[subscriber] = wakeup
+        self.tasks.add(task)
+        self.subscribers.append(subscriber)
+        self.logger.info("Subscriber %s connected", subscriber.name)
+        try:
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                pending, n_frames = subscriber.take()
+                writer.write(pending)
+                await writer.drain()
+                subscriber.sent += n_frames
+        except OSError:
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by close(), asyncio logs a traceback for client tasks that end cancelled
+            pass
+        finally:
+            self.subscribers.remove(subscriber)
+            del self.wakeups[subscriber]
+            self.tasks.discard(task)
+            writer.close()
+            self.logger.info("Subscriber %s left, %d frames sent, %d dropped", subscriber.name, subscriber.sent, subscriber.dropped)
+
+    async def close (self):
+        self.server.close()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.server.wait_closed()
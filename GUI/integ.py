@@ -4,120 +4,163 @@ import os
 import socket
 import queue
 import threading
-from matplotlib.artist import Artist
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import csv
 import time
 import datetime
 import argparse
 import signal
+import asyncio
 import numpy
 from itertools import count
 inter_path=os.path.dirname(os.path.realpath(__file__))
 sys.path.append(inter_path)
 from logger import Logger
+import protocol
+from conversion import ConversionEngine, R1, R2, V_A, CAUTION_VOLTAGE, SATURATION_VOLTAGE
+from calibration import Calibrator
+from frame_clock import FrameClock, NOMINAL_PERIOD
+from frame_pool import FramePool, FRAME_POOL_BUFFERS
+from rolling_stats import RollingStats
+import log_writer
+from recording import RecordingWriter
+from plot_history import RingBuffer, minmax_decimate
+import async_pipeline
+from board_merger import FrameMerger
+import topology
+import metrics
+from metrics import registry, STAGE_SERIAL, STAGE_ENQUEUE, STAGE_DECODE, STAGE_CONVERT, STAGE_RENDER, STAGE_TOTAL
 
 parser = argparse.ArgumentParser(description='Interprets and plots results given by the Arduino.')
 #parser.add_argument('--nsensors', help='Number of sensors that will be monitored', type=int, required=True)
-parser.add_argument('--port', help='Serial port name to connect', type=str, required=True)
+parser.add_argument('--port', help='Serial port name to connect, one per board', type=str, nargs='+')
 parser.add_argument('--aref', help='Voltage reference of the Arduino board', type=float, default=5)
 parser.add_argument('--adc_resolution', help='Number of bits of resolution of the ADC', type=int, default=10)
 parser.add_argument('--max-deviation', help='Max modular difference between a group of resistances (in kOhms)', type=int, default=10)
-parser.add_argument('--time-tolerance', help='Percentage of tolerance calculated over the sampling period', type=int, default=10)
+parser.add_argument('--sampling-period', help='Expected seconds between frames, only used until the period is measured from the frames (defaults to the period of the virtual sensor or of the firmware)', type=float, default=None)
+parser.add_argument('--time-tolerance', help='Percentage of the sampling period a frame may arrive after it was due before it is late', type=int, default=10)
 parser.add_argument('--verbose', help='Outputs all messages', action='store_true')
 parser.add_argument('--virtual', help='Create virtual serial connection', action='store_true')
+parser.add_argument('--virtual-period', help='Seconds between frames sent by the virtual sensor (0 sends as fast as possible)', type=float, default=9.52)
+parser.add_argument('--virtual-boards', help='Number of virtual boards', type=int, default=1)
+parser.add_argument('--virtual-noise', help='Noise of the virtual sensor readings (in ADC codes)', type=float, default=1.0)
+parser.add_argument('--protocol', help='Wire format used between the serial monitor and this script', choices=protocol.PROTOCOLS, default=protocol.PROTOCOL_ASCII)
+parser.add_argument('--asyncio', help='Runs acquisition and processing on an asyncio event loop instead of one thread per stage', action='store_true')
+parser.add_argument('--in-process', help='Reads the serial port in this process instead of starting osc.py and receiving its frames through a socket', action='store_true')
+parser.add_argument('--log-flush-rows', help='Rows buffered before the CSV log is written to disk', type=int, default=log_writer.LOG_FLUSH_ROWS)
+parser.add_argument('--log-flush-interval', help='Max seconds a row waits before the CSV log is written to disk', type=float, default=log_writer.LOG_FLUSH_INTERVAL)
+parser.add_argument('--log-time-format', help='Format of the time column of the CSV log', choices=log_writer.TIME_FORMATS, default=log_writer.TIME_FORMAT_DATETIME)
+parser.add_argument('--log-rotate-size', help='Size (in MB) at which the CSV log continues in a new compressed segment, 0 (default) keeps a single file', type=float, default=log_writer.LOG_ROTATE_SIZE)
+parser.add_argument('--log-rotate-interval', help='Hours of data after which the CSV log continues in a new compressed segment, 0 (default) keeps a single file', type=float, default=log_writer.LOG_ROTATE_INTERVAL)
+parser.add_argument('--log-compression', help='Codec finished segments of the CSV log are compressed with, when it is rotated', choices=list(log_writer.COMPRESSIONS), default=log_writer.LOG_COMPRESSION)
+parser.add_argument('--record', help='Also records raw frames to a memory-mappable binary file in the logs folder', action='store_true')
+parser.add_argument('--merge-window', help='Max seconds a frame waits for the other boards before it is processed (defaults to the measured sampling period plus tolerance)', type=float, default=None)
+parser.add_argument('--plot-board', help='Board shown in the GUI', type=int, default=0)
+parser.add_argument('--plot-history', help='Number of points kept in each plot (older points are discarded)', type=int, default=100000)
+parser.add_argument('--topology', help='JSON description of the groups and positions of the resistors of the chip', type=str, default=topology.DEFAULT_TOPOLOGY)
 parser.add_argument('--calculate-values', help='Makes the calculations to find sensor resistance instead of using static formula', action='store_true')
-#parser.add_argument('--no-gui', help="Do not show GUI", action='store_true')
+parser.add_argument('--metrics-interval', help='Seconds between snapshots of latencies, queue depths and drops written to the logs folder (0 disables them)', type=float, default=metrics.METRICS_INTERVAL)
+parser.add_argument('--no-gui', help="Do not show GUI, only acquires, converts and logs data", action='store_true')
 args = parser.parse_args()
+if not args.port and not args.virtual:
+    parser.error("--port is required unless --virtual is used")
 
 # Will not complain of high deviance unless resistance difference of a group is less than 10kOhms
 ACCEPTABLE_DEVIANCE=args.max_deviation
 
-TIME_TOLERANCE=args.time_tolerance/100
-
-R1=1
-R2=4.4
-V_A=1
-ACTUAL_SAMPLING_PERIOD=9.52
-DELTA=TIME_TOLERANCE*ACTUAL_SAMPLING_PERIOD
-CORRECTED_SAMPLING_PERIOD=ACTUAL_SAMPLING_PERIOD+DELTA
-CAUTION_VOLTAGE=1.5
-SATURATION_VOLTAGE=1.7
+# In seconds, the frame clocks measure the actual period from there
+SAMPLING_PERIOD=args.sampling_period
+if SAMPLING_PERIOD is None:
+    SAMPLING_PERIOD=args.virtual_period if args.virtual and args.virtual_period > 0 else NOMINAL_PERIOD
 # 32 sensors in chip matrix + VREF_A + VREF_B
 MAX_SENSORS=34
-N_ROWS=2
-N_COLS=3
-SENSORS_PER_WINDOW=5
+# Groups and positions of the resistors of the chip
+TOPOLOGY=topology.load_topology(args.topology)
 R_OF_IREF=200E3
-
-
-def int_to_voltage(int_value, aref_voltage, adc_resoltuion):
-    return float((aref_voltage*int_value)/adc_resoltuion)
-
-def retrieve_measurement_data(data_queue, aref_voltage, adc_resoltuion, stop, data_socket, vref, iref):
+X_LIMIT_GROWTH=0.25
+X_LIMIT_MIN_STEP=10
+# Plots are redrawn once per frame, their timer is reset when the period moves further than this fraction
+PLOT_INTERVAL_TOLERANCE=0.1
+TEXT_BOX=dict(facecolor='white', alpha=0.7, edgecolor='none')
+RECV_BUFFER_SIZE=4096
+# Max frames taken from the data queue and converted in a single call
+MAX_BATCH_FRAMES=256
+# In seconds, how often the in-process serial reader checks if it must stop
+SERIAL_READ_TIMEOUT=0.5
+SERIAL_BAUD_RATE=115200
+# The serial monitor of board i serves its frames on SERVER_PORT+i
+SERVER_PORT=25565
+# In seconds
+CONNECT_TIMEOUT=5
+CONNECT_RETRY_INTERVAL=0.1
+
+
+# Hands the references of frames read at once to the calibrator of their board and reports when they change
+#   samples: (n_frames, n_sensors), or the samples of each frame
+#   last_codes keeps the VREF codes of the previous frame
+def update_references(samples, calibrator, last_codes):
+    samples = numpy.asarray(samples)
+    if not len(samples):
+        return
+    codes = samples[:, :2].astype(numpy.int64)
+    old_codes = numpy.vstack((last_codes, codes[:-1]))
+    changed = codes != old_codes
+    # [VREF_A, VREF_B] of the frames that give the first VREF, or one that moved
+    first = (changed & (old_codes == 0)).any(axis=0).tolist()
+    fluctuation = (changed & (old_codes != 0)).any()
+    last_codes[:] = codes[-1].tolist()
+    calibration = calibrator.update(samples)
+    calculated_vref_A, calculated_vref_B = calibration.vref.tolist()
+    iref_A, iref_B = calibration.iref.tolist()
+
+    if first[0]:
+        print(f"[VREF] INFO: VREF_A = {calculated_vref_A:.3f} V")
+        print(f"             IREF_A = {iref_A*1E9:.0f} nA")
+    if fluctuation:
+        print(f"[VREF] WARNING: Fluctuation in VREF.")
+        print(f"                Current VREF_A = {calculated_vref_A:.3f} V")
+        print(f"                Current IREF_A = {iref_A*1E9:.0f} nA")
+        print(f"                Current VREF_B = {calculated_vref_B:.3f} V")
+        print(f"                Current IREF_B = {iref_B*1E9:.0f} nA")
+    if first[1]:
+        print(f"[VREF] INFO: VREF_B = {calculated_vref_B:.3f} V")
+        print(f"             IREF_B = {iref_B*1E9:.0f} nA")
+
+# clock gives every frame of the board its sample time and finds the frames that never arrived
+#   Binary frames are decoded into buffers of pool, the data handler gives them back
+def retrieve_measurement_data(data_queue, stop, data_socket, calibrator, clock, pool, wire_protocol, board=0):
     retriever_logger=Logger("SOCKET-RECV")
     if args.verbose:
         retriever_logger.set_debug()
     else:
         retriever_logger.set_warning()
-    vref_A_new=0
-    vref_A_old=0
-    vref_B_new=0
-    vref_B_old=0
+    last_codes=[0, 0]
+    # Frames may be split across or merged in a single recv, the decoder keeps partial data between calls
+    decoder = protocol.make_decoder(wire_protocol, board, pool)
+    missed_frames = 0
     while not stop[0]:
-        # Data comes in this format: <|ABCD||ABCD||...|>
-        # NUMBER 4 here should be replaced by a variable
         try:
-            my_data = data_socket.recv(2+MAX_SENSORS*(2+4))
-            decoded_data = my_data.decode("utf-8")
-            data_string = decoded_data.replace("<|", "")
-            data_string = data_string.replace("|>", "")
-            serialized_data_list = data_string.split("||")
-            vref_A_old=vref_A_new
-            vref_A_new=int(serialized_data_list[0])
-            vref_B_old=vref_B_new
-            vref_B_new=int(serialized_data_list[1])
-            # Calculate IREF
-            vout_ref_A_1=int(serialized_data_list[2])
-            vout_ref_A_2=int(serialized_data_list[5])
-            vout_ref_A_med=int_to_voltage(int((vout_ref_A_1+vout_ref_A_2)/2), aref_voltage, adc_resoltuion)
-            vout_ref_A_med=(vout_ref_A_med + (V_A*R2)/R1)*(R1/(R1+R2))
-            calculated_vref_A=int_to_voltage(vref_A_new, aref_voltage, adc_resoltuion)
-            iref_A=(vout_ref_A_med - calculated_vref_A)/R_OF_IREF
-
-            vout_ref_B_1=int(serialized_data_list[18])
-            vout_ref_B_2=int(serialized_data_list[21])
-            vout_ref_B_med=int_to_voltage(int((vout_ref_B_1+vout_ref_B_2)/2), aref_voltage, adc_resoltuion)
-            vout_ref_B_med=(vout_ref_B_med + (V_A*R2)/R1)*(R1/(R1+R2))
-            calculated_vref_B=int_to_voltage(vref_B_new, aref_voltage, adc_resoltuion)
-            iref_B=(vout_ref_B_med - calculated_vref_B)/R_OF_IREF
-
-            # Output parameters
-            vref[0]=calculated_vref_A
-            vref[1]=calculated_vref_B
-            iref[0]=iref_A
-            iref[1]=iref_B
-
-            if vref_A_old == 0 and vref_A_old != vref_A_new:
-                print(f"[VREF] INFO: VREF_A = {calculated_vref_A:.3f} V")
-                print(f"             IREF_A = {iref_A*1E9:.0f} nA")
-            if (vref_A_old != 0 and vref_A_old != vref_A_new) or (vref_B_old != 0 and vref_B_old != vref_B_new):
-                print(f"[VREF] WARNING: Fluctuation in VREF.")
-                print(f"                Current VREF_A = {calculated_vref_A:.3f} V")
-                print(f"                Current IREF_A = {iref_A*1E9:.0f} nA")
-                print(f"                Current VREF_B = {calculated_vref_B:.3f} V")
-                print(f"                Current IREF_B = {iref_B*1E9:.0f} nA")
-            if vref_B_old == 0 and vref_B_old != vref_B_new:
-                print(f"[VREF] INFO: VREF_B = {calculated_vref_B:.3f} V")
-                print(f"             IREF_B = {iref_B*1E9:.0f} nA")
-            try:
-                data_list = [int (x) for x in serialized_data_list]
-                data_queue.put(data_list, block=False)
-            except queue.Full:
-                retriever_logger.warning("Data queue is full, dumping new measurements")
-            except ValueError:
-                pass
+            my_data = data_socket.recv(RECV_BUFFER_SIZE)
+            if not my_data:
+                retriever_logger.warning("Server has closed the connection")
+                break
+            frames = decoder.feed(my_data)
+            if getattr(decoder, "missed_frames", 0) > missed_frames:
+                retriever_logger.warning("Board %d: serial monitor dropped %d frames", board, decoder.missed_frames-missed_frames, key=board)
+                missed_frames = decoder.missed_frames
+            for frame in frames:
+                registry.stamp(frame.stamps, STAGE_DECODE)
+                if frame.samples.size != MAX_SENSORS:
+                    retriever_logger.warning("Frame %d has %d sensors, expected %d", frame.seq, frame.samples.size, MAX_SENSORS)
+                    registry.count("dropped.wrong_size")
+                    pool.release(frame.slot)
+            frames = clock.stamp_frames([frame for frame in frames if frame.samples.size == MAX_SENSORS])
+            update_references([frame.samples for frame in frames], calibrator, last_codes)
+            for frame in frames:
+                try:
+                    data_queue.put(frame, block=False)
+                except queue.Full:
+                    retriever_logger.warning("Data queue is full, dumping new measurements")
+                    registry.count("dropped.data_queue")
+                    pool.release(frame.slot)
         except ConnectionResetError:
             pass
         except ConnectionAbortedError:
@@ -127,406 +170,407 @@ def retrieve_measurement_data(data_queue, aref_voltage, adc_resoltuion, stop, da
             exit(1)
     retriever_logger.debug("Bye")
 
-def build_matrix_figure (list_of_titles):
-    fig, axes = plt.subplots(nrows=N_ROWS, ncols=N_COLS)
-    axes[0][0].set_ylabel("Resistance of sensors (kOhms)")
-    axes[1][0].set_ylabel("Resistance of sensors (kOhms)")
-    axes[0][0].set_title(list_of_titles[0])
-    axes[0][1].set_title(list_of_titles[1])
-    axes[1][0].set_title(list_of_titles[2])
-    axes[1][1].set_title(list_of_titles[3])
-    axes[1][2].set_title(list_of_titles[4])
-    lines=[]
-    for row in range(N_ROWS):
-        for column in range(N_COLS):
-            if row == 0 and column == 2:
-                continue
-            lines.append(axes[row][column].plot([],[])[0])
-            axes[row][column].grid(which='major', alpha=0.5)
-            axes[row][column].grid(which='minor', alpha=0.2)
-            axes[row][column].set_ylim(-0.1, 200)
-    return fig, axes, lines
-
-def check_deviation(indexes, values, average, acceptable_dev, logger):
-    for i, v in zip(indexes, values):
-        dev = v-average
-        dev_abs = numpy.abs(dev)
-        if dev_abs > acceptable_dev:
-            # i+2 is to be coherent with resistance layout naming
-            logger.warning(f"Sensor {i+2} has high deviation.\n\tGroup mean:    {average:.1f} kOhms\n\tCurrent value: {v:.1f} kOhms\n\tDeviation:     {dev:.1f} kOhms\n")
-
-def get_max_voltage(voltages, indexes):
-    index = indexes[0]
-    max_voltage = voltages[0]
-    for i, voltage in enumerate(voltages):
-        new_voltage = voltage
-        if new_voltage > max_voltage:
-            index = indexes[i]
-            max_voltage = new_voltage
-    return (index, max_voltage)
-
-def get_voltages_resistances_and_average (matrix_indexes, float_data):
-
-    matrix_voltages = [float_data[i][0] for i in matrix_indexes]
-    matrix_resistances = [float_data[i][1] for i in matrix_indexes]
-    max_voltage_tuple = get_max_voltage(matrix_voltages, matrix_indexes)
-    matrix_average = sum(matrix_resistances)/len(matrix_resistances)
-    return (matrix_resistances, matrix_average, max_voltage_tuple)
-
-
-def process_matrix_A(float_data, data_handling_logger):
-    # R3 is sensor 1, because float data does not have the vrefs
-    matrix_A_indexes1 = [1, 2, 4, 7]
-    matrix_A_set1, matrix_A_average1, max_A_voltage_1_tuple = get_voltages_resistances_and_average(matrix_A_indexes1, float_data)
-    check_deviation(matrix_A_indexes1, matrix_A_set1, matrix_A_average1, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_A_indexes2 = [12, 13, 14, 15]
-    matrix_A_set2, matrix_A_average2, max_A_voltage_2_tuple = get_voltages_resistances_and_average(matrix_A_indexes2, float_data)
-    check_deviation(matrix_A_indexes2, matrix_A_set2, matrix_A_average2, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_A_indexes3 = [5, 6]
-    matrix_A_set3, matrix_A_average3, max_A_voltage_3_tuple = get_voltages_resistances_and_average(matrix_A_indexes3, float_data)
-    check_deviation(matrix_A_indexes3, matrix_A_set3, matrix_A_average3, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_A_indexes4 = [9, 10]
-    matrix_A_set4, matrix_A_average4, max_A_voltage_4_tuple = get_voltages_resistances_and_average(matrix_A_indexes4, float_data)
-    check_deviation(matrix_A_indexes4, matrix_A_set4, matrix_A_average4, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_A_indexes5 = [8, 11]
-    matrix_A_set5, matrix_A_average5, max_A_voltage_5_tuple = get_voltages_resistances_and_average(matrix_A_indexes5, float_data)
-    check_deviation(matrix_A_indexes5, matrix_A_set5, matrix_A_average5, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_A_values = [(matrix_A_average1, max_A_voltage_1_tuple), (matrix_A_average2, max_A_voltage_2_tuple), (matrix_A_average3, max_A_voltage_3_tuple), (matrix_A_average4, max_A_voltage_4_tuple), (matrix_A_average5, max_A_voltage_5_tuple)]
-    return matrix_A_values
-
-def process_matrix_B(float_data, data_handling_logger):
-    # R19 is sensor 17, because float data does not have the vrefs
-    matrix_B_indexes1 = [17, 18, 20, 23]
-    matrix_B_set1, matrix_B_average1, max_B_voltage_1_tuple = get_voltages_resistances_and_average(matrix_B_indexes1, float_data)
-    check_deviation(matrix_B_indexes1, matrix_B_set1, matrix_B_average1, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_B_indexes2 = [28, 29, 30, 31]
-    matrix_B_set2, matrix_B_average2, max_B_voltage_2_tuple = get_voltages_resistances_and_average(matrix_B_indexes2, float_data)
-    check_deviation(matrix_B_indexes2, matrix_B_set2, matrix_B_average2, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_B_indexes3 = [21, 22]
-    matrix_B_set3, matrix_B_average3, max_B_voltage_3_tuple = get_voltages_resistances_and_average(matrix_B_indexes3, float_data)
-    check_deviation(matrix_B_indexes3, matrix_B_set3, matrix_B_average3, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_B_indexes4 = [25, 26]
-    matrix_B_set4, matrix_B_average4, max_B_voltage_4_tuple = get_voltages_resistances_and_average(matrix_B_indexes4, float_data)
-    check_deviation(matrix_B_indexes4, matrix_B_set4, matrix_B_average4, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_B_indexes5 = [24, 27]
-    matrix_B_set5, matrix_B_average5, max_B_voltage_5_tuple = get_voltages_resistances_and_average(matrix_B_indexes5, float_data)
-    check_deviation(matrix_B_indexes5, matrix_B_set5, matrix_B_average5, ACCEPTABLE_DEVIANCE, data_handling_logger)
-
-    matrix_B_values = [(matrix_B_average1, max_B_voltage_1_tuple), (matrix_B_average2, max_B_voltage_2_tuple), (matrix_B_average3, max_B_voltage_3_tuple), (matrix_B_average4, max_B_voltage_4_tuple), (matrix_B_average5, max_B_voltage_5_tuple)]
-    return matrix_B_values
-
-def handle_data(data_queue, aref_voltage, adc_resoltuion, stop_threads, vref, iref, output_data_A, output_data_B, output_text_values):
-    data_handling_logger=Logger("DATA HANDLING")
+# In-process replacement of osc.py and retrieve_measurement_data
+#   Frames go from the serial port to the data queue as rows of the array of their read, without being encoded and sent through a socket
+def read_serial_frames(data_queue, stop, serial_reader, calibrator, clock, board=0):
+    reader_logger=Logger("SERIAL-READ")
     if args.verbose:
-        data_handling_logger.set_debug()
+        reader_logger.set_debug()
     else:
-        data_handling_logger.set_warning()
+        reader_logger.set_warning()
+    last_codes=[0, 0]
+    while not stop[0]:
+        # Returns no frames when the read times out, so stop is checked regularly
+        receive_times, samples = serial_reader.get_serial_frames()
+        if not len(samples):
+            continue
+        update_references(samples, calibrator, last_codes)
+        # Frames are made once they are stamped
+        indices, sample_times, missed = clock.stamp(receive_times)
+        for receive_time, seq, sample_time, missing, frame_samples in zip(receive_times.tolist(), indices.tolist(), sample_times.tolist(), missed.tolist(), samples):
+            frame = protocol.Frame(seq, sample_time, frame_samples, board, {STAGE_SERIAL: receive_time}, missing)
+            # Stamped before the put, the data handler may take it right away
+            registry.stamp(frame.stamps, STAGE_ENQUEUE)
+            try:
+                data_queue.put(frame, block=False)
+            except queue.Full:
+                reader_logger.warning("Data queue is full, dumping new measurements")
+                registry.count("dropped.data_queue")
+    serial_reader.close()
+    reader_logger.debug("Bye")
+
+# matplotlib is only imported when a GUI is requested
+#   One subplot per group of the matrix, in the cell given by the topology
+def build_matrix_figure (matrix):
+    import matplotlib.pyplot as plt
+    n_rows, n_cols = matrix.grid
+    fig, axes = plt.subplots(nrows=n_rows, ncols=n_cols, squeeze=False)
+    fig.suptitle(matrix.title, fontsize=16)
+    for row in range(n_rows):
+        axes[row][0].set_ylabel("Resistance of sensors (kOhms)")
+    lines=[]
+    voltage_texts=[]
+    resistance_texts=[]
+    # Artists are created once and updated in place by the animation
+    #   Texts must be inside the axes to be redrawn by blitting
+    for title, (row, column) in zip(matrix.titles, matrix.cells):
+        axes[row][column].set_title(title)
+        lines.append(axes[row][column].plot([],[])[0])
+        voltage_texts.append(axes[row][column].text(0.35, 0.98, "", color='black', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', bbox=TEXT_BOX, transform=axes[row][column].transAxes))
+        resistance_texts.append(axes[row][column].text(0.98, 0.98, "", fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', bbox=TEXT_BOX, transform=axes[row][column].transAxes))
+        axes[row][column].grid(which='major', alpha=0.5)
+        axes[row][column].grid(which='minor', alpha=0.2)
+        axes[row][column].set_ylim(-0.1, 200)
+    return fig, axes, lines, voltage_texts, resistance_texts
+
+# Changes axis limits only when the data does not fit them anymore, returns True if they changed
+#   The x axis grows in steps, so a full redraw is not needed for every new sample
+def update_axis_limits(ax, x_low, x_high, y_low, y_high):
+    changed = False
+    current_low, current_high = ax.get_xlim()
+    step = max(X_LIMIT_MIN_STEP, X_LIMIT_GROWTH*(x_high-x_low))
+    if x_low < current_low or x_high > current_high or x_low-current_low > step:
+        ax.set_xlim(x_low, x_high+step)
+        changed = True
+    if (y_low, y_high) != tuple(ax.get_ylim()):
+        ax.set_ylim(y_low, y_high)
+        changed = True
+    return changed
+
+def log_deviations(stats, board, logger):
+    for frame_index, member in zip(*numpy.nonzero(stats.deviating)):
+        sensor = TOPOLOGY.members[member]
+        average = stats.mean[frame_index, TOPOLOGY.segments[member]]
+        logger.warning("Board %d: sensor %d has high deviation.\n\tGroup mean:    %.1f kOhms\n\tCurrent value: %.1f kOhms\n\tDeviation:     %.1f kOhms\n", board, sensor + TOPOLOGY.first_resistor, average, average+stats.deviation[frame_index, member], stats.deviation[frame_index, member], key=(board, sensor))
+
+# Opens the CSV log, the log of missing frames, the rolling statistics and, if requested, the binary recording of every board of this session
+def open_logs(n_boards):
     ts = time.time()
     sttime = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d_%H-%M-%S')
-    file_name="log_"+sttime+".csv"
     if not os.path.exists(os.path.join(inter_path, "logs")):
         os.makedirs(os.path.join(inter_path, "logs"))
-    csv_file = open (os.path.join(inter_path, "logs", file_name), "w", newline="")
-    writer=csv.writer(csv_file)
     # VREF_A is taken as sensor0, V_REFB is taken as sensor1
     description_list=["sensor"+str(x) for x in range(MAX_SENSORS)]
     description_list.insert(0, "time")
-    writer.writerow(description_list)
-    csv_file.close()
-    while not stop_threads[0]:
-        try:
-            data_list = data_queue.get(block=True, timeout=CORRECTED_SAMPLING_PERIOD)
-            data_queue.task_done()
-        except queue.Empty:
-            data_handling_logger.warning("Did not recieve measurement data from socket. Replacing with 0's")
-            data_list=[0]*MAX_SENSORS
-        data_handling_logger.debug(f"{data_list}")
-        # First logs everything in csv file
-        ts = time.time()
-        sttime = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d_%H:%M:%S.%f')[:-3]
+    csv_logs = []
+    gap_logs = []
+    recordings = []
+    rolling_stats = []
+    for board in range(n_boards):
+        # A single board keeps the file names used before multi-board support
+        suffix = sttime if n_boards == 1 else f"{sttime}_board{board}"
+        csv_logs.append(log_writer.LogWriter(os.path.join(inter_path, "logs", "log_"+suffix+".csv"), description_list, flush_rows=args.log_flush_rows, flush_interval=args.log_flush_interval, time_format=args.log_time_format, rotate_size=args.log_rotate_size, rotate_interval=args.log_rotate_interval, compression=args.log_compression))
+        # Frames that never arrived are not made up, the frame that ends each gap is logged with the number missing before it
+        gap_logs.append(log_writer.LogWriter(os.path.join(inter_path, "logs", "gaps_"+suffix+".csv"), ["time", "missing_frames"], flush_rows=1, flush_interval=args.log_flush_interval, time_format=args.log_time_format, value_format=".0f"))
+        recordings.append(RecordingWriter(os.path.join(inter_path, "logs", "rec_"+suffix+".rec"), MAX_SENSORS, flush_interval=args.log_flush_interval) if args.record else None)
+        # Summary of the last minute, hour and day of the session, written when it ends
+        rolling_stats.append(RollingStats([TOPOLOGY.label(sensor) for sensor in range(TOPOLOGY.n_resistors)], os.path.join(inter_path, "logs", "stats_"+suffix+".json")))
+    return csv_logs, gap_logs, recordings, rolling_stats
+
+def close_logs(csv_logs, gap_logs, recordings, rolling_stats, merger, logger):
+    for board, (csv_log, recording) in enumerate(zip(csv_logs, recordings)):
+        csv_log.close()
+        gap_logs[board].close()
+        rolling_stats[board].close()
+        if recording:
+            recording.close()
+        logger.info("Board %d: %s, %d rows logged, %d gaps", board, merger.stats[board], csv_log.rows_written, gap_logs[board].rows_written)
+
+# Converts and logs a batch of merged frames, then hands the values of each frame of the plotted board to the plots
+#   Frames are converted board by board, each with the calibration of its board and its own logs
+#   outputs is (one output queue per matrix of the topology, output_text_values), or None without GUI
+def process_frames(frames, conversion_engine, csv_logs, gap_logs, recordings, rolling_stats, calibrators, pool, outputs, data_handling_logger):
+    if not frames:
+        return
+    if data_handling_logger.is_debug():
+        data_handling_logger.debug("%s", [(frame.board, frame.samples.tolist()) for frame in frames])
+    for board in sorted(set(frame.board for frame in frames)):
+        board_frames = [frame for frame in frames if frame.board == board]
+        # Taken once, the whole batch is converted with the same references
+        calibration = calibrators[board].calibration
+        vref = calibration.vref
+        iref = calibration.iref
         # VREF_A is taken as sensor0
         # VREF_B is taken as sensor1
-        vref_a_float = vref[0]
-        vref_b_float = vref[1]
-        iref_a_float = iref[0]
-        iref_b_float = iref[1]
-        string_data = [f"{sttime}", f"{vref_a_float:.3f}", f"{vref_b_float:.3f}"]
-        float_data = []
-        for i in range(MAX_SENSORS-2):
-            vread = int_to_voltage(data_list[i+2], aref_voltage, adc_resoltuion)
-            vplot = (vread + (R2/R1) * V_A) * (R1/(R1+R2))
+        frame_vrefs = numpy.tile(vref, (len(board_frames), 1))
+        # The buffers of the frames go back to the pool, their samples are only used from here on
+        frame_codes = pool.gather(board_frames)
+        vplots, resistances = conversion_engine.convert_with_tables(frame_codes, calibration.vplot_table, calibration.resistance_table)
+        converted_time = time.time()
+        for frame in board_frames:
+            registry.stamp(frame.stamps, STAGE_CONVERT, converted_time)
+        # First logs everything in csv file
+        frame_timestamps = numpy.array([frame.timestamp for frame in board_frames])
+        csv_logs[board].write(frame_timestamps, numpy.hstack((frame_vrefs, resistances)))
+        # seq counts the missing frames too, the gaps show in the recording
+        if recordings[board]:
+            recordings[board].append(frame_timestamps, [frame.seq for frame in board_frames], frame_codes, vref, iref)
+        gap_frames = [frame for frame in board_frames if frame.missed]
+        if gap_frames:
+            gap_logs[board].write(numpy.array([frame.timestamp for frame in gap_frames]), numpy.array([[frame.missed] for frame in gap_frames]))
+            missing = sum(frame.missed for frame in gap_frames)
+            data_handling_logger.warning("Board %d: %d frames missing", board, missing, key=board)
+            registry.count("missing.frames", missing)
+        rolling_stats[board].add(frame_timestamps, resistances)
+
+        # Group averages, max voltages and deviations of every frame at once
+        stats = TOPOLOGY.group_stats(vplots, resistances, ACCEPTABLE_DEVIANCE)
+        log_deviations(stats, board, data_handling_logger)
+        # Without GUI there is nobody to consume the outputs
+        if outputs is None or board != args.plot_board:
+            continue
+        output_matrices, output_text_values = outputs
+        # Every frame refers to the arrays of the whole batch, the plots take the row of frame_index when they draw it
+        for frame_index, frame in enumerate(board_frames):
+            for matrix_index, (matrix, output_matrix) in enumerate(zip(TOPOLOGY.matrices, output_matrices)):
+                # Values go with the stamps of their frame, only the first matrix stamps the render stage
+                try:
+                    output_matrix.put((stats, frame_index, frame.stamps if matrix_index == 0 else None), block=False)
+                except queue.Full:
+                    data_handling_logger.warning("Matrix %s data queue is full, dumping measurements", matrix.key)
+                    registry.count(f"dropped.output_data_{matrix.key}")
+
             try:
-                if args.calculate_values:
-                    # Matrix A
-                    if i < 16:
-                        rsensor = (vplot-vref_a_float)/iref_a_float
-                    # Matrix B
-                    else:
-                        rsensor = (vplot-vref_b_float)/iref_b_float
-                    rsensor = rsensor/1E3
-                else:
-                    rsensor = 1.81*data_list[i+2] - 177
-            except ZeroDivisionError:
-                rsensor = 0
-            string_data.append(f"{rsensor:.3f}")
-            float_data.append((vplot, rsensor))
-        csv_file = open (os.path.join(inter_path, "logs", file_name), "a", newline="")
-        writer=csv.writer(csv_file)
-        writer.writerow(string_data)
-        csv_file.close()
-
-        # Now separates the values to be shown by fig of matrix A and fig of matrix B
-        # This part of the code also takes the averages of the values according to physical proximity in the chip
-        matrix_A_values = process_matrix_A(float_data, data_handling_logger)
-        matrix_B_values = process_matrix_B(float_data, data_handling_logger)
-        matrix_A_B_values = float_data
+                output_text_values.put((vplots, resistances, frame_index), block=False)
+            except queue.Full:
+                data_handling_logger.warning("Values data queue is full, dumping measurements")
+                registry.count("dropped.output_text_values")
+
+# Seconds to wait for frames: until a frame of any board is late, or a frame held by the merger must be released
+def frame_timeout(clocks, now):
+    timeout = min(clock.timeout(now) for clock in clocks)
+    if args.merge_window is not None:
+        timeout = min(timeout, args.merge_window)
+    return timeout
+
+# Without --merge-window, a frame waits for the other boards until the slowest one is late
+def update_merge_window(merger, clocks):
+    if args.merge_window is None:
+        merger.max_delay = max(clock.late_limit for clock in clocks)
+
+def report_late_boards(clocks, now, logger):
+    for board, clock in enumerate(clocks):
+        if clock.last_arrival is None:
+            logger.warning("Did not recieve measurement data from board %d yet", board, key=board)
+        elif clock.overdue(now):
+            logger.warning("Did not recieve measurement data from board %d for %.2fs", board, now - clock.last_arrival, key=board)
+
+# data_queue holds the frames of every board, merger puts them back in time order
+#   Frames are not made up when they do not arrive, the clocks tell when they are late
+def handle_data(data_queue, conversion_engine, stop_threads, calibrators, clocks, pool, outputs, merger):
+    data_handling_logger=Logger("DATA HANDLING")
+    if args.verbose:
+        data_handling_logger.set_debug()
+    else:
+        data_handling_logger.set_warning()
+    csv_logs, gap_logs, recordings, rolling_stats = open_logs(merger.n_boards)
+    while not stop_threads[0]:
+        # Drains whatever is waiting in the queue so a backlog is converted in a single call
+        frames = []
         try:
-            output_data_A.put(matrix_A_values, block=False)
-        except queue.Full:
-            data_handling_logger.warning("Matrix A data queue is full, dumping measurements")
-
+            frames.append(data_queue.get(block=True, timeout=frame_timeout(clocks, time.time())))
+            data_queue.task_done()
+            while len(frames) < MAX_BATCH_FRAMES:
+                frames.append(data_queue.get(block=False))
+                data_queue.task_done()
+        except queue.Empty:
+            if not frames:
+                report_late_boards(clocks, time.time(), data_handling_logger)
+        update_merge_window(merger, clocks)
+        process_frames(merger.push(frames, time.time()), conversion_engine, csv_logs, gap_logs, recordings, rolling_stats, calibrators, pool, outputs, data_handling_logger)
+    process_frames(merger.flush(), conversion_engine, csv_logs, gap_logs, recordings, rolling_stats, calibrators, pool, outputs, data_handling_logger)
+    close_logs(csv_logs, gap_logs, recordings, rolling_stats, merger, data_handling_logger)
+
+# asyncio version of the retriever and data handling threads
+#   Frames come from the serial ports (serial_readers) or from the serial monitors' sockets (data_sockets),
+#   one source stage per board, go through a bounded asyncio queue and are converted and logged on an executor thread
+#   Nothing is made up when frames stop arriving, it is only reported
+async def acquire_async(conversion_engine, calibrators, clocks, pool, outputs, merger, serial_readers=None, data_sockets=None):
+    async_logger=Logger("ASYNC")
+    if args.verbose:
+        async_logger.set_debug()
+    else:
+        async_logger.set_warning()
+    last_codes=[[0, 0] for board in range(merger.n_boards)]
+    decoders=[protocol.make_decoder(args.protocol, board, pool) for board in range(merger.n_boards)]
+    missed_frames=[0]*merger.n_boards
+    # Frames of a single board, read at once
+    def on_frames(batch):
+        if not batch:
+            return batch
+        board = batch[0].board
+        missed = getattr(decoders[board], "missed_frames", 0)
+        if missed > missed_frames[board]:
+            async_logger.warning("Board %d: serial monitor dropped %d frames", board, missed-missed_frames[board], key=board)
+            missed_frames[board] = missed
+        for frame in batch:
+            if frame.samples.size != MAX_SENSORS:
+                async_logger.warning("Frame %d of board %d has %d sensors, expected %d", frame.seq, board, frame.samples.size, MAX_SENSORS)
+                registry.count("dropped.wrong_size")
+                pool.release(frame.slot)
+        batch = clocks[board].stamp_frames([frame for frame in batch if frame.samples.size == MAX_SENSORS])
+        update_references([frame.samples for frame in batch], calibrators[board], last_codes[board])
+        return batch
+    frames = asyncio.Queue(async_pipeline.ASYNC_QUEUE_SIZE)
+    registry.register_queue("data_queue", frames)
+    csv_logs, gap_logs, recordings, rolling_stats = open_logs(merger.n_boards)
+    def process(batch):
+        update_merge_window(merger, clocks)
+        process_frames(merger.push(batch, time.time()), conversion_engine, csv_logs, gap_logs, recordings, rolling_stats, calibrators, pool, outputs, async_logger)
+    def on_timeout():
+        report_late_boards(clocks, time.time(), async_logger)
+        # Frames of boards that went quiet are not held any longer
+        process([])
+    writers = []
+    try:
+        sources = []
+        if serial_readers:
+            for board, serial_reader in enumerate(serial_readers):
+                sources.append(async_pipeline.read_serial(serial_reader, frames, on_frames, board))
+        else:
+            for board, data_socket in enumerate(data_sockets):
+                reader, writer = await asyncio.open_connection(sock=data_socket)
+                writers.append(writer)
+                sources.append(async_pipeline.read_stream(reader, decoders[board], frames, on_frames))
+        await async_pipeline.run_stages(*sources, async_pipeline.process_batches(frames, process, MAX_BATCH_FRAMES, lambda: frame_timeout(clocks, time.time()), on_timeout))
+    finally:
+        for serial_reader in serial_readers or []:
+            serial_reader.close()
+        for writer in writers:
+            writer.close()
+        process_frames(merger.flush(), conversion_engine, csv_logs, gap_logs, recordings, rolling_stats, calibrators, pool, outputs, async_logger)
+        close_logs(csv_logs, gap_logs, recordings, rolling_stats, merger, async_logger)
+    async_logger.debug("Bye")
+
+# Connects to the frame server of a serial monitor, waiting for it to be up
+#   Returns None if the serial monitor exits or is not up in time
+def connect_to_serial_monitor(server_port, subproc):
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
         try:
-            output_data_B.put(matrix_B_values, block=False)
-        except queue.Full:
-            data_handling_logger.warning("Matrix B data queue is full, dumping measurements")
+            return socket.create_connection(('localhost', server_port))
+        except ConnectionRefusedError:
+            if subproc.poll() is not None or time.monotonic() > deadline:
+                return None
+            time.sleep(CONNECT_RETRY_INTERVAL)
+
+def stop_subprocess(subproc, logger):
+    if sys.platform == "win32":
+        subproc.kill()
+    else:
+        subproc.send_signal(signal.SIGINT)
+    poll = subproc.poll()
+    while poll is None:
+        logger.debug("Waiting subprocess")
+        time.sleep(1)
+        poll = subproc.poll()
 
-        try:
-            output_text_values.put(matrix_A_B_values, block=False)
-        except queue.Full:
-            data_handling_logger.warning("Values data queue is full, dumping measurements")
-
-def single_index_to_tuple (i):
-    #row = int(i/N_COLS)
-    #col = int(i%N_COLS)
-    # This can become a class if this mapping needs to be flexible or more elaborate
-    if i == 0:
-        return (0,0)
-    elif i == 1:
-        return (0,1)
-    elif i == 2 :
-        return (1,0)
-    elif i == 3 :
-        return (1,1)
-    elif i == 4 :
-        return (1,2)
-    else :
-        raise NotImplementedError
-
-position_dict = {
-# Un-groupped 
-    2 : (0.65, 0.1),
-    5 : (0.75, 0.1),
-    18: (0.85, 0.1),
-    21: (0.95, 0.1),
-# Un-groupped
-
-# Group 10
-    14 : (0.45, 0.9),
-    17 : (0.55, 0.9),
-    15 : (0.45, 0.8),
-    16 : (0.55, 0.8),
-# Group 9
-    9 : (0.15, 0.9),
-    6 : (0.25, 0.9),
-    4 : (0.15, 0.8),
-    3 : (0.25, 0.8),
-# Group 6
-    8 : (0.15, 0.7),
-    7 : (0.25, 0.7),
-# Group 8
-    13 : (0.75, 0.7),
-    10 : (0.75, 0.6),
-# Group 7
-    11 : (0.45, 0.7),
-    12 : (0.55, 0.7),
-
-# Group 5
-    26 : (0.75, 0.5),
-    29 : (0.75, 0.4),
-# Group 4
-    27 : (0.45, 0.4),
-    28 : (0.55, 0.4),
-# Group 3
-    24 : (0.15, 0.4),
-    23 : (0.25, 0.4),
-# Group 2
-    31 : (0.45, 0.3),
-    32 : (0.55, 0.3),
-    30 : (0.45, 0.2),
-    33 : (0.55, 0.2),
-# Group 1
-    20 : (0.15, 0.3),
-    19 : (0.25, 0.3),
-    25 : (0.15, 0.2),
-    22 : (0.25, 0.2),
-}
-
-def calculate_positioning(index):
-    return position_dict[index]
-
-def make_animation(data_queue, aref_voltage, adc_resoltuion, vref, iref, stop_threads):
+# clock is the frame clock of the plotted board
+def make_animation(outputs, clock):
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
     animation_logger=Logger("ANIMATION")
     if args.verbose:
         animation_logger.set_debug()
     else:
         animation_logger.set_warning()
-    matrix_A_x_vals={}
-    matrix_A_y_vals={}
-    matrix_B_x_vals={}
-    matrix_B_y_vals={}
-    for sensor in range(SENSORS_PER_WINDOW):
-        matrix_A_x_vals[sensor]=[]
-        matrix_A_y_vals[sensor]=[]
-        matrix_B_x_vals[sensor]=[]
-        matrix_B_y_vals[sensor]=[]
-
-    matrix_A_title_list=['R3|R4|R6|R9', 'R14|R15|R16|R17', 'R7|R8', 'R11|R12', 'R10|R13']
-    figA, axesA, linesA = build_matrix_figure(matrix_A_title_list)
-    figA.suptitle("Matrix A", fontsize=16)
-    textsA=[]
-    matrix_B_title_list=['R19|R20|R22|R25', 'R30|R31|R32|R33', 'R23|R24', 'R27|R28', 'R26|R29']
-    figB, axesB, linesB = build_matrix_figure(matrix_B_title_list)
-    figB.suptitle("Matrix B", fontsize=16)
-    textsB=[]
+    output_matrices, output_text_values = outputs
+
+    # Redraws as often as the plotted board sends frames
+    def follow_period(frame_animation):
+        interval = max(int(clock.period*1E3), 1)
+        if abs(frame_animation.event_source.interval - interval) > PLOT_INTERVAL_TOLERANCE*interval:
+            frame_animation.event_source.interval = interval
+
     figValues, ax = plt.subplots(1,1)
     figValues.suptitle("Individual resistor values", fontsize=16)
+    # Sensors placed as they are on the chip
+    value_sensors=list(TOPOLOGY.positions)
     textsValues=[]
-    smaller_measured_resistance=[50, 50, 50, 50, 50]
-    biggest_measured_resistance=[100, 100, 100, 100, 100]
-    output_data_A = queue.Queue(10)
-    output_data_B = queue.Queue(10)
-    output_text_values = queue.Queue(10)
-    try:
-        data_handling_thread = threading.Thread(target=handle_data, name="data_handling_thread", args=(data_queue, aref_voltage, adc_resoltuion, stop_threads, vref, iref, output_data_A, output_data_B, output_text_values))
-    except Exception as e:
-        animation_logger.error("Could not create thread")
-        e.with_traceback()
-    data_handling_thread.start()
-
-    indexA = count()
-    next(indexA)
-    indexB = count()
-    next(indexB)
+    for x_pos, y_pos in TOPOLOGY.positions.values():
+        textsValues.append(ax.text(x_pos, y_pos, "", fontfamily='serif', color='black', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=ax.transAxes))
 
     def animateValue(i):
         try:
-            # data_list is a list of tuples:
-            # [(vplot, resistance)]
-            data_list = output_text_values.get(block=True, timeout=CORRECTED_SAMPLING_PERIOD)
+            # vplots and resistances of a batch, (n_frames, n_resistors), and the frame to show
+            vplots, resistances, frame_index = output_text_values.get(block=True, timeout=clock.timeout(time.time()))
             output_text_values.task_done()
-            voltages = [value[0] for value in data_list]
-            resistances = [voltage[1] for voltage in data_list]
         except queue.Empty:
             animation_logger.warning("Did not recieve measurement data for values list")
-            resistances=[0]*MAX_SENSORS
-            voltages=[0]*MAX_SENSORS
-        for text in textsValues:
-            text.set_visible(False)
-        index = 2
-        # x_pos, y_pos = (0.15, 0.3)
-        for resistance, voltage in zip(resistances, voltages):
-            # index+2 is to be coherent with resistance layout naming
-            text_value_string = f"R{index}\n{resistance:.3f}\n{voltage:.2f}V"
-            x_pos, y_pos = calculate_positioning(index)
-            textsValues.append(ax.text(x_pos, y_pos, text_value_string, fontfamily='serif', color='black', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=ax.transAxes))
-            index+=1
-
-    def animateA(i):
-        try:
-            # data_list is a list of tuples:
-            # [(resistance, (index, vplot))]
-            data_list = output_data_A.get(block=True, timeout=CORRECTED_SAMPLING_PERIOD)
-            output_data_A.task_done()
-            resistances = [value[0] for value in data_list]
-            voltage_infos = [voltage_info[1] for voltage_info in data_list]
-        except queue.Empty:
-            animation_logger.warning("Did not recieve measurement data for matrix A")
-            resistances=[0]*MAX_SENSORS
-        sample=next(indexA)
-        for text in textsA:
-            text.set_visible(False)
-        for j, line in enumerate(linesA):
-            row, col = single_index_to_tuple(j)
-            sensor_id=j
-            resistance = resistances[sensor_id]
-            index, voltage = voltage_infos[sensor_id]
-            max_voltage_string = f"R{index+2}: {voltage:.2f}V"
-            if (voltage > SATURATION_VOLTAGE) :
-                textsA.append(axesA[row][col].text(0.35, 1.1, max_voltage_string, color='red', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesA[row][col].transAxes))
-            elif (voltage > CAUTION_VOLTAGE):
-                textsA.append(axesA[row][col].text(0.35, 1.1, max_voltage_string, color='orange', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesA[row][col].transAxes))
-            else:
-                textsA.append(axesA[row][col].text(0.35, 1.1, max_voltage_string, color='black', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesA[row][col].transAxes))
-            if resistance < 0:
-                animation_logger.debug("Negative resistance!")
-            text = f"{resistance:.3f}"
-            textsA.append(axesA[row][col].text(1, 1.1, text, fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesA[row][col].transAxes))
-            if smaller_measured_resistance[sensor_id] <= 50 or (resistance > 50 and resistance < smaller_measured_resistance[sensor_id]):
-                smaller_measured_resistance[sensor_id] = resistance - 50
-            if resistance > biggest_measured_resistance[sensor_id]:
-                biggest_measured_resistance[sensor_id] = resistance + 50
-            
-            matrix_A_x_vals[sensor_id].append(sample)
-            matrix_A_y_vals[sensor_id].append(resistance)
-
-            axesA[row][col].set_xlim(0, sample)
-            axesA[row][col].set_ylim(smaller_measured_resistance[sensor_id], biggest_measured_resistance[sensor_id])
-            line.set_data(matrix_A_x_vals[sensor_id], matrix_A_y_vals[sensor_id])
-        return linesA
-
-    def animateB(i):
-        try:
-            data_list = output_data_B.get(block=True, timeout=CORRECTED_SAMPLING_PERIOD)
-            output_data_B.task_done()
-            resistances = [value[0] for value in data_list]
-            voltage_infos = [voltage_info[1] for voltage_info in data_list]
-        except queue.Empty:
-            animation_logger.warning("Did not recieve measurement data for matrix B")
-            resistances=[0]*MAX_SENSORS
-        sample=next(indexB)
-        for text in textsB:
-            text.set_visible(False)
-        for j, line in enumerate(linesB):
-            row, col = single_index_to_tuple(j)
-            sensor_id=j
-            resistance = resistances[sensor_id]
-            index, voltage = voltage_infos[sensor_id]
-            max_voltage_string = f"R{index+2}: {voltage:.2f}V"
-            if (voltage > SATURATION_VOLTAGE) :
-                textsB.append(axesB[row][col].text(0.35, 1.1, max_voltage_string, color='red', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesB[row][col].transAxes))
-            elif (voltage > CAUTION_VOLTAGE):
-                textsB.append(axesB[row][col].text(0.35, 1.1, max_voltage_string, color='orange', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesB[row][col].transAxes))
-            else:
-                textsB.append(axesB[row][col].text(0.35, 1.1, max_voltage_string, color='black', fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesB[row][col].transAxes))
-            if resistance < 0:
-                animation_logger.debug("Negative resistance!")
-            text = f"{resistance:.3f}"
-            textsB.append(axesB[row][col].text(1, 1.1, text, fontweight='bold', fontsize='medium', horizontalalignment='right', verticalalignment='top', transform=axesB[row][col].transAxes))
-            if smaller_measured_resistance[sensor_id] <= 50 or (resistance > 50 and resistance < smaller_measured_resistance[sensor_id]):
-                smaller_measured_resistance[sensor_id] = resistance - 50
-            if resistance > biggest_measured_resistance[sensor_id]:
-                biggest_measured_resistance[sensor_id] = resistance + 50
-            
-            matrix_B_x_vals[sensor_id].append(sample)
-            matrix_B_y_vals[sensor_id].append(resistance)
-
-            axesB[row][col].set_xlim(0, sample)
-            axesB[row][col].set_ylim(smaller_measured_resistance[sensor_id], biggest_measured_resistance[sensor_id])
-            line.set_data(matrix_B_x_vals[sensor_id], matrix_B_y_vals[sensor_id])
-        return linesB
-
-    animA=animation.FuncAnimation(figA, animateA, blit=False, cache_frame_data=False, interval=ACTUAL_SAMPLING_PERIOD*1E3)
-    animB=animation.FuncAnimation(figB, animateB, blit=False, cache_frame_data=False, interval=ACTUAL_SAMPLING_PERIOD*1E3)
-    animValues=animation.FuncAnimation(figValues, animateValue, blit=False, cache_frame_data=True, interval=ACTUAL_SAMPLING_PERIOD*1E3)
+            return textsValues
+        follow_period(values_animation)
+        frame_vplots, frame_resistances = vplots[frame_index].tolist(), resistances[frame_index].tolist()
+        for sensor, text in zip(value_sensors, textsValues):
+            voltage, resistance = frame_vplots[sensor], frame_resistances[sensor]
+            text.set_text(f"{TOPOLOGY.label(sensor)}\n{resistance:.3f}\n{voltage:.2f}V")
+        return textsValues
+
+    def animate_matrix(matrix, output_matrix):
+        fig, axes, lines, voltage_texts, resistance_texts = build_matrix_figure(matrix)
+        artists = lines + voltage_texts + resistance_texts
+        n_groups = len(matrix.titles)
+        # Bounded history per plotted group, so redraw cost does not grow with the session length
+        history=[RingBuffer(args.plot_history) for group in range(n_groups)]
+        smaller_measured_resistance=[50]*n_groups
+        biggest_measured_resistance=[100]*n_groups
+        sample_index = count()
+        next(sample_index)
+
+        # Group stats of a batch and the frame to show
+        def update_matrix_figure(stats, frame_index, sample):
+            means = stats.mean[frame_index, matrix.groups].tolist()
+            max_sensors = stats.max_sensor[frame_index, matrix.groups].tolist()
+            max_voltages = stats.max_voltage[frame_index, matrix.groups].tolist()
+            limits_changed = False
+            for j, line in enumerate(lines):
+                row, col = matrix.cells[j]
+                resistance, index, voltage = means[j], max_sensors[j], max_voltages[j]
+                voltage_texts[j].set_text(f"{TOPOLOGY.label(index)}: {voltage:.2f}V")
+                if (voltage > SATURATION_VOLTAGE) :
+                    voltage_texts[j].set_color('red')
+                elif (voltage > CAUTION_VOLTAGE):
+                    voltage_texts[j].set_color('orange')
+                else:
+                    voltage_texts[j].set_color('black')
+                if resistance < 0:
+                    animation_logger.debug("Negative resistance!")
+                resistance_texts[j].set_text(f"{resistance:.3f}")
+                if smaller_measured_resistance[j] <= 50 or (resistance > 50 and resistance < smaller_measured_resistance[j]):
+                    smaller_measured_resistance[j] = resistance - 50
+                if resistance > biggest_measured_resistance[j]:
+                    biggest_measured_resistance[j] = resistance + 50
+
+                history[j].append(sample, resistance)
+                x_vals, y_vals = history[j].data()
+                limits_changed |= update_axis_limits(axes[row][col], x_vals[0]-1, sample, smaller_measured_resistance[j], biggest_measured_resistance[j])
+                # One min/max pair per pixel of the axis is enough to draw it
+                line.set_data(*minmax_decimate(x_vals, y_vals, axes[row][col].get_window_extent().width))
+            if limits_changed:
+                # Ticks changed, the background saved for blitting must be rendered again
+                fig.canvas.draw()
+
+        def animate(i):
+            try:
+                stats, frame_index, stamps = output_matrix.get(block=True, timeout=clock.timeout(time.time()))
+                output_matrix.task_done()
+            except queue.Empty:
+                animation_logger.warning("Did not recieve measurement data for matrix %s", matrix.key)
+                return artists
+            follow_period(matrix_animation)
+            update_matrix_figure(stats, frame_index, next(sample_index))
+            registry.stamp(stamps, STAGE_RENDER)
+            if stamps and STAGE_SERIAL in stamps:
+                registry.observe(STAGE_TOTAL, stamps[STAGE_RENDER] - stamps[STAGE_SERIAL])
+            return artists
+
+        # Init functions only tell which artists are animated, without waiting for data
+        matrix_animation = animation.FuncAnimation(fig, animate, init_func=lambda: artists, blit=True, cache_frame_data=False, interval=clock.period*1E3)
+        return matrix_animation
+
+    # Animations stop if they are garbage collected
+    animations=[animate_matrix(matrix, output_matrix) for matrix, output_matrix in zip(TOPOLOGY.matrices, output_matrices)]
+    values_animation = animation.FuncAnimation(figValues, animateValue, init_func=lambda: textsValues, blit=True, cache_frame_data=False, interval=clock.period*1E3)
+    animations.append(values_animation)
     plt.show()
 
 if __name__ == "__main__":
@@ -538,85 +582,177 @@ if __name__ == "__main__":
     #nsensors=args.nsensors
     nsensors=4
     if nsensors > MAX_SENSORS:
-        gui_monitor_logger.error(f"Only {MAX_SENSORS} sensors can be viewed. {nsensors} passed.")
+        gui_monitor_logger.error("Only %d sensors can be viewed. %d passed.", MAX_SENSORS, nsensors)
         exit(1)
     aref_voltage=args.aref
     adc_bits=args.adc_resolution
     adc_resoltuion=(2**adc_bits)-1
-    port=args.port
     python_interp=sys.executable
     inter_path=os.path.dirname(os.path.realpath(__file__))
-    if args.virtual:
-        gui_monitor_logger.error("Virtual sensor is not supported yet")
+    n_boards = args.virtual_boards if args.virtual else len(args.port)
+    if not 0 <= args.plot_board < n_boards:
+        gui_monitor_logger.error("Can not plot board %d, there are %d boards.", args.plot_board, n_boards)
         exit(1)
-        serial_monitor_cmd=[python_interp, os.path.join(inter_path,"virtual_sensor.py"), "--port", "dummy", "--nsensors", str(MAX_SENSORS)]
-    else:
-        serial_monitor_cmd=[python_interp, os.path.join(inter_path,"osc.py"), "--port", port, "--nsensors", str(MAX_SENSORS), "--time-tolerance", str(args.time_tolerance)]
-    server_addr=('localhost', 25565)
-    serial_server = socket.socket()
-    serial_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    serial_server.bind(server_addr)
-    if args.verbose:
-        serial_monitor_cmd.append("--verbose")
+    virtual_sensor_subprocs = []
+    ports = args.port
+    if args.virtual:
+        ports = []
+        for board in range(n_boards):
+            # The emulator prints the name of its pseudo-terminal before sending any frame
+            virtual_sensor_cmd=[python_interp, os.path.join(inter_path,"virtual_sensor.py"), "--period", str(args.virtual_period), "--noise", str(args.virtual_noise)]
+            if args.verbose:
+                virtual_sensor_cmd.append("--verbose")
+            virtual_sensor_subprocs.append(subprocess.Popen(virtual_sensor_cmd, stdout=subprocess.PIPE, text=True))
+            port = virtual_sensor_subprocs[-1].stdout.readline().strip()
+            if not port:
+                gui_monitor_logger.error("Could not start virtual sensor")
+                for virtual_sensor_subproc in virtual_sensor_subprocs:
+                    stop_subprocess(virtual_sensor_subproc, gui_monitor_logger)
+                exit(1)
+            gui_monitor_logger.info("Virtual sensor %d running on %s", board, port)
+            ports.append(port)
+    # Every process of the session dumps its metrics next to the logs
+    metrics_dumper = None
+    metrics_prefix = os.path.join(inter_path, "logs", "metrics_"+datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    if args.metrics_interval > 0:
+        if not os.path.exists(os.path.join(inter_path, "logs")):
+            os.makedirs(os.path.join(inter_path, "logs"))
+        metrics_notes = None
+        if args.protocol == protocol.PROTOCOL_ASCII and not args.in_process:
+            # The times of a frame stay in osc.py, its metrics file has the serial, enqueue and send stages
+            metrics_notes = "ascii frames carry no times: decode is measured from the socket receive, serial, send and total are not measured"
+        metrics_dumper = metrics.MetricsDumper(metrics_prefix+".jsonl", args.metrics_interval, process_name="integ", notes=metrics_notes)
     stop_threads=[False]
     try:
-        try:
-            serial_read_subproc = subprocess.Popen(serial_monitor_cmd)
-        except subprocess.CalledProcessError as err:
-            gui_monitor_logger.error(err.stderr.decode("utf-8"))
-            exit(1)
-        time.sleep(1)
-        poll = serial_read_subproc.poll()
-        if poll is not None:
-            exit(1)
-        try:
-            serial_server.settimeout(5)
-            serial_server.listen(1)
-            conn, addr = serial_server.accept()
-            gui_monitor_logger.info(f"Connected to {addr}")
-        except socket.timeout:
-            if sys.platform == "win32":
-                serial_read_subproc.kill()
-            else:
-                serial_read_subproc.send_signal(signal.SIGINT)
-            poll = serial_read_subproc.poll()
-            while poll is None:
-                gui_monitor_logger.debug("Waiting subprocess")
-                time.sleep(1)
-                poll = serial_read_subproc.poll()
-            exit(1)
-
-        # This means we may a maximum of 5 minutes of measurement buffering in the queue
-        # Measurements arrive every 0.1s
-        # This queue will be accessed 
-        #   1) When a measurement arrives from the socket
-        #   2) When the animation function is called to retrieve a frame
-        data_queue = queue.Queue(3000)
-        data_queue.put([0]*34)
-        vref=[0, 0]
-        iref=[0, 0]
-        try:
-            retriever_thread = threading.Thread(target=retrieve_measurement_data, name="retriever_thread", args=(data_queue, aref_voltage, adc_resoltuion, stop_threads, conn, vref, iref))
-        except Exception as e:
-            gui_monitor_logger.error("Could not create thread")
-            e.with_traceback()
-        retriever_thread.start()
-
-        make_animation(data_queue, aref_voltage, adc_resoltuion, vref, iref, stop_threads)
+        serial_readers = []
+        serial_read_subprocs = []
+        conns = []
+        if args.in_process:
+            import osc
+            for port in ports:
+                serial_config={
+                    'port' : port,
+                    'baud' : SERIAL_BAUD_RATE,
+                    'sensors' : MAX_SENSORS,
+                    'read_mode' : 'chunk',
+                    # The event loop only reads when data is waiting
+                    'timeout' : 0 if args.asyncio else SERIAL_READ_TIMEOUT,
+                    'verbose' : args.verbose,
+                }
+                try:
+                    serial_readers.append(osc.Oscilloscope(serial_config))
+                except SystemExit:
+                    for serial_reader in serial_readers:
+                        serial_reader.close()
+                    for virtual_sensor_subproc in virtual_sensor_subprocs:
+                        stop_subprocess(virtual_sensor_subproc, gui_monitor_logger)
+                    exit(1)
+        else:
+            # One serial monitor per board, each serves its frames on its own port
+            for board, port in enumerate(ports):
+                serial_monitor_cmd=[python_interp, os.path.join(inter_path,"osc.py"), "--port", port, "--nsensors", str(MAX_SENSORS), "--sampling-period", str(SAMPLING_PERIOD), "--time-tolerance", str(args.time_tolerance), "--protocol", args.protocol, "--server-port", str(SERVER_PORT+board)]
+                if args.asyncio:
+                    serial_monitor_cmd.append("--asyncio")
+                if metrics_dumper:
+                    serial_monitor_cmd += ["--metrics-file", f"{metrics_prefix}_osc{board}.jsonl", "--metrics-interval", str(args.metrics_interval)]
+                if args.verbose:
+                    serial_monitor_cmd.append("--verbose")
+                try:
+                    serial_read_subprocs.append(subprocess.Popen(serial_monitor_cmd))
+                except subprocess.CalledProcessError as err:
+                    gui_monitor_logger.error(err.stderr.decode("utf-8"))
+                    exit(1)
+            # Subscribes as soon as each serial monitor is up
+            for board, serial_read_subproc in enumerate(serial_read_subprocs):
+                conn = connect_to_serial_monitor(SERVER_PORT+board, serial_read_subproc)
+                if conn is None:
+                    gui_monitor_logger.error("Could not connect to the serial monitor of board %d", board)
+                    for subproc in serial_read_subprocs + virtual_sensor_subprocs:
+                        if subproc.poll() is None:
+                            stop_subprocess(subproc, gui_monitor_logger)
+                    exit(1)
+                gui_monitor_logger.info("Connected to %s", conn.getpeername())
+                conns.append(conn)
+
+        conversion_engine = ConversionEngine(aref_voltage, adc_resoltuion, R1, R2, V_A, args.calculate_values)
+        # VREF/IREF of each board, read by the retrievers and used by the data handler
+        calibrators=[Calibrator(conversion_engine, R_OF_IREF) for board in range(n_boards)]
+        # Sample clock of each board, fed by the retrievers and followed by every consumer of the frames
+        clocks=[FrameClock(SAMPLING_PERIOD, args.time_tolerance) for board in range(n_boards)]
+        merger = FrameMerger(n_boards, args.merge_window)
+        update_merge_window(merger, clocks)
+        # Sample buffers of the binary frames of every board, from the retrievers to the data handler
+        pool = FramePool(FRAME_POOL_BUFFERS, MAX_SENSORS, protocol.SAMPLE_DTYPE)
+        registry.register_queue("frame_pool", pool)
+        outputs = None
+        if not args.no_gui:
+            outputs = ([queue.Queue(10) for matrix in TOPOLOGY.matrices], queue.Queue(10))
+            for matrix, output_queue in zip(TOPOLOGY.matrices, outputs[0]):
+                registry.register_queue(f"output_data_{matrix.key}", output_queue)
+            registry.register_queue("output_text_values", outputs[1])
+        if args.asyncio:
+            pipeline = async_pipeline.PipelineThread(acquire_async, args=(conversion_engine, calibrators, clocks, pool, outputs, merger, serial_readers, conns), name="acquisition_thread")
+            pipeline.start()
+            acquisition_threads = [pipeline]
+        else:
+            # This means we may a maximum of 5 minutes of measurement buffering in the queue
+            # Measurements arrive every 0.1s
+            # This queue will be accessed 
+            #   1) When a measurement arrives from the socket
+            #   2) When the animation function is called to retrieve a frame
+            data_queue = queue.Queue(3000)
+            registry.register_queue("data_queue", data_queue)
+            # One retriever per board, so boards are read concurrently
+            retriever_threads = []
+            try:
+                for board in range(n_boards):
+                    if args.in_process:
+                        retriever_threads.append(threading.Thread(target=read_serial_frames, name=f"retriever_thread_{board}", args=(data_queue, stop_threads, serial_readers[board], calibrators[board], clocks[board], board)))
+                    else:
+                        retriever_threads.append(threading.Thread(target=retrieve_measurement_data, name=f"retriever_thread_{board}", args=(data_queue, stop_threads, conns[board], calibrators[board], clocks[board], pool, args.protocol, board)))
+                data_handling_thread = threading.Thread(target=handle_data, name="data_handling_thread", args=(data_queue, conversion_engine, stop_threads, calibrators, clocks, pool, outputs, merger))
+            except Exception as e:
+                gui_monitor_logger.error("Could not create thread")
+                e.with_traceback()
+            for retriever_thread in retriever_threads:
+                retriever_thread.start()
+            data_handling_thread.start()
+            acquisition_threads = retriever_threads
+
+        if args.no_gui:
+            shutdown = threading.Event()
+            def handler(signum, frame):
+                gui_monitor_logger.info("Stopping acquisition")
+                shutdown.set()
+            signal.signal(signal.SIGINT, handler)
+            signal.signal(signal.SIGTERM, handler)
+            # Also stops if a serial monitor goes away
+            while not shutdown.wait(1) and all(thread.is_alive() for thread in acquisition_threads):
+                pass
+        else:
+            make_animation(outputs, clocks[args.plot_board])
 
         stop_threads[0]=True
-        retriever_thread.join()
-        if sys.platform == "win32":
-            serial_read_subproc.kill()
+        if args.asyncio:
+            # Cancels every stage right away, the logs are flushed before it returns
+            pipeline.stop()
         else:
-            serial_read_subproc.send_signal(signal.SIGINT)
-        poll = serial_read_subproc.poll()
-        while poll is None:
-            time.sleep(1)
-            gui_monitor_logger.debug("Waiting subprocess")
-            poll = serial_read_subproc.poll()
-        conn.close()
-        serial_server.close()
+            # Unblocks the retrievers waiting on recv
+            for conn in conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for retriever_thread in retriever_threads:
+                retriever_thread.join()
+            # Flushes the logs
+            data_handling_thread.join()
+        for subproc in serial_read_subprocs + virtual_sensor_subprocs:
+            stop_subprocess(subproc, gui_monitor_logger)
+        for conn in conns:
+            conn.close()
+        if metrics_dumper:
+            metrics_dumper.close()
         gui_monitor_logger.debug("Bye")
     except Exception as e:
         e.with_traceback()
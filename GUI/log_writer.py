@@ -0,0 +1,293 @@
+import os
+import bz2
+import csv
+import gzip
+import json
+import lzma
+import queue
+import shutil
+import datetime
+import threading
+import time
+import numpy
+from logger import Logger
+from metrics import registry, STAGE_LOG
+
+TIME_FORMAT_DATETIME="datetime"
+TIME_FORMAT_EPOCH="epoch"
+TIME_FORMATS=[TIME_FORMAT_DATETIME, TIME_FORMAT_EPOCH]
+
+# Rows are written when this many are pending or when the oldest pending row is this old (in seconds)
+LOG_FLUSH_ROWS=256
+LOG_FLUSH_INTERVAL=5.0
+# Session logs are cut in segments when they reach this size (in MB) or span this long (in hours)
+#   Off by default (0), a session is a single plain log_*.csv unless a limit is asked for
+LOG_ROTATE_SIZE=0
+LOG_ROTATE_INTERVAL=0
+# Finished segments are compressed with one of these stdlib codecs: (extension, opener)
+COMPRESSIONS={
+    "gzip": (".gz", lambda path, mode: gzip.open(path, mode, compresslevel=6)),
+    "bz2": (".bz2", bz2.open),
+    "xz": (".xz", lzma.open),
+    "none": ("", None),
+}
+LOG_COMPRESSION="gzip"
+MANIFEST_SUFFIX=".manifest.json"
+DATETIME_FORMAT='%Y-%m-%d_%H:%M:%S.%f'
+
+def format_timestamp(timestamp, time_format):
+    if time_format == TIME_FORMAT_EPOCH:
+        return f"{timestamp:.3f}"
+    return datetime.datetime.fromtimestamp(timestamp).strftime(DATETIME_FORMAT)[:-3]
+
+def parse_timestamp(time_string, time_format):
+    if time_format == TIME_FORMAT_EPOCH:
+        return float(time_string)
+    return datetime.datetime.strptime(time_string, DATETIME_FORMAT).timestamp()
+
+# log_x.csv is written as log_x.part0001.csv, log_x.part0002.csv... listed in log_x.manifest.json
+def manifest_path (file_path):
+    return os.path.splitext(file_path)[0] + MANIFEST_SUFFIX
+
+def segment_path (file_path, number):
+    base, extension = os.path.splitext(file_path)
+    return f"{base}.part{number:04d}{extension}"
+
+# Time range, rows and file of every segment of a session, shared by the writer and the compressor
+#   Rewritten whole on every change, through a temporary file, so readers never see half of it
+class SessionManifest ():
+    def __init__ (self, file_path, header, time_format):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.content = {"header": header, "time_format": time_format, "segments": []}
+
+    # A segment gets its entry with its first row, start and end are epoch seconds, end is None until it is finished
+    def add (self, segment_file, start):
+        with self.lock:
+            self.content["segments"].append({"file": os.path.basename(segment_file), "start": start, "end": None, "rows": 0})
+            self._write()
+
+    def finish (self, segment_file, end, rows):
+        self._update(segment_file, end=end, rows=rows)
+
+    def compressed (self, segment_file, compressed_file):
+        self._update(segment_file, file=os.path.basename(compressed_file), bytes=os.path.getsize(compressed_file))
+
+    def _update (self, segment_file, **values):
+        with self.lock:
+            for segment in self.content["segments"]:
+                if segment["file"] == os.path.basename(segment_file):
+                    segment.update(values)
+            self._write()
+
+    def _write (self):
+        with open(self.file_path + ".tmp", "w") as manifest_file:
+            json.dump(self.content, manifest_file, indent=1)
+        os.replace(self.file_path + ".tmp", self.file_path)
+
+# Compresses finished segments on its own thread, the manifest points to the compressed file
+#   before the original is removed, so a reader always finds one of them
+class SegmentCompressor ():
+    def __init__ (self, compression, manifest):
+        self.extension, self.opener = COMPRESSIONS[compression]
+        self.manifest = manifest
+        self.logger = Logger("LOG-COMPRESSOR")
+        self.logger.set_warning()
+        self.segments = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="log_compressor_thread", daemon=True)
+        self.thread.start()
+
+    def compress (self, segment_file):
+        self.segments.put(segment_file)
+
+    # Compresses every segment still queued
+    def close (self):
+        self.segments.put(None)
+        self.thread.join()
+
+    def _run (self):
+        while True:
+            segment_file = self.segments.get()
+            if segment_file is None:
+                return
+            compressed_file = segment_file + self.extension
+            try:
+                with open(segment_file, "rb") as source, self.opener(compressed_file + ".tmp", "wb") as destination:
+                    shutil.copyfileobj(source, destination, 1 << 20)
+                os.replace(compressed_file + ".tmp", compressed_file)
+                self.manifest.compressed(segment_file, compressed_file)
+                os.remove(segment_file)
+            except OSError as e:
+                self.logger.error("Could not compress %s: %s", segment_file, e)
+                continue
+            self.logger.debug("Compressed %s", compressed_file)
+
+# Reads the segments of a session from its manifest
+class SessionLogReader ():
+    def __init__ (self, file_path):
+        self.directory = os.path.dirname(file_path)
+        with open(file_path) as manifest_file:
+            content = json.load(manifest_file)
+        self.header = content["header"]
+        self.time_format = content["time_format"]
+        self.segments = content["segments"]
+
+    # Segments with rows between start and end (epoch seconds, None is unbounded)
+    #   The last one may still be written, its end is None
+    def segments_between (self, start=None, end=None):
+        return [segment for segment in self.segments
+                if (start is None or segment["end"] is None or segment["end"] >= start) and (end is None or segment["start"] <= end)]
+
+    # Text stream of a segment, decompressed while it is read
+    def open_segment (self, segment):
+        file_path = os.path.join(self.directory, segment["file"])
+        for extension, opener in COMPRESSIONS.values():
+            if extension and file_path.endswith(extension):
+                return opener(file_path, "rt")
+        return open(file_path)
+
+    # Yields the CSV lines (headers skipped) of the rows between start and end, one segment open at a time
+    #   Only the segments crossing a bound have their rows parsed and filtered
+    def lines (self, start=None, end=None):
+        for segment in self.segments_between(start, end):
+            inside = (start is None or segment["start"] >= start) and (end is None or (segment["end"] is not None and segment["end"] <= end))
+            with self.open_segment(segment) as segment_file:
+                segment_file.readline()
+                for line in segment_file:
+                    if not inside:
+                        timestamp = parse_timestamp(line.split(",", 1)[0], self.time_format)
+                        if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                            continue
+                    yield line
+
+# Keeps the CSV file open and writes rows from a background thread
+#   Producers only hand over raw epoch timestamps and float arrays, formatting and disk I/O
+#   happen on the writer thread, so a slow disk never blocks acquisition
+#   With a rotate size or interval the log is cut in segments (see manifest_path and segment_path),
+#   the finished ones are compressed by a SegmentCompressor
+#   on_flush(tags, flushed_time) is called on the writer thread with the tags given to write() once their rows are on disk
+class LogWriter ():
+    def __init__ (self, file_path, header, flush_rows=LOG_FLUSH_ROWS, flush_interval=LOG_FLUSH_INTERVAL, time_format=TIME_FORMAT_DATETIME, rotate_size=None, rotate_interval=None, compression=LOG_COMPRESSION, value_format=".3f", on_flush=None):
+        self.file_path = file_path
+        self.header = header
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.time_format = time_format
+        self.value_format = value_format
+        self.on_flush = on_flush
+        # In bytes and seconds
+        self.rotate_size = rotate_size*2**20 if rotate_size else None
+        self.rotate_interval = rotate_interval*3600 if rotate_interval else None
+        self.logger = Logger("LOG-WRITER")
+        self.logger.set_warning()
+        self.rows = queue.Queue()
+        self.rows_written = 0
+        self.manifest = None
+        self.compressor = None
+        self.segments = 0
+        if self.rotate_size or self.rotate_interval:
+            self.manifest = SessionManifest(manifest_path(file_path), header, time_format)
+            if COMPRESSIONS[compression][1] is not None:
+                self.compressor = SegmentCompressor(compression, self.manifest)
+            self._open_segment()
+        else:
+            self._open(file_path)
+        self.thread = threading.Thread(target=self._run, name="log_writer_thread", daemon=True)
+        self.thread.start()
+
+    # timestamps: (n_rows,) epoch seconds, values: (n_rows, n_columns)
+    def write (self, timestamps, values, tag=None):
+        self.rows.put((numpy.atleast_1d(timestamps), numpy.atleast_2d(values), time.time(), tag))
+
+    # Writes everything still pending and closes the file
+    def close (self):
+        self.rows.put(None)
+        self.thread.join()
+
+    def _open (self, file_path):
+        self.segment_file = file_path
+        self.segment_start = None
+        self.segment_end = None
+        self.segment_rows = 0
+        self.csv_file = open (file_path, "w", newline="")
+        self.writer = csv.writer(self.csv_file)
+        self.writer.writerow(self.header)
+        self.csv_file.flush()
+
+    def _open_segment (self):
+        self.segments += 1
+        self._open(segment_path(self.file_path, self.segments))
+
+    # Closes the current segment, an empty one is removed
+    def _close_segment (self):
+        self.csv_file.close()
+        if self.manifest is None:
+            return
+        if not self.segment_rows:
+            os.remove(self.segment_file)
+            return
+        self.manifest.finish(self.segment_file, self.segment_end, self.segment_rows)
+        if self.compressor is not None:
+            self.compressor.compress(self.segment_file)
+
+    def _rotate (self, timestamps):
+        if self.manifest is None or not self.segment_rows:
+            return
+        if (self.rotate_size and self.csv_file.tell() >= self.rotate_size) or (self.rotate_interval and timestamps.max() - self.segment_start >= self.rotate_interval):
+            self._close_segment()
+            self._open_segment()
+            self.logger.debug("Log continues in %s", self.segment_file)
+
+    def _flush (self, pending):
+        for timestamps, values, _, _ in pending:
+            # Segments are cut between batches, rows of a batch stay together
+            self._rotate(timestamps)
+            if self.manifest is not None and not self.segment_rows:
+                self.segment_start = float(timestamps.min())
+                self.manifest.add(self.segment_file, self.segment_start)
+            self.segment_end = max(self.segment_end or 0, float(timestamps.max()))
+            self.segment_rows += len(timestamps)
+            time_strings = [format_timestamp(timestamp, self.time_format) for timestamp in timestamps.tolist()]
+            self.writer.writerows([time_string] + [format(value, self.value_format) for value in row] for time_string, row in zip(time_strings, values.tolist()))
+            self.rows_written += len(time_strings)
+        self.csv_file.flush()
+        # Time every row waited between write() and the disk
+        flushed_time = time.time()
+        for timestamps, _, write_time, _ in pending:
+            for _ in range(len(timestamps)):
+                registry.observe(STAGE_LOG, flushed_time - write_time, flushed_time)
+        if self.on_flush is not None:
+            self.on_flush([tag for _, _, _, tag in pending], flushed_time)
+
+    def _run (self):
+        pending = []
+        pending_rows = 0
+        deadline = None
+        running = True
+        while running:
+            timeout = None if deadline is None else max(deadline-time.monotonic(), 0)
+            try:
+                item = self.rows.get(block=True, timeout=timeout)
+                if item is None:
+                    running = False
+                else:
+                    pending.append(item)
+                    pending_rows += len(item[0])
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+            if pending and (not running or pending_rows >= self.flush_rows or time.monotonic() >= deadline):
+                try:
+                    self._flush(pending)
+                except OSError as e:
+                    self.logger.error("Could not write to %s: %s", self.segment_file, e)
+                pending = []
+                pending_rows = 0
+                deadline = None
+        try:
+            self._close_segment()
+        except OSError as e:
+            self.logger.error("Could not close %s: %s", self.segment_file, e)
+        if self.compressor is not None:
+            self.compressor.close()
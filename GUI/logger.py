@@ -1,16 +1,113 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import threading
+
+LOG_FORMAT="[%(name)s] %(levelname)s: %(message)s"
+# At most RATE_LIMIT_BURST messages with the same format string are written per RATE_LIMIT_INTERVAL seconds,
+#   the rest are counted and reported with the next one that gets through
+RATE_LIMIT_INTERVAL=5.0
+RATE_LIMIT_BURST=3
+# Forgets the format strings not seen for a while past this many
+RATE_LIMIT_MAX_KEYS=1024
+# Messages below this level are always written, debug output is asked for with --verbose
+RATE_LIMIT_LEVEL=logging.WARNING
+
+# Drops repeated messages, keyed on logger, level and format string (not the formatted message)
+#   so messages must pass their values as arguments to be grouped
+#   Messages about one of several things (a sensor, a board) pass it as rate_limit_key
+#   so a noisy one does not hide the others
+class RateLimitFilter (logging.Filter):
+    def __init__ (self, interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST, level=RATE_LIMIT_LEVEL):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self.lock = threading.Lock()
+        # key: [window start, written, suppressed, arguments of the last suppressed]
+        self.windows = {}
+
+    def filter (self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, str(record.msg), getattr(record, "rate_limit_key", None))
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or record.created - window[0] >= self.interval:
+                if len(self.windows) >= RATE_LIMIT_MAX_KEYS:
+                    self._prune(record.created)
+                suppressed = window[2] if window else 0
+                self.windows[key] = [record.created, 1, 0, None]
+                if suppressed:
+                    record.msg = f"{str(record.msg).rstrip()} (suppressed {suppressed} similar messages)"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            window[3] = record.args
+            return False
+
+    def _prune (self, now):
+        for key in [key for key, window in self.windows.items() if now - window[0] >= self.interval and not window[2]]:
+            del self.windows[key]
+
+    # Returns (logger name, level, last suppressed message, suppressed) for every message still holding back others
+    def take_suppressed (self):
+        with self.lock:
+            suppressed = [(name, level, (msg % window[3] if window[3] else msg).rstrip(), window[2]) for (name, level, msg, _), window in self.windows.items() if window[2]]
+            for key in self.windows:
+                self.windows[key][2] = 0
+        return suppressed
+
+# Every logger hands its records to a queue, a single listener thread writes them to the console
+#   so logging from the acquisition threads never waits on the terminal
+_setup_lock = threading.Lock()
+_queue_handler = None
+_listener = None
+_console_handler = None
+_rate_limit = RateLimitFilter()
+
+def _get_queue_handler ():
+    global _queue_handler, _listener, _console_handler
+    with _setup_lock:
+        if _queue_handler is None:
+            log_queue = queue.SimpleQueue()
+            _console_handler = logging.StreamHandler()
+            _console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            _queue_handler = logging.handlers.QueueHandler(log_queue)
+            _queue_handler.addFilter(_rate_limit)
+            _listener = logging.handlers.QueueListener(log_queue, _console_handler)
+            _listener.start()
+            atexit.register(stop_logging)
+    return _queue_handler
+
+# Writes what is left in the queue and the count of messages still suppressed
+#   Called at exit, logging after it is lost
+def stop_logging ():
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+    for name, level, msg, suppressed in _rate_limit.take_suppressed():
+        _console_handler.handle(logging.LogRecord(name, level, "", 0, f"{msg} (suppressed {suppressed} similar messages)", None, None))
 
 # Create a new module for Logger
+#   Messages are %-style format strings, their arguments are only formatted if the message is written
 class Logger ():
     def __init__ (self, logger_name=None):
         if logger_name:
             self.logger = logging.getLogger(logger_name)
         else:
             self.logger = logging.getLogger(__name__)
-        self.log_format = logging.Formatter("[%(name)s] %(levelname)s: %(message)s")
-        self.console_handle = logging.StreamHandler()
-        self.console_handle.setFormatter(self.log_format)
-        self.logger.addHandler(self.console_handle)
+        # Loggers with the same name are the same logging.Logger, the handler is only added once
+        queue_handler = _get_queue_handler()
+        if queue_handler not in self.logger.handlers:
+            self.logger.addHandler(queue_handler)
+        self.logger.propagate = False
 
     def set_debug(self):
         self.logger.setLevel(logging.DEBUG)
@@ -24,14 +121,19 @@ class Logger ():
     def set_error(self):
         self.logger.setLevel(logging.ERROR)
 
-    def error(self, msg):
-        self.logger.error(msg)
-    
-    def debug(self, msg):
-        self.logger.debug(msg)
+    # For messages whose arguments are expensive to build
+    def is_debug(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def error(self, msg, *args):
+        self.logger.error(msg, *args)
+
+    def debug(self, msg, *args):
+        self.logger.debug(msg, *args)
 
-    def info(self, msg):
-        self.logger.info(msg)
+    def info(self, msg, *args):
+        self.logger.info(msg, *args)
 
-    def warning(self, msg):
-        self.logger.warning(msg)
\ No newline at end of file
+    # key: what the message is about, messages with different keys are rate limited apart
+    def warning(self, msg, *args, key=None):
+        self.logger.warning(msg, *args, extra={"rate_limit_key": key})
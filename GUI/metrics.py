@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+import numpy
+
+# Per process registry of pipeline metrics
+#   Frames carry a dict of {stage: time.time()} filled as they move through the pipeline, stamping a
+#   stage records how long the frame took since the previous stage it went through
+#   Queues are registered once and their depth is read whenever a snapshot is taken
+STAGE_SERIAL="serial"
+STAGE_ENQUEUE="enqueue"
+STAGE_SEND="send"
+STAGE_DECODE="decode"
+STAGE_CONVERT="convert"
+STAGE_LOG="log"
+STAGE_RENDER="render"
+# From the serial read to the plot
+STAGE_TOTAL="total"
+STAGES=[STAGE_SERIAL, STAGE_ENQUEUE, STAGE_SEND, STAGE_DECODE, STAGE_CONVERT, STAGE_LOG, STAGE_RENDER, STAGE_TOTAL]
+# Not a stage: when a frame that came without times of its own was received, the stage after it is measured from there
+STAGE_RECEIVE="receive"
+
+# Latencies kept per stage, statistics are computed over the most recent ones
+HISTORY_SIZE=4096
+# Histogram bucket edges, in seconds (1us to 100s)
+BUCKET_EDGES=numpy.logspace(-6, 2, 17)
+METRICS_INTERVAL=10.0
+
+class RollingHistogram ():
+    def __init__ (self, capacity=HISTORY_SIZE):
+        self.capacity = capacity
+        self.values = numpy.zeros(capacity)
+        self.times = numpy.zeros(capacity)
+        self.next = 0
+        self.size = 0
+        self.total = 0
+
+    def add (self, value, now):
+        self.values[self.next] = value
+        self.times[self.next] = now
+        self.next = (self.next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.total += 1
+
+    def summary (self):
+        if self.size == 0:
+            return {"count": self.total}
+        values = self.values[:self.size]
+        times = self.times[:self.size]
+        span = times.max() - times.min()
+        counts, _ = numpy.histogram(values, bins=BUCKET_EDGES)
+        p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+        return {
+            "count": self.total,
+            "rate": (self.size - 1)/span if span > 0 else None,
+            "mean": float(values.mean()),
+            "p50": float(p50),
+            "p90": float(p90),
+            "p99": float(p99),
+            "max": float(values.max()),
+            "buckets": counts.tolist(),
+        }
+
+class MetricsRegistry ():
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.queues = {}
+
+    # Stamps a stage on a frame's stamps dict and records the time since the previous stage
+    #   stamps may be None for frames that are not traced
+    def stamp (self, stamps, stage, now=None):
+        if stamps is None:
+            return
+        now = time.time() if now is None else now
+        if stamps:
+            self.observe(stage, now - next(reversed(stamps.values())), now)
+        stamps[stage] = now
+
+    def observe (self, stage, latency, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = RollingHistogram()
+            self.histograms[stage].add(latency, now)
+
+    def count (self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Anything with a qsize() method: queue.Queue, asyncio.Queue
+    def register_queue (self, name, measured_queue):
+        with self.lock:
+            self.queues[name] = measured_queue
+
+    def snapshot (self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "stages": {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+                "queues": {name: measured_queue.qsize() for name, measured_queue in self.queues.items()},
+                "counters": dict(self.counters),
+                "bucket_edges": BUCKET_EDGES.tolist(),
+            }
+
+registry = MetricsRegistry()
+
+# Appends a JSON snapshot of the registry to a file every interval seconds, one per line
+# notes are written with every snapshot, to tell what its stages do not cover
+class MetricsDumper ():
+    def __init__ (self, file_path, interval=METRICS_INTERVAL, metrics=registry, process_name=None, notes=None):
+        self.file_path = file_path
+        self.interval = interval
+        self.metrics = metrics
+        self.process_name = process_name
+        self.notes = notes
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics_thread", daemon=True)
+        self.thread.start()
+
+    def dump (self):
+        snapshot = self.metrics.snapshot()
+        if self.process_name:
+            snapshot["process"] = self.process_name
+        if self.notes:
+            snapshot["notes"] = self.notes
+        with open(self.file_path, "a") as metrics_file:
+            metrics_file.write(json.dumps(snapshot) + "\n")
+
+    def _run (self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    # Writes a last snapshot
+    def close (self):
+        self.stopped.set()
+        self.thread.join()
+        self.dump()
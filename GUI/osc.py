@@ -3,147 +3,235 @@ import serial.tools.list_ports
 import numpy
 import os
 import sys
-import matplotlib.pyplot as plot
-import matplotlib.animation as animation
 import queue
 import threading
-import socket
 import argparse
 import signal
 import time
+import asyncio
 inter_path=os.path.dirname(os.path.realpath(__file__))
 sys.path.append(inter_path)
 from logger import Logger
+import protocol
+from serial_parser import SerialLineParser, FrameReassembler
+from serial_supervisor import ConnectionSupervisor
+import async_pipeline
+from frame_server import FrameServer, AsyncFrameServer, SUBSCRIBER_BUFFER_FRAMES
+import metrics
+from metrics import registry, STAGE_SERIAL, STAGE_ENQUEUE, STAGE_SEND
+from frame_clock import FrameClock, NOMINAL_PERIOD, DEFAULT_TIME_TOLERANCE
 
 
-parser = argparse.ArgumentParser(description='Serial monitor script. Creates a socket and sends data read from serial input there.')
-parser.add_argument('--port', help='Port to make serial connection', type=str, required=True)
-parser.add_argument('--nsensors', help='Number of sensors that will be monitored', type=int, required=True)
-parser.add_argument('--baud', help='Baud rate of serial connection', type=int, default=115200)
-parser.add_argument('--time-tolerance', help='Percentage of tolerance calculated over the sampling period', type=int, default=10)
-parser.add_argument('--verbose', help='Outputs all messages', action='store_true')
-args = parser.parse_args()
+READ_BUFFER_SIZE=16*1024
 
-TIME_TOLERANCE=args.time_tolerance/100
-
-# In seconds
-ACTUAL_SAMPLING_PERIOD=9.52
-DELTA=TIME_TOLERANCE*ACTUAL_SAMPLING_PERIOD
-CORRECTED_SAMPLING_PERIOD=ACTUAL_SAMPLING_PERIOD+DELTA
+# Frames are served on this local port, integ.py expects SERVER_PORT+i for board i
+SERVER_PORT=25565
 
 class Oscilloscope ():
     def __init__ (self, config):
         self.port = config['port']
         self.baud = config['baud']
         self.num_sensors = config['sensors']
-        self.sample_buffer = numpy.zeros(self.num_sensors)
+        self.sample_buffer = numpy.zeros(self.num_sensors, dtype=numpy.uint16)
+        self.parser = SerialLineParser(self.num_sensors)
+        self.read_mode = config.get('read_mode', 'line')
+        self.chunk_size = config.get('chunk_size', 0)
+        self.reassembler = FrameReassembler()
+        self.read_buffer = bytearray(max(self.chunk_size, READ_BUFFER_SIZE))
+        self.read_view = memoryview(self.read_buffer)
+        # None blocks until data arrives, a timeout lets the caller check if it must stop
+        self.timeout = config.get('timeout', None)
         self.logger = Logger("SERIAL")
-        if args.verbose:
+        if config.get('verbose', False):
             self.logger.set_debug()
         else:
             self.logger.set_info()
         self.sample = 0
         try:
-            self.ser = serial.Serial(port=self.port, baudrate=self.baud)
+            self.ser = self._open(self.port)
             self.connected=True
         except:
             self.logger.error ('Could not connect to serial port ' + self.port)
             available_ports = serial.tools.list_ports.comports()
-            self.logger.info (f"List of available ports")
+            self.logger.info ("List of available ports")
             for p in available_ports:
-                self.logger.info (f"\t{p}")
+                self.logger.info ("\t%s", p)
             exit(1)
+        self.supervisor = ConnectionSupervisor(self.port, self._open, self.logger)
+
+    def _open (self, port):
+        return serial.Serial(port=port, baudrate=self.baud, timeout=self.timeout)
 
     def close (self):
         self.ser.close()
 
-    # Returns a copy of the object's internal buffer
+    # Makes a reconnection in progress give up, so the thread reading the port can stop
+    def interrupt (self):
+        self.supervisor.interrupt()
+
+    # Waits for the port to come back, as long as a read would (forever if timeout is None)
+    #   Returns False if it is still lost
+    def reconnect (self):
+        if self.connected:
+            self.connected = False
+            self.supervisor.lost()
+            try:
+                self.ser.close()
+            except serial.SerialException:
+                pass
+        ser = self.supervisor.reconnect(self.timeout)
+        if ser is None:
+            return False
+        self.ser = ser
+        self.port = self.supervisor.port
+        self.connected = True
+        return True
+
+    # Returns a copy of the object's internal buffer, None if the port is lost and did not come back
     def get_serial_data (self):
         success_read = False
         while not success_read:
+            if not self.connected and not self.reconnect():
+                return None
             try:
                 data = self.ser.read_until('\n'.encode('utf-8'))
-                self.logger.debug(f"{data}")
-            except serial.SerialException:
-                self.logger.warning ('Lost connection on port ' + self.port)
-                self.connected = False
-                # If connection is lost, will keep trying to reconnect
-                while not self.connected:
-                    try:
-                        self.ser = serial.Serial(port=self.port, baudrate=self.baud)
-                        self.connected=True
-                        self.logger.warning ('Re-gained connection on port ' + self.port)
-                    except serial.SerialException:
-                        self.connected = False
-            try:
-                data = data.decode('utf-8')
-                data = data.rsplit('|')
-                data.remove('\r\n')
-                data = numpy.array(data)
-                data = numpy.flip(data)
-                for i in range(self.num_sensors):
-                    self.sample_buffer[i] = int(data[i])
+                self.logger.debug("%s", data)
+            except (serial.SerialException, OSError):
+                if not self.reconnect():
+                    return None
+                continue
+            frames = self.parser.parse(data)
+            if len(frames):
+                self.sample_buffer[:] = frames[-1]
                 success_read = True
-            except:
-                success_read = False
+            else:
+                self.logger.debug("Discarded malformed frame, rejects so far: %s", self.parser.rejects)
         return numpy.copy(self.sample_buffer)
 
-def produce_window(measurement_queue, ser, stop):
+    # Reads everything already waiting on the port (at least one byte) and returns all complete frames in it
+    #   Returns the host receive time of each frame and a (n_frames, num_sensors) array
+    #   Returns no frames if the read timed out or the port is lost and did not come back
+    def get_serial_frames (self):
+        while True:
+            if not self.connected and not self.reconnect():
+                return numpy.zeros(0), numpy.zeros((0, self.num_sensors), dtype=numpy.uint16)
+            try:
+                read_size = max(self.ser.in_waiting, 1)
+                if self.chunk_size:
+                    read_size = min(read_size, self.chunk_size)
+                read_size = min(read_size, len(self.read_buffer))
+                n_bytes = self.ser.readinto(self.read_view[:read_size])
+            except (serial.SerialException, OSError):
+                # A partial line from before the disconnection can not be completed
+                self.reassembler.clear()
+                if not self.reconnect():
+                    return numpy.zeros(0), numpy.zeros((0, self.num_sensors), dtype=numpy.uint16)
+                continue
+            if n_bytes == 0:
+                return numpy.zeros(0), numpy.zeros((0, self.num_sensors), dtype=numpy.uint16)
+            receive_time = time.time()
+            complete = self.reassembler.feed(self.read_view[:n_bytes])
+            if not complete:
+                continue
+            frames = self.parser.parse(complete)
+            if len(frames):
+                return numpy.full(len(frames), receive_time), frames
+            self.logger.debug("Discarded malformed frames, rejects so far: %s", self.parser.rejects)
+
+def produce_window(measurement_queue, ser, stop, verbose=False):
     producer_logger = Logger("SOCKET-PUT")
-    if args.verbose:
+    if verbose:
         producer_logger.set_debug()
     else:
         producer_logger.set_error()
     while not stop[0]:
         old_time = time.time()
-        measurement_buffer=ser.get_serial_data()
-        try:
-            measurement_queue.put(measurement_buffer, block=False)
-            producer_logger.debug(f"Delta: {time.time()-old_time:.3f}s")
-        except queue.Full:
-            producer_logger.warning("Measurement queue is full, dumping new measurements")
+        if ser.read_mode == 'chunk':
+            receive_times, measurement_buffers = ser.get_serial_frames()
+        else:
+            measurement_buffer = ser.get_serial_data()
+            measurement_buffers = [] if measurement_buffer is None else [measurement_buffer]
+            receive_times = [time.time()]
+        for receive_time, measurement_buffer in zip(receive_times, measurement_buffers):
+            stamps = {STAGE_SERIAL: receive_time}
+            # Stamped before the put, the consumer may take it right away
+            registry.stamp(stamps, STAGE_ENQUEUE)
+            try:
+                measurement_queue.put((receive_time, measurement_buffer, stamps), block=False)
+            except queue.Full:
+                producer_logger.warning("Measurement queue is full, dumping new measurements")
+                registry.count("dropped.window_queue")
+        producer_logger.debug("Delta: %.3fs", time.time()-old_time)
     ser.close()
     producer_logger.debug("Bye")
     exit(0)
 
-def consume_reading(measurement_queue, num_sensors, stop):
+# clock follows the period of the frames, so a frame is reported as soon as it is late
+def consume_reading(measurement_queue, stop, wire_protocol, clock, server, verbose=False):
     consumer_logger = Logger("SOCKET-SEND")
-    if args.verbose:
+    if verbose:
         consumer_logger.set_debug()
     else:
         consumer_logger.set_error()
-    connection_addr=('localhost', 25565)
-    try:
-        data_socket = socket.socket()
-        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        data_socket.connect(connection_addr)
-    except socket.timeout:
-        consumer_logger.error("Could not connect")
-        return
-    except ConnectionRefusedError:
-        consumer_logger.error("Could not connect")
-        return
+    seq = 0
     while not stop[0]:
         try:
-            measurement_buffer = measurement_queue.get(block=True, timeout=CORRECTED_SAMPLING_PERIOD)
+            receive_time, measurement_buffer, stamps = measurement_queue.get(block=True, timeout=clock.timeout(time.time()))
             measurement_queue.task_done()
         except queue.Empty:
-            consumer_logger.warning("Measurement readings are out of sync")
-            measurement_buffer = numpy.zeros(num_sensors)
-        try:
-            measurement_string="<"
-            for measurement in measurement_buffer:
-                measurement_int = int(measurement)
-                measurement_string+=f"|{measurement_int:04d}|"
-            measurement_string+=">"
-            data_socket.send(measurement_string.encode("utf-8"))
-        except:
-            consumer_logger.error("Could not send message on socket")
-    data_socket.close()
+            # Nothing is sent for the frames that did not arrive, the receiver finds the gap in the frame times
+            consumer_logger.warning("Measurement readings are out of sync, %d frames overdue", clock.overdue(time.time()))
+            registry.count("late.out_of_sync")
+            continue
+        clock.stamp([receive_time])
+        # Encoded once, whatever the number of subscribers
+        server.publish(protocol.encode_frame(wire_protocol, seq, receive_time, measurement_buffer))
+        registry.stamp(stamps, STAGE_SEND)
+        seq += 1
     consumer_logger.debug("Bye")
     exit(0)
 
+# asyncio version of produce_window and consume_reading, needs an Oscilloscope opened with timeout=0
+async def forward_frames(serial_reader, wire_protocol, server_port=SERVER_PORT, buffer_frames=SUBSCRIBER_BUFFER_FRAMES, verbose=False):
+    forward_logger = Logger("SOCKET-ASYNC")
+    if verbose:
+        forward_logger.set_debug()
+    else:
+        forward_logger.set_error()
+    server = AsyncFrameServer(server_port, buffer_frames, verbose)
+    try:
+        await server.start()
+    except OSError as e:
+        forward_logger.error("Could not listen on port %d: %s", server_port, e)
+        serial_reader.close()
+        return
+    frames = asyncio.Queue(async_pipeline.ASYNC_QUEUE_SIZE)
+    registry.register_queue("window_queue", frames)
+    try:
+        await async_pipeline.run_stages(async_pipeline.read_serial(serial_reader, frames), async_pipeline.publish_frames(frames, server, wire_protocol))
+    finally:
+        await server.close()
+        serial_reader.close()
+    forward_logger.debug("Bye")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serial monitor script. Serves data read from serial input to any number of local subscribers.')
+    parser.add_argument('--port', help='Port to make serial connection', type=str, required=True)
+    parser.add_argument('--nsensors', help='Number of sensors that will be monitored', type=int, required=True)
+    parser.add_argument('--baud', help='Baud rate of serial connection', type=int, default=115200)
+    parser.add_argument('--sampling-period', help='Expected seconds between frames, only used until the period is measured from the frames', type=float, default=NOMINAL_PERIOD)
+    parser.add_argument('--time-tolerance', help='Percentage of the sampling period a frame may arrive after it was due before it is late', type=int, default=DEFAULT_TIME_TOLERANCE)
+    parser.add_argument('--read-mode', help='Read one line per call or everything waiting on the port at once', choices=['line', 'chunk'], default='line')
+    parser.add_argument('--chunk-size', help='Max bytes per read in chunk mode (0 reads everything waiting on the port)', type=int, default=0)
+    parser.add_argument('--protocol', help='Wire format used to send frames through the socket', choices=protocol.PROTOCOLS, default=protocol.PROTOCOL_ASCII)
+    parser.add_argument('--server-port', help='Local TCP port subscribers connect to', type=int, default=SERVER_PORT)
+    parser.add_argument('--subscriber-buffer', help='Frames buffered for each subscriber, the oldest are dropped when it falls behind', type=int, default=SUBSCRIBER_BUFFER_FRAMES)
+    parser.add_argument('--metrics-file', help='Appends a JSON snapshot of latencies, queue depths and drops to this file periodically', type=str, default=None)
+    parser.add_argument('--metrics-interval', help='Seconds between metrics snapshots', type=float, default=metrics.METRICS_INTERVAL)
+    parser.add_argument('--asyncio', help='Reads and sends frames from an asyncio event loop instead of two threads', action='store_true')
+    parser.add_argument('--verbose', help='Outputs all messages', action='store_true')
+    args = parser.parse_args()
+
     stop_threads=[False]
     oscilloscope_logger = Logger("OSC")
     if args.verbose:
@@ -154,19 +242,49 @@ if __name__ == "__main__":
         'port' : args.port,
         'baud' : args.baud,
         'sensors' : args.nsensors,
+        'read_mode' : args.read_mode,
+        'chunk_size' : args.chunk_size,
+        'verbose' : args.verbose,
     }
-    oscilloscope_logger.debug(f"Starting serial communication with: {config}")
+    oscilloscope_logger.debug("Starting serial communication with: %s", config)
+    metrics_dumper = None
+    if args.metrics_file:
+        metrics_dumper = metrics.MetricsDumper(args.metrics_file, args.metrics_interval, process_name=f"osc:{args.port}")
+    def close_metrics():
+        if metrics_dumper:
+            metrics_dumper.close()
     # Create two threads one for serial comm and one for oscilloscope
     #   These threads will communicate through a queue that contains buffers
     #       Each buffer has a 16x1024 window
     #   Ideally one item should be put and consumed every 0.1s
     #   Queue must warn if more than one buffer is present
     #       Queue can store a max of 10 windows
+    if args.asyncio:
+        config['timeout'] = 0
+        pipeline = async_pipeline.PipelineThread(forward_frames, args=(Oscilloscope(config), args.protocol, args.server_port, args.subscriber_buffer, args.verbose))
+        def handler(signum, frame):
+            oscilloscope_logger.info("Stopping event loop")
+            pipeline.stop()
+            close_metrics()
+            exit(0)
+        signal.signal(signal.SIGINT, handler)
+        pipeline.start()
+        while pipeline.is_alive():
+            pipeline.join(1)
+        close_metrics()
+        exit(0)
     window_queue = queue.Queue(1024)
+    registry.register_queue("window_queue", window_queue)
     serial_reader = Oscilloscope(config)
     try:
-        producer_thread = threading.Thread(target=produce_window, name="producer_thread", args=(window_queue, serial_reader, stop_threads))
-        consumer_thread = threading.Thread(target=consume_reading, name="consumer_thread", args=(window_queue, serial_reader.num_sensors, stop_threads))
+        server = FrameServer(args.server_port, args.subscriber_buffer, args.verbose)
+    except OSError as e:
+        oscilloscope_logger.error("Could not listen on port %d: %s", args.server_port, e)
+        serial_reader.close()
+        exit(1)
+    try:
+        producer_thread = threading.Thread(target=produce_window, name="producer_thread", args=(window_queue, serial_reader, stop_threads, args.verbose))
+        consumer_thread = threading.Thread(target=consume_reading, name="consumer_thread", args=(window_queue, stop_threads, args.protocol, FrameClock(args.sampling_period, args.time_tolerance), server, args.verbose))
     except Exception as e:
         oscilloscope_logger.error("Could not create threads")
         exit(1)
@@ -174,8 +292,11 @@ if __name__ == "__main__":
     def handler(signum, frame):
         oscilloscope_logger.info("Killing threads")
         stop_threads[0]=True
+        serial_reader.interrupt()
         producer_thread.join()
         consumer_thread.join()
+        server.close()
+        close_metrics()
         exit(0)
     
     signal.signal(signal.SIGINT, handler)
@@ -184,4 +305,6 @@ if __name__ == "__main__":
     consumer_thread.start()
     producer_thread.join()
     consumer_thread.join()
-    window_queue.join()
\ No newline at end of file
+    window_queue.join()
+    server.close()
+    close_metrics()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import numpy
+
+# Fixed capacity history of (x, y) points, oldest points are overwritten once it is full
+class RingBuffer ():
+    def __init__ (self, capacity):
+        self.capacity = capacity
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.next = 0
+        self.size = 0
+
+    def __len__ (self):
+        return self.size
+
+    def append (self, x, y):
+        self.x[self.next] = x
+        self.y[self.next] = y
+        self.next = (self.next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    # Returns the points from oldest to newest
+    def data (self):
+        if self.size < self.capacity:
+            return self.x[:self.size], self.y[:self.size]
+        order = numpy.r_[self.next:self.capacity, 0:self.next]
+        return self.x[order], self.y[order]
+
+# Keeps the min and the max of every bucket, in their original order
+#   A line drawn through them looks the same as the full data at n_buckets pixels wide,
+#   spikes included, while the number of points stays bounded
+def minmax_decimate(x, y, n_buckets):
+    n_points = len(x)
+    n_buckets = max(int(n_buckets), 1)
+    if n_points <= 2*n_buckets:
+        return x, y
+    bucket_size = -(-n_points // n_buckets)
+    n_full = n_points // bucket_size
+    buckets = y[:n_full*bucket_size].reshape(n_full, bucket_size)
+    first = numpy.minimum(buckets.argmin(axis=1), buckets.argmax(axis=1))
+    last = numpy.maximum(buckets.argmin(axis=1), buckets.argmax(axis=1))
+    offsets = numpy.arange(n_full) * bucket_size
+    indexes = numpy.column_stack((first + offsets, last + offsets)).ravel()
+    if n_full*bucket_size < n_points:
+        tail = y[n_full*bucket_size:]
+        tail_indexes = numpy.unique([tail.argmin(), tail.argmax()]) + n_full*bucket_size
+        indexes = numpy.concatenate((indexes, tail_indexes))
+    return x[indexes], y[indexes]
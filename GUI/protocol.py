@@ -0,0 +1,145 @@
+import collections
+import struct
+import time
+import numpy
+from metrics import registry, STAGE_SERIAL, STAGE_SEND, STAGE_RECEIVE
+from serial_parser import ADC_MAX_CODE
+
+# Wire formats used between osc.py and integ.py
+#   ascii:  <|ABCD||ABCD||...|>  (one 4 digit field per sensor, legacy format)
+#   binary: fixed header followed by packed little-endian uint16 samples
+#           the sequence number lets the receiver count the frames it missed, ascii frames carry none
+PROTOCOL_ASCII="ascii"
+PROTOCOL_BINARY="binary"
+PROTOCOLS=[PROTOCOL_ASCII, PROTOCOL_BINARY]
+
+FRAME_MAGIC=b"TM"
+FRAME_VERSION=2
+# magic, version, reserved, sequence number, serial receive time (s), send time (s), sensor count
+FRAME_HEADER=struct.Struct("<2sBBIddH")
+SAMPLE_DTYPE=numpy.dtype("<u2")
+# Guards the decoder against garbage headers asking for huge payloads
+MAX_FRAME_SENSORS=1024
+
+# board tells which acquisition board sent the frame when several are read at once
+# stamps is the {stage: time} dict filled by metrics.registry.stamp(), None for frames that are not traced
+# missed is the number of frames of the board missing right before this one, set by frame_clock.FrameClock
+# slot is the frame_pool.FramePool buffer samples live in, None if they have a buffer of their own
+Frame = collections.namedtuple("Frame", ["seq", "timestamp", "samples", "board", "stamps", "missed", "slot"], defaults=(0, None, 0, None))
+
+def encode_ascii_frame(samples):
+    measurement_string="<"
+    for measurement in samples:
+        measurement_string+=f"|{int(measurement):04d}|"
+    measurement_string+=">"
+    return measurement_string.encode("utf-8")
+
+def encode_binary_frame(seq, timestamp, samples):
+    samples = numpy.asarray(samples, dtype=SAMPLE_DTYPE)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 0, seq & 0xFFFFFFFF, timestamp, time.time(), samples.size)
+    return header + samples.tobytes()
+
+def encode_frame(protocol, seq, timestamp, samples):
+    if protocol == PROTOCOL_BINARY:
+        return encode_binary_frame(seq, timestamp, samples)
+    return encode_ascii_frame(samples)
+
+# Decoders keep whatever was not consumed from previous reads, so data can be fed
+# exactly as it comes out of recv(): a frame split across reads or several frames
+# merged in a single read are both handled
+# Every frame is tagged with the board of the connection the decoder reads from
+# Samples are copied out of the receive buffer into buffers of pool, if there is one
+class BinaryFrameDecoder ():
+    def __init__ (self, board=0, pool=None):
+        self.board = board
+        self.pool = pool
+        self.buffer = bytearray()
+        self.discarded_bytes = 0
+        self.next_seq = None
+        # Frames the sender numbered but that never arrived
+        self.missed_frames = 0
+
+    def feed (self, data):
+        self.buffer += data
+        frames = []
+        position = 0
+        buffer_size = len(self.buffer)
+        while buffer_size - position >= FRAME_HEADER.size:
+            magic, version, _, seq, timestamp, send_time, nsensors = FRAME_HEADER.unpack_from(self.buffer, position)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION or nsensors > MAX_FRAME_SENSORS:
+                # Lost sync, look for the next magic
+                next_position = self.buffer.find(FRAME_MAGIC, position+1)
+                if next_position < 0:
+                    # Last byte may be the start of a split magic
+                    next_position = buffer_size-1
+                self.discarded_bytes += next_position-position
+                position = next_position
+                continue
+            frame_size = FRAME_HEADER.size + nsensors*SAMPLE_DTYPE.itemsize
+            if buffer_size - position < frame_size:
+                break
+            samples = numpy.frombuffer(self.buffer, dtype=SAMPLE_DTYPE, count=nsensors, offset=position+FRAME_HEADER.size)
+            slot = None
+            if self.pool is None:
+                samples = samples.copy()
+            else:
+                slot, samples = self.pool.copy_in(samples)
+            if self.next_seq is not None:
+                self.missed_frames += (seq - self.next_seq) & 0xFFFFFFFF
+            self.next_seq = (seq + 1) & 0xFFFFFFFF
+            frames.append(Frame(seq, timestamp, samples, self.board, {STAGE_SERIAL: timestamp, STAGE_SEND: send_time}, 0, slot))
+            position += frame_size
+        del self.buffer[:position]
+        return frames
+
+class AsciiFrameDecoder ():
+    def __init__ (self, board=0):
+        self.board = board
+        self.buffer = bytearray()
+        self.discarded_bytes = 0
+        # Well formed frames with a code the ADC can not output, they would not fit in the conversion tables
+        self.rejected_frames = 0
+        self.seq = 0
+
+    def feed (self, data):
+        self.buffer += data
+        frames = []
+        position = 0
+        receive_time = time.time()
+        while True:
+            start = self.buffer.find(b"<", position)
+            if start < 0:
+                self.discarded_bytes += len(self.buffer)-position
+                position = len(self.buffer)
+                break
+            end = self.buffer.find(b">", start)
+            if end < 0:
+                self.discarded_bytes += start-position
+                position = start
+                break
+            self.discarded_bytes += start-position
+            position = end+1
+            fields = bytes(self.buffer[start+1:end]).replace(b"|", b" ").split()
+            try:
+                samples = numpy.array(fields, dtype=numpy.int64)
+            except ValueError:
+                self.discarded_bytes += end+1-start
+                continue
+            # Checked before the cast, which would wrap negative codes around
+            if samples.size and (samples.min() < 0 or samples.max() > ADC_MAX_CODE):
+                self.discarded_bytes += end+1-start
+                self.rejected_frames += 1
+                registry.count("dropped.out_of_range")
+                continue
+            samples = samples.astype(SAMPLE_DTYPE)
+            # Nothing is known about the frame before it got here, its stages are measured from the socket
+            frames.append(Frame(self.seq, receive_time, samples, self.board, {STAGE_RECEIVE: receive_time}))
+            self.seq += 1
+        del self.buffer[:position]
+        return frames
+
+# Ascii frames are parsed into arrays of their own, only binary frames are copied into pool
+def make_decoder(protocol, board=0, pool=None):
+    if protocol == PROTOCOL_BINARY:
+        return BinaryFrameDecoder(board, pool)
+    return AsciiFrameDecoder(board)
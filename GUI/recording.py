@@ -0,0 +1,124 @@
+import os
+import struct
+import time
+import numpy
+
+# Binary session recording
+#   <name>.rec: fixed size header followed by fixed size records, appended as frames arrive
+#   <name>.rec.idx: sparse time index, one (timestamp, record number) entry per block of records
+RECORDING_MAGIC=b"TCCREC"
+RECORDING_VERSION=1
+# magic, version, number of sensors, record size, reserved
+RECORDING_HEADER=struct.Struct("<6sHHH52x")
+INDEX_SUFFIX=".idx"
+INDEX_DTYPE=numpy.dtype([("timestamp", "<f8"), ("record", "<u8")])
+# A new index entry is added at least every INDEX_INTERVAL seconds and every INDEX_MAX_RECORDS records
+INDEX_INTERVAL=60.0
+INDEX_MAX_RECORDS=4096
+WRITE_BUFFER_SIZE=1024*1024
+
+def record_dtype(n_sensors):
+    return numpy.dtype([
+        ("timestamp", "<f8"),
+        ("seq", "<u4"),
+        ("codes", "<u2", (n_sensors,)),
+        ("vref", "<f4", (2,)),
+        ("iref", "<f4", (2,)),
+    ])
+
+class RecordingWriter ():
+    # flush_interval: seconds between writes of the buffered records to disk (None leaves it to the buffer)
+    def __init__ (self, file_path, n_sensors, flush_interval=None):
+        self.file_path = file_path
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.dtype = record_dtype(n_sensors)
+        self.n_records = 0
+        self.last_index_time = None
+        self.last_index_record = 0
+        self.data_file = open(file_path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self.data_file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, n_sensors, self.dtype.itemsize))
+        self.index_file = open(file_path + INDEX_SUFFIX, "wb")
+
+    # timestamps, seqs: (n_records,), codes: (n_records, n_sensors), vref and iref: (2,) or (n_records, 2)
+    def append (self, timestamps, seqs, codes, vref, iref):
+        timestamps = numpy.atleast_1d(timestamps)
+        records = numpy.empty(len(timestamps), dtype=self.dtype)
+        records["timestamp"] = timestamps
+        records["seq"] = seqs
+        records["codes"] = codes
+        records["vref"] = vref
+        records["iref"] = iref
+        self._update_index(timestamps)
+        self.data_file.write(records.tobytes())
+        self.n_records += len(records)
+        if self.flush_interval is not None and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _update_index (self, timestamps):
+        entries = []
+        for i, timestamp in enumerate(timestamps.tolist()):
+            record = self.n_records + i
+            if self.last_index_time is None or timestamp - self.last_index_time >= INDEX_INTERVAL or record - self.last_index_record >= INDEX_MAX_RECORDS:
+                entries.append((timestamp, record))
+                self.last_index_time = timestamp
+                self.last_index_record = record
+        if entries:
+            self.index_file.write(numpy.array(entries, dtype=INDEX_DTYPE).tobytes())
+
+    def flush (self):
+        self.data_file.flush()
+        self.index_file.flush()
+        self.last_flush = time.monotonic()
+
+    def close (self):
+        self.data_file.close()
+        self.index_file.close()
+
+# Memory maps a recording, nothing is read until records are actually accessed
+class RecordingReader ():
+    def __init__ (self, file_path):
+        self.file_path = file_path
+        with open(file_path, "rb") as data_file:
+            magic, version, n_sensors, record_size = RECORDING_HEADER.unpack(data_file.read(RECORDING_HEADER.size))
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ValueError(f"{file_path} is not a version {RECORDING_VERSION} recording")
+        self.n_sensors = n_sensors
+        self.dtype = record_dtype(n_sensors)
+        if self.dtype.itemsize != record_size:
+            raise ValueError(f"{file_path} has records of {record_size} bytes, expected {self.dtype.itemsize}")
+        # A record being written when the session stopped is ignored
+        n_records = (os.path.getsize(file_path) - RECORDING_HEADER.size) // record_size
+        if n_records > 0:
+            self.records = numpy.memmap(file_path, dtype=self.dtype, mode="r", offset=RECORDING_HEADER.size, shape=(n_records,))
+        else:
+            self.records = numpy.zeros(0, dtype=self.dtype)
+        index_path = file_path + INDEX_SUFFIX
+        if os.path.exists(index_path):
+            self.index = numpy.fromfile(index_path, dtype=INDEX_DTYPE)
+            self.index = self.index[self.index["record"] < n_records]
+        else:
+            self.index = numpy.zeros(0, dtype=INDEX_DTYPE)
+
+    def __len__ (self):
+        return len(self.records)
+
+    def start_time (self):
+        return float(self.records[0]["timestamp"]) if len(self.records) else None
+
+    def end_time (self):
+        return float(self.records[-1]["timestamp"]) if len(self.records) else None
+
+    # Returns the records with start <= timestamp < end as a view of the mapped file
+    #   The sparse index narrows the search to one block on each side, so only those blocks are touched
+    def time_range (self, start, end):
+        first = self._find(start)
+        last = self._find(end)
+        return self.records[first:last]
+
+    def _find (self, timestamp):
+        block = numpy.searchsorted(self.index["timestamp"], timestamp, side="left")
+        lower = int(self.index["record"][block-1]) if block > 0 else 0
+        upper = int(self.index["record"][block]) if block < len(self.index) else len(self.records)
+        block_timestamps = self.records[lower:upper]["timestamp"]
+        return lower + int(numpy.searchsorted(block_timestamps, timestamp, side="left"))
@@ -0,0 +1,153 @@
+import json
+import threading
+import numpy
+
+# Windows the statistics are kept for, in seconds
+STATS_WINDOWS={"minute": 60, "hour": 3600, "day": 86400}
+# Each window is split in this many buckets, memory does not depend on the sampling rate
+#   Statistics cover the last window seconds, to the width of a bucket
+STATS_BUCKETS=60
+
+# Merges the moments of two sets of samples (Chan et al.)
+#   Moments are (count, mean of t, mean, M2 of t, M2, co-moment of t and the values)
+def merge_moments (a, b):
+    n_a, mean_t_a, mean_a, m2_t_a, m2_a, comoment_a = a
+    n_b, mean_t_b, mean_b, m2_t_b, m2_b, comoment_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    share_b = n_b/n
+    weight = n_a*n_b/n
+    delta_t = mean_t_b - mean_t_a
+    delta = mean_b - mean_a
+    return (n, mean_t_a + delta_t*share_b, mean_a + delta*share_b, m2_t_a + m2_t_b + delta_t**2*weight, m2_a + m2_b + delta**2*weight, comoment_a + comoment_b + delta_t*delta*weight)
+
+# Moments of a batch of samples, times: (n_samples,), values: (n_samples, n_sensors)
+def batch_moments (times, values):
+    mean_t = times.mean()
+    mean = values.mean(axis=0)
+    centered_t = times - mean_t
+    centered = values - mean
+    return (len(times), mean_t, mean, centered_t @ centered_t, (centered**2).sum(axis=0), centered_t @ centered)
+
+def empty_moments (n_sensors):
+    return (0, 0.0, numpy.zeros(n_sensors), 0.0, numpy.zeros(n_sensors), numpy.zeros(n_sensors))
+
+# drift is the slope of a least squares fit, in value units per hour
+def summarize_moments (moments):
+    n, mean_t, mean, m2_t, m2, comoment = moments
+    if n == 0:
+        return {"count": 0}
+    return {
+        "count": n,
+        "mean": mean.tolist(),
+        "std": numpy.sqrt(m2/n).tolist(),
+        "drift_per_hour": (comoment/m2_t*3600).tolist() if m2_t > 0 else None,
+    }
+
+# Statistics of every sensor over a sliding window, kept as a ring of time buckets
+#   Times are relative to the first sample, so their squares keep their precision
+class WindowStats ():
+    def __init__ (self, window, n_sensors, n_buckets=STATS_BUCKETS):
+        self.window = window
+        self.n_buckets = n_buckets
+        self.bucket_width = window/n_buckets
+        # Bucket number held by each slot of the ring, -1 if it is empty
+        self.bucket_ids = numpy.full(n_buckets, -1, dtype=numpy.int64)
+        self.count = numpy.zeros(n_buckets, dtype=numpy.int64)
+        self.mean_t = numpy.zeros(n_buckets)
+        self.m2_t = numpy.zeros(n_buckets)
+        self.mean = numpy.zeros((n_buckets, n_sensors))
+        self.m2 = numpy.zeros((n_buckets, n_sensors))
+        # Sum of (t - mean_t)*(value - mean), gives the slope of the values over time
+        self.comoment = numpy.zeros((n_buckets, n_sensors))
+        self.min = numpy.full((n_buckets, n_sensors), numpy.inf)
+        self.max = numpy.full((n_buckets, n_sensors), -numpy.inf)
+
+    # times: (n_frames,) relative times, values: (n_frames, n_sensors)
+    def add (self, times, values):
+        bucket_ids = numpy.floor(times/self.bucket_width).astype(numpy.int64)
+        # A batch spans one bucket, rarely two
+        for bucket_id in numpy.unique(bucket_ids):
+            if bucket_id <= self.bucket_ids.max() - self.n_buckets:
+                # Older than the window
+                continue
+            in_bucket = bucket_ids == bucket_id
+            self._merge(bucket_id, times[in_bucket], values[in_bucket])
+
+    def _merge (self, bucket_id, times, values):
+        slot = bucket_id % self.n_buckets
+        if self.bucket_ids[slot] != bucket_id:
+            self.bucket_ids[slot] = bucket_id
+            self.count[slot] = 0
+            self.mean_t[slot] = self.m2_t[slot] = 0
+            self.mean[slot] = self.m2[slot] = self.comoment[slot] = 0
+            self.min[slot] = numpy.inf
+            self.max[slot] = -numpy.inf
+        merged = merge_moments(self._moments(slot), batch_moments(times, values))
+        self.count[slot], self.mean_t[slot], self.mean[slot], self.m2_t[slot], self.m2[slot], self.comoment[slot] = merged
+        numpy.minimum(self.min[slot], values.min(axis=0), out=self.min[slot])
+        numpy.maximum(self.max[slot], values.max(axis=0), out=self.max[slot])
+
+    def _moments (self, slot):
+        return (int(self.count[slot]), float(self.mean_t[slot]), self.mean[slot], float(self.m2_t[slot]), self.m2[slot], self.comoment[slot])
+
+    # Merges the buckets still inside the window ending at relative time now
+    def snapshot (self, now):
+        live = self.bucket_ids > numpy.floor(now/self.bucket_width) - self.n_buckets
+        live &= self.count > 0
+        moments = empty_moments(self.mean.shape[1])
+        for slot in numpy.nonzero(live)[0]:
+            moments = merge_moments(moments, self._moments(slot))
+        summary = summarize_moments(moments)
+        if summary["count"]:
+            summary["min"] = self.min[live].min(axis=0).tolist()
+            summary["max"] = self.max[live].max(axis=0).tolist()
+        return summary
+
+# Rolling statistics of the sensors of one board over every window
+#   add() is called by the data handler, snapshot() may be called from any thread
+class RollingStats ():
+    def __init__ (self, sensor_names, summary_path=None, windows=STATS_WINDOWS, n_buckets=STATS_BUCKETS):
+        self.sensor_names = sensor_names
+        self.summary_path = summary_path
+        self.windows = {name: WindowStats(window, len(sensor_names), n_buckets) for name, window in windows.items()}
+        self.lock = threading.Lock()
+        self.start = None
+        self.last = None
+        self.frames = 0
+
+    # timestamps: (n_frames,) in seconds since the epoch, values: (n_frames, n_sensors)
+    def add (self, timestamps, values):
+        if not len(timestamps):
+            return
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        with self.lock:
+            if self.start is None:
+                self.start = timestamps.min()
+            times = timestamps - self.start
+            for window in self.windows.values():
+                window.add(times, values)
+            self.last = max(self.last or 0, timestamps.max())
+            self.frames += len(timestamps)
+
+    # Statistics of every window ending at now (defaults to the last sample)
+    def snapshot (self, now=None):
+        with self.lock:
+            snapshot = {"sensors": self.sensor_names, "frames": self.frames, "time": now or self.last, "windows": {}}
+            if self.start is None:
+                return snapshot
+            relative_now = (now or self.last) - self.start
+            for name, window in self.windows.items():
+                snapshot["windows"][name] = window.snapshot(relative_now)
+        return snapshot
+
+    def write_summary (self, file_path, now=None):
+        with open(file_path, "w") as summary_file:
+            json.dump(self.snapshot(now), summary_file, indent=1)
+
+    # Writes the summary, if it has a path
+    def close (self):
+        if self.summary_path:
+            self.write_summary(self.summary_path)
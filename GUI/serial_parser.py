@@ -0,0 +1,117 @@
+import numpy
+
+# The firmware prints each frame as "%04u|" for every sensor followed by "\r\n"
+ADC_MAX_CODE=1023
+FIELD_WIDTH=5
+DIGITS_PER_FIELD=FIELD_WIDTH-1
+SEPARATOR=ord('|')
+LINE_END=b"\r\n"
+
+REJECT_EMPTY="empty"
+REJECT_FIELD_COUNT="field_count"
+REJECT_MALFORMED="malformed"
+REJECT_OUT_OF_RANGE="out_of_range"
+REJECT_REASONS=[REJECT_EMPTY, REJECT_FIELD_COUNT, REJECT_MALFORMED, REJECT_OUT_OF_RANGE]
+
+PLACE_VALUES=numpy.array([1000, 100, 10, 1], dtype=numpy.uint16)
+
+# Parses many firmware lines at once into a (n_frames, num_sensors) uint16 array
+#   Lines with the expected fixed width are decoded together as a single byte matrix,
+#   anything else goes through a slower path that only has to classify the reject reason
+class SerialLineParser ():
+    def __init__ (self, num_sensors, max_code=ADC_MAX_CODE):
+        self.num_sensors = num_sensors
+        self.max_code = max_code
+        # Without the trailing "\n", which is used to split lines
+        self.line_length = num_sensors*FIELD_WIDTH + 1
+        self.accepted = 0
+        self.rejects = dict.fromkeys(REJECT_REASONS, 0)
+
+    def reset_counters (self):
+        self.accepted = 0
+        self.rejects = dict.fromkeys(REJECT_REASONS, 0)
+
+    # data must only hold complete lines, anything after the last "\n" is not a frame
+    def parse (self, data):
+        lines = bytes(data).split(b"\n")
+        if lines[-1] == b"":
+            lines.pop()
+        n_lines = len(lines)
+        frames = numpy.zeros((n_lines, self.num_sensors), dtype=numpy.uint16)
+        valid = numpy.zeros(n_lines, dtype=bool)
+        fixed_width = [i for i, line in enumerate(lines) if len(line) == self.line_length]
+        if fixed_width:
+            self._parse_fixed_width(lines, fixed_width, frames, valid)
+        if len(fixed_width) != n_lines:
+            fixed_width_set = set(fixed_width)
+            for i, line in enumerate(lines):
+                if i not in fixed_width_set:
+                    valid[i] = self._parse_line(line, frames[i])
+        self.accepted += int(numpy.count_nonzero(valid))
+        if valid.all():
+            return frames
+        return frames[valid]
+
+    def _parse_fixed_width (self, lines, indexes, frames, valid):
+        raw = numpy.frombuffer(b"".join(lines[i] for i in indexes), dtype=numpy.uint8)
+        raw = raw.reshape(len(indexes), self.line_length)
+        fields = raw[:, :-1].reshape(len(indexes), self.num_sensors, FIELD_WIDTH)
+        # Bytes below '0' wrap around and also fail the digit check
+        digits = fields[:, :, :DIGITS_PER_FIELD] - ord('0')
+        well_formed = (digits <= 9).all(axis=(1, 2))
+        well_formed &= (fields[:, :, -1] == SEPARATOR).all(axis=1)
+        well_formed &= raw[:, -1] == LINE_END[0]
+        codes = digits.astype(numpy.uint16) @ PLACE_VALUES
+        in_range = (codes <= self.max_code).all(axis=1)
+        self.rejects[REJECT_MALFORMED] += int(numpy.count_nonzero(~well_formed))
+        self.rejects[REJECT_OUT_OF_RANGE] += int(numpy.count_nonzero(well_formed & ~in_range))
+        accepted = well_formed & in_range
+        rows = numpy.asarray(indexes)
+        # The firmware pops its results as a stack, so the line comes in reverse order
+        frames[rows[accepted]] = codes[accepted, ::-1]
+        valid[rows[accepted]] = True
+
+    def _parse_line (self, line, frame):
+        line = line.rstrip(b"\r")
+        if not line:
+            self.rejects[REJECT_EMPTY] += 1
+            return False
+        fields = line.rstrip(b"|").split(b"|")
+        if len(fields) != self.num_sensors:
+            self.rejects[REJECT_FIELD_COUNT] += 1
+            return False
+        if not all(field.isdigit() for field in fields):
+            self.rejects[REJECT_MALFORMED] += 1
+            return False
+        codes = [int(field) for field in fields]
+        if max(codes) > self.max_code:
+            self.rejects[REJECT_OUT_OF_RANGE] += 1
+            return False
+        frame[:] = codes[::-1]
+        return True
+
+# Data kept waiting for a line end before it is considered garbage
+MAX_PENDING_BYTES=64*1024
+
+# Splits complete lines out of arbitrary chunks read from the port
+#   The bytes after the last line end are kept and completed by the next chunk
+class FrameReassembler ():
+    def __init__ (self, max_pending=MAX_PENDING_BYTES):
+        self.buffer = bytearray()
+        self.max_pending = max_pending
+        self.dropped_bytes = 0
+
+    def clear (self):
+        self.dropped_bytes += len(self.buffer)
+        del self.buffer[:]
+
+    def feed (self, chunk):
+        self.buffer += chunk
+        end = self.buffer.rfind(b"\n")
+        if end < 0:
+            if len(self.buffer) > self.max_pending:
+                self.clear()
+            return b""
+        complete = bytes(self.buffer[:end+1])
+        del self.buffer[:end+1]
+        return complete
@@ -0,0 +1,120 @@
+import os
+import time
+import random
+import threading
+import serial
+import serial.tools.list_ports
+from metrics import registry
+
+# In seconds, delay before the next attempt to open a lost port, doubled after every failure
+RECONNECT_MIN_DELAY=0.05
+RECONNECT_MAX_DELAY=2.0
+RECONNECT_BACKOFF=2
+# Each delay is randomly stretched or shrunk by up to this fraction, so boards lost together do not retry together
+RECONNECT_JITTER=0.25
+# In seconds, how often the ports are listed while the board is missing
+#   A board that shows up again is opened right away, without waiting for the backoff
+DISCOVERY_INTERVAL=1.0
+
+# (vid, pid, serial number) of a USB serial port, None if it is not a USB port or is not there
+#   port may be a symlink, such as the /dev/serial/by-id names
+def port_identity (port):
+    device = os.path.realpath(port)
+    for port_info in serial.tools.list_ports.comports():
+        if port_info.device in (port, device) and port_info.vid is not None:
+            return (port_info.vid, port_info.pid, port_info.serial_number)
+    return None
+
+# Device of the port with this identity, None if there is not exactly one
+#   Without serial number several identical boards can not be told apart, the current port is kept if it is one of them
+def find_port (identity, current_port=None):
+    vid, pid, serial_number = identity
+    devices = [port_info.device for port_info in serial.tools.list_ports.comports()
+               if port_info.vid == vid and port_info.pid == pid and (serial_number is None or port_info.serial_number == serial_number)]
+    if current_port in devices or os.path.realpath(current_port or "") in devices:
+        return current_port
+    if len(devices) == 1:
+        return devices[0]
+    return None
+
+# Reopens a serial port after it is lost, with exponential backoff and jitter between attempts
+#   The port is looked for again by its USB identity, so a board that comes back on another tty is found
+#   open_port(port) returns an open serial.Serial, or raises serial.SerialException
+class ConnectionSupervisor ():
+    def __init__ (self, port, open_port, logger):
+        self.port = port
+        self.open_port = open_port
+        self.logger = logger
+        self.identity = port_identity(port)
+        self.interrupted = threading.Event()
+        self.failures = 0
+        self.next_attempt = 0
+        self.next_discovery = 0
+        self.lost_time = None
+
+    # Makes reconnect() give up, so the thread reading the port can stop
+    def interrupt (self):
+        self.interrupted.set()
+
+    def lost (self):
+        self.logger.warning("Lost connection on port %s", self.port)
+        registry.count("serial.disconnects")
+        self.lost_time = time.monotonic()
+        self.failures = 0
+        # A glitch may only last a moment, the first attempt is right away
+        self.next_attempt = self.lost_time
+        self.next_discovery = self.lost_time + DISCOVERY_INTERVAL
+
+    # True if the board looks like it is there, follows it to its new port
+    def _discover (self):
+        if self.identity is None:
+            return os.path.exists(self.port) or self.port in [port_info.device for port_info in serial.tools.list_ports.comports()]
+        device = find_port(self.identity, self.port)
+        if device is None:
+            return False
+        if device != self.port:
+            self.logger.warning("Board of port %s found on %s", self.port, device)
+            registry.count("serial.port_changes")
+            self.port = device
+        return True
+
+    # One attempt to open the port, if it is due, returns the port or None
+    def _attempt (self):
+        now = time.monotonic()
+        if now >= self.next_discovery:
+            self.next_discovery = now + DISCOVERY_INTERVAL
+            if self._discover():
+                self.next_attempt = now
+        if now < self.next_attempt:
+            return None
+        registry.count("serial.reconnect_attempts")
+        try:
+            port = self.open_port(self.port)
+        except (serial.SerialException, OSError) as e:
+            self.failures += 1
+            delay = min(RECONNECT_MIN_DELAY*RECONNECT_BACKOFF**self.failures, RECONNECT_MAX_DELAY)
+            self.next_attempt = now + delay*random.uniform(1-RECONNECT_JITTER, 1+RECONNECT_JITTER)
+            self.logger.debug("Could not open %s: %s", self.port, e)
+            return None
+        downtime = time.monotonic() - self.lost_time
+        self.logger.warning("Re-gained connection on port %s after %.1fs", self.port, downtime)
+        registry.count("serial.reconnects")
+        registry.observe("serial.downtime", downtime)
+        return port
+
+    # Returns the reopened port, or None if interrupted or not reopened within timeout seconds
+    #   timeout=0 makes a single attempt if one is due, for readers that must not block
+    def reconnect (self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            port = self._attempt()
+            if port is not None:
+                return port
+            now = time.monotonic()
+            wait = min(self.next_attempt, self.next_discovery) - now
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                wait = min(wait, deadline - now)
+            if self.interrupted.wait(max(wait, 0)):
+                return None
@@ -0,0 +1,44 @@
+import numpy
+import topology
+from analyze_logs import analyze_file, gap_rows
+from conversion import ConversionEngine, codes_to_voltage, R1, R2, V_A
+
+N_SENSORS=32
+VREF=numpy.array([0.5, 0.5])
+IREF=numpy.array([4E-6, 4E-6])
+
+# Rows of a log as integ.py writes them: time, VREF_A, VREF_B and the resistance of every sensor
+def log_rows (codes):
+    engine = ConversionEngine(5, 1023, R1, R2, V_A, True)
+    vplot_table, resistance_table = engine.build_tables(VREF, IREF)
+    frames = numpy.hstack((numpy.zeros((len(codes), 2), dtype=codes.dtype), codes))
+    _, resistances = engine.convert_with_tables(frames, vplot_table, resistance_table)
+    return numpy.hstack((numpy.tile(VREF, (len(codes), 1)), resistances))
+
+def write_log (file_path, values):
+    with open(file_path, "w") as log_file:
+        log_file.write(",".join(["time"] + ["sensor%d" % sensor for sensor in range(values.shape[1])]) + "\n")
+        for row, row_values in enumerate(values):
+            log_file.write(",".join(["%.3f" % (row*0.1)] + ["%.3f" % value for value in row_values]) + "\n")
+
+def measured_codes (n_frames):
+    return numpy.random.default_rng(0).integers(150, 250, (n_frames, N_SENSORS))
+
+def test_zero_filled_row_is_skipped (tmp_path):
+    codes = measured_codes(10)
+    codes[4] = 0
+    file_path = str(tmp_path / "log_zero_row.csv")
+    write_log(file_path, log_rows(codes))
+    summary = analyze_file(file_path, topology.DEFAULT_TOPOLOGY, 10, 5, 1023)
+    assert summary["rows"] == 10
+    assert summary["skipped_rows"] == 1
+    assert summary["sensor_moments"][0] == 9
+
+def test_measured_rows_are_not_gaps ():
+    values = log_rows(measured_codes(100))
+    assert not gap_rows(values).any()
+    assert gap_rows(log_rows(numpy.zeros((1, N_SENSORS), dtype=numpy.int64))).all()
+
+def test_zero_resistances_before_iref_are_gaps ():
+    values = numpy.zeros((3, 2 + N_SENSORS))
+    assert gap_rows(values).all()
@@ -0,0 +1,39 @@
+import numpy
+from conversion import ConversionEngine
+from calibration import Calibrator, REFERENCE_SEED_FRAMES
+
+N_SENSORS=32
+REFERENCE_CODE=102
+# A sensor read in the VREF_A slot
+OUTLIER_CODE=188
+
+def make_calibrator ():
+    return Calibrator(ConversionEngine(5, 1023, 1, 4.4, 1, True), 200E3)
+
+def frame (vref_a=REFERENCE_CODE):
+    samples = numpy.full(N_SENSORS, REFERENCE_CODE, dtype=numpy.uint16)
+    samples[0] = vref_a
+    return samples
+
+def test_outlier_first_frame_does_not_bias_references ():
+    calibrator = make_calibrator()
+    calibrator.update(frame(OUTLIER_CODE))
+    for _ in range(REFERENCE_SEED_FRAMES - 1):
+        calibrator.update(frame())
+    assert abs(calibrator.smoothed[0] - REFERENCE_CODE) < 1
+    assert abs(calibrator.calibration.vref[0] - REFERENCE_CODE*5/1023) < 0.01
+
+def test_outlier_first_frame_in_a_batch ():
+    calibrator = make_calibrator()
+    calibrator.update(numpy.vstack([frame(OUTLIER_CODE)] + [frame()]*REFERENCE_SEED_FRAMES))
+    assert abs(calibrator.smoothed[0] - REFERENCE_CODE) < 1
+
+def test_batch_is_smoothed_like_single_frames ():
+    samples = numpy.random.default_rng(0).integers(90, 110, (20, N_SENSORS)).astype(numpy.uint16)
+    one_by_one = make_calibrator()
+    for frame_samples in samples:
+        one_by_one.update(frame_samples)
+    batched = make_calibrator()
+    batched.update(samples[:3])
+    batched.update(samples[3:])
+    assert numpy.allclose(one_by_one.smoothed, batched.smoothed)
@@ -0,0 +1,93 @@
+import json
+import os
+from collections import namedtuple
+import numpy
+
+# Layout of the resistors of the chip, loaded once from a JSON file
+#   Resistors are grouped by physical proximity, a group is expected to read similar resistances
+#   Groups are compiled into gather indices so the statistics of every group of every matrix are
+#   computed for a whole batch of frames with a few numpy operations
+DEFAULT_TOPOLOGY=os.path.join(os.path.dirname(os.path.realpath(__file__)), "topology.json")
+# Subplot grid of a matrix figure when the topology does not give one
+DEFAULT_GRID=[2, 3]
+
+# Statistics of a batch of frames, one row per frame
+#   mean, max_voltage and max_sensor have one column per group, in topology order
+#   deviation and deviating have one column per member of a group, in ChipTopology.members order
+GroupStats = namedtuple("GroupStats", ["mean", "max_voltage", "max_sensor", "deviation", "deviating"])
+
+# A figure of the GUI, groups is the slice of the topology groups it shows
+class Matrix ():
+    def __init__ (self, key, title, grid, groups, titles, cells):
+        self.key = key
+        self.title = title
+        self.grid = grid
+        self.groups = groups
+        self.titles = titles
+        self.cells = cells
+
+class ChipTopology ():
+    def __init__ (self, description):
+        self.name = description.get("name", "")
+        # Resistor number of the first converted value, the values of a frame do not include the VREFs
+        self.first_resistor = description["first_resistor"]
+        self.n_resistors = description["resistors"]
+        self.matrices = []
+        members = []
+        starts = []
+        for matrix in description["matrices"]:
+            first_group = len(starts)
+            grid = matrix.get("grid", DEFAULT_GRID)
+            titles = []
+            cells = []
+            for group in matrix["groups"]:
+                if not group["resistors"]:
+                    raise ValueError(f"Empty group in matrix {matrix['key']}")
+                starts.append(len(members))
+                members.extend(self.index(resistor) for resistor in group["resistors"])
+                titles.append(group.get("title", "|".join(f"R{resistor}" for resistor in group["resistors"])))
+                # Without a cell, groups fill the grid row by row
+                n_group = len(titles) - 1
+                cells.append(tuple(group.get("cell", (n_group // grid[1], n_group % grid[1]))))
+            self.matrices.append(Matrix(matrix["key"], matrix.get("title", f"Matrix {matrix['key']}"), grid, slice(first_group, len(starts)), titles, cells))
+        self.members = numpy.array(members, dtype=numpy.intp)
+        self.starts = numpy.array(starts, dtype=numpy.intp)
+        self.sizes = numpy.diff(numpy.append(self.starts, len(self.members)))
+        # Group of each member
+        self.segments = numpy.repeat(numpy.arange(len(self.starts)), self.sizes)
+        self.positions = {self.index(int(resistor)): tuple(position) for resistor, position in description.get("positions", {}).items()}
+
+    # Index in the converted values of a frame of a resistor number
+    def index (self, resistor):
+        index = resistor - self.first_resistor
+        if not 0 <= index < self.n_resistors:
+            raise ValueError(f"R{resistor} is not on the chip")
+        return index
+
+    def label (self, index):
+        return f"R{index + self.first_resistor}"
+
+    # Mean of every group and deviation of every member from the mean of its group
+    #   resistances is (n_frames, n_resistors)
+    def group_deviation (self, resistances):
+        member_resistances = resistances[:, self.members]
+        mean = numpy.add.reduceat(member_resistances, self.starts, axis=1)/self.sizes
+        return mean, member_resistances - mean[:, self.segments]
+
+    # vplots and resistances are (n_frames, n_resistors), or a single frame
+    #   The max voltage of a group is the first of its members holding it, as listed in the topology
+    def group_stats (self, vplots, resistances, max_deviation):
+        vplots = numpy.atleast_2d(vplots)
+        mean, deviation = self.group_deviation(numpy.atleast_2d(resistances))
+        member_vplots = vplots[:, self.members]
+        max_voltage = numpy.maximum.reduceat(member_vplots, self.starts, axis=1)
+        n_members = len(self.members)
+        holds_max = member_vplots == max_voltage[:, self.segments]
+        first = numpy.minimum.reduceat(numpy.where(holds_max, numpy.arange(n_members), n_members), self.starts, axis=1)
+        # NaN voltages hold no max, the first member of their group is taken
+        first = numpy.where(first < n_members, first, self.starts)
+        return GroupStats(mean, max_voltage, self.members[first], deviation, numpy.abs(deviation) > max_deviation)
+
+def load_topology (file_path=DEFAULT_TOPOLOGY):
+    with open(file_path) as topology_file:
+        return ChipTopology(json.load(topology_file))
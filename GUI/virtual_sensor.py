@@ -0,0 +1,220 @@
+import os
+import sys
+import tty
+import time
+import select
+import signal
+import threading
+import argparse
+import numpy
+inter_path=os.path.dirname(os.path.realpath(__file__))
+sys.path.append(inter_path)
+from logger import Logger
+
+# Software model of platformIO-project/src/main.cpp
+#   Reproduces the order in which the sketch samples its channels (next_chan/next_mux),
+#   the stack order in which ADC_RESULT::pop_value sends them and the "%04u|" + CRLF line format
+
+N_SENSORS=34
+ADC_MAX_CODE=1023
+# 34 conversions, one every 35 Timer2 interrupts of 8ms
+FIRMWARE_SAMPLING_PERIOD=9.52
+DEFAULT_VREF_CODE=102
+DEFAULT_SENSOR_CODES=(120, 220)
+
+class FirmwareEmulator ():
+    def __init__ (self, noise=1.0, drift=0.0, vref_code=DEFAULT_VREF_CODE, seed=None):
+        self.rng = numpy.random.default_rng(seed)
+        self.noise = noise
+        # In ADC codes per hour
+        self.drift = drift
+        self.vref_code = vref_code
+        self.baselines = {}
+        self.start_time = None
+        # Firmware globals
+        self.chan = 8
+        self.is_next = 0
+        self.measurements_A_B = 0
+        self.control_A_B = 'A'
+        self.pins_A = 0
+        self.pins_B = 0
+        # first_setup() leaves ADMUX on A0
+        self.adc_channel = 0
+        self.data = []
+
+    def next_chan (self, chan):
+        if self.is_next == 3 or chan > 7:
+            self.is_next = 0
+            chan += 1
+        else:
+            self.is_next += 1
+        # Only analog inputs up to A9 will be used
+        return chan % 10
+
+    def next_mux (self):
+        # Only channels 0 to 7, that measure matrix sensors, need this multiplexing logic
+        if self.chan < 8:
+            if self.measurements_A_B == 16:
+                self.measurements_A_B = 0
+                self.control_A_B = 'B' if self.control_A_B == 'A' else 'A'
+            if self.control_A_B == 'A':
+                self.pins_A = self.measurements_A_B & 0xF
+            else:
+                self.pins_B = self.measurements_A_B & 0xF
+            self.measurements_A_B += 1
+
+    # What is physically connected to the ADC right now
+    def slot (self):
+        if self.adc_channel >= 8:
+            return (self.adc_channel,)
+        pins = self.pins_A if self.control_A_B == 'A' else self.pins_B
+        return (self.adc_channel, self.control_A_B, pins)
+
+    def sample (self, slot, elapsed):
+        if slot not in self.baselines:
+            if slot[0] >= 8:
+                self.baselines[slot] = float(self.vref_code)
+            else:
+                self.baselines[slot] = float(self.rng.uniform(*DEFAULT_SENSOR_CODES))
+        value = self.baselines[slot] + self.drift*elapsed/3600 + self.rng.normal(0, self.noise)
+        return int(min(max(round(value), 0), ADC_MAX_CODE))
+
+    def make_conversion (self, elapsed):
+        # Conversion uses the channel and mux selected after the previous one, as in loop()
+        value = self.sample(self.slot(), elapsed)
+        self.chan = self.next_chan(self.chan)
+        self.adc_channel = self.chan & 0xF
+        self.next_mux()
+        if len(self.data) < N_SENSORS:
+            self.data.append(value)
+
+    # Runs the sketch until it prints a frame and returns the raw bytes, along with the pushed values
+    def next_frame (self, now=None):
+        now = time.time() if now is None else now
+        if self.start_time is None:
+            self.start_time = now
+        elapsed = now - self.start_time
+        for _ in range(N_SENSORS):
+            self.make_conversion(elapsed)
+        values = self.data
+        self.data = []
+        # serial_transaction() pops the values as a stack
+        line = "".join(f"{value:04d}|" for value in reversed(values)) + "\r\n"
+        return line.encode("ascii"), values
+
+# Corrupts frames the ways a real serial link does
+class FaultInjector ():
+    def __init__ (self, drop_rate=0.0, corrupt_rate=0.0, truncate_rate=0.0, saturate_rate=0.0, seed=None):
+        self.rng = numpy.random.default_rng(seed)
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.truncate_rate = truncate_rate
+        self.saturate_rate = saturate_rate
+        self.injected = {"drop": 0, "corrupt": 0, "truncate": 0, "saturate": 0}
+
+    def apply (self, line):
+        if self.rng.random() < self.drop_rate:
+            self.injected["drop"] += 1
+            return b""
+        line = bytearray(line)
+        if self.rng.random() < self.saturate_rate:
+            sensor = int(self.rng.integers(N_SENSORS))
+            line[sensor*5:sensor*5+4] = b"%04d" % ADC_MAX_CODE
+            self.injected["saturate"] += 1
+        if self.rng.random() < self.corrupt_rate:
+            line[int(self.rng.integers(len(line)-2))] = int(self.rng.integers(256))
+            self.injected["corrupt"] += 1
+        if self.rng.random() < self.truncate_rate:
+            del line[int(self.rng.integers(1, len(line)-2)):-2]
+            self.injected["truncate"] += 1
+        return bytes(line)
+
+# Pseudo-terminal that osc.py can open as if it was the board's serial port
+class VirtualPort ():
+    def __init__ (self, link=None):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.name = os.ttyname(self.slave)
+        self.link = link
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.name, link)
+        self.pending = b""
+        self.overruns = 0
+
+    # Returns False if the line could not be written before the deadline (None waits forever)
+    def write (self, data, deadline=None):
+        self.pending += data
+        while self.pending:
+            timeout = None if deadline is None else max(deadline-time.monotonic(), 0)
+            _, writable, _ = select.select([], [self.master], [], timeout)
+            if not writable:
+                # Nobody is reading fast enough, the UART would overrun
+                self.pending = b""
+                self.overruns += 1
+                return False
+            try:
+                written = os.write(self.master, self.pending)
+                self.pending = self.pending[written:]
+            except BlockingIOError:
+                pass
+        return True
+
+    def close (self):
+        if self.link and os.path.lexists(self.link):
+            os.remove(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Emulates the ATmega2560 firmware on a pseudo-terminal. Prints the port name on the first line of stdout.')
+    parser.add_argument('--period', help='Seconds between frames (0 sends as fast as the reader takes them)', type=float, default=FIRMWARE_SAMPLING_PERIOD)
+    parser.add_argument('--frames', help='Stop after this many frames (0 runs forever)', type=int, default=0)
+    parser.add_argument('--noise', help='Standard deviation of the noise added to every sample (in ADC codes)', type=float, default=1.0)
+    parser.add_argument('--drift', help='Drift added to every sample (in ADC codes per hour)', type=float, default=0.0)
+    parser.add_argument('--vref-code', help='ADC code read on the VREF channels', type=int, default=DEFAULT_VREF_CODE)
+    parser.add_argument('--drop-rate', help='Probability of a frame being lost', type=float, default=0.0)
+    parser.add_argument('--corrupt-rate', help='Probability of a byte of a frame being corrupted', type=float, default=0.0)
+    parser.add_argument('--truncate-rate', help='Probability of a frame being truncated', type=float, default=0.0)
+    parser.add_argument('--saturate-rate', help='Probability of a sensor of a frame reading full scale', type=float, default=0.0)
+    parser.add_argument('--seed', help='Seed for sensor values, noise and faults', type=int, default=None)
+    parser.add_argument('--link', help='Also creates a symlink to the port with this name', type=str, default=None)
+    parser.add_argument('--verbose', help='Outputs all messages', action='store_true')
+    args = parser.parse_args()
+
+    virtual_logger = Logger("VIRTUAL")
+    if args.verbose:
+        virtual_logger.set_debug()
+    else:
+        virtual_logger.set_warning()
+
+    emulator = FirmwareEmulator(noise=args.noise, drift=args.drift, vref_code=args.vref_code, seed=args.seed)
+    faults = FaultInjector(args.drop_rate, args.corrupt_rate, args.truncate_rate, args.saturate_rate, seed=args.seed)
+    port = VirtualPort(args.link)
+    print(port.name, flush=True)
+
+    stop=threading.Event()
+    def handler(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+    sent = 0
+    next_frame_time = time.monotonic() + args.period
+    while not stop.is_set() and (args.frames == 0 or sent < args.frames):
+        if args.period > 0:
+            if stop.wait(max(next_frame_time-time.monotonic(), 0)):
+                break
+            next_frame_time += args.period
+            deadline = next_frame_time
+        else:
+            deadline = None
+        line, _ = emulator.next_frame()
+        line = faults.apply(line)
+        if line and port.write(line, deadline):
+            virtual_logger.debug("%s", line)
+        sent += 1
+    virtual_logger.info("Sent %d frames, %d overruns, injected faults: %s", sent, port.overruns, faults.injected)
+    port.close()